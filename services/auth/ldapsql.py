@@ -39,18 +39,23 @@
 from hashlib import sha1
 import random
 import urlparse
+from threading import Lock
 
 import ldap
 
 from sqlalchemy.ext.declarative import declarative_base, Column
 from sqlalchemy import Integer, String, SmallInteger
-from sqlalchemy.sql import select, insert, update, and_
+from sqlalchemy.sql import insert, select
 
 from metlog.holder import CLIENT_HOLDER
 from services.util import BackendError, ssha, create_engine
 from services.auth import NodeAttributionError
-from services.ldappool import ConnectionManager, StateConnector
+from services.ldappool import (ConnectionManager, StateConnector,
+                               AUTH_MODES, backend_error)
+from services.cache import LRUCache, MISSING
+from services.events import notify, USER_CHANGED
 from services.auth.resetcode import ResetCodeManager
+from services.auth.nodes import NodeAllocator
 
 #
 # Custom SQL tables:
@@ -93,7 +98,16 @@ class LDAPAuth(ResetCodeManager):
                  nodes_scheme='https', check_account_state=True,
                  create_tables=False, ldap_pool_size=10, ldap_use_pool=False,
                  connector_cls=StateConnector, check_node=False,
-                 ldap_max_lifetime=600, **kw):
+                 ldap_max_lifetime=600, ldap_checkout_timeout=None,
+                 ldap_max_waiters=None, ldap_min_idle=0,
+                 ldap_maintenance_interval=0, ldap_auth_mode='pool',
+                 ldap_bind_check_size=5, ldap_use_async=False,
+                 ldap_server_policy='round_robin', ldap_failure_threshold=3,
+                 ldap_failure_cooldown=30, ldap_master_uri=None,
+                 ldap_dn_cache_size=0, ldap_dn_cache_ttl=300,
+                 ldap_dn_cache_negative_ttl=10, id_block_size=1,
+                 nodes_refresh_interval=60, nodes_flush_interval=5,
+                 sweep_interval=0, **kw):
         self.check_account_state = check_account_state
         self.ldapuri = ldapuri
         self.sqluri = sqluri
@@ -108,12 +122,39 @@ class LDAPAuth(ResetCodeManager):
         self.nodes_scheme = nodes_scheme
         self.ldap_timeout = ldap_timeout
         # by default, the ldap connections use the bind user
-        self.conn = ConnectionManager(ldapuri, bind_user, bind_password,
-                                      use_tls=use_tls, timeout=ldap_timeout,
-                                      size=ldap_pool_size,
-                                      use_pool=ldap_use_pool,
-                                      connector_cls=connector_cls,
-                                      max_lifetime=ldap_max_lifetime)
+        self.conn = ConnectionManager(
+                ldapuri, bind_user, bind_password, use_tls=use_tls,
+                timeout=ldap_timeout, size=ldap_pool_size,
+                use_pool=ldap_use_pool, connector_cls=connector_cls,
+                max_lifetime=ldap_max_lifetime,
+                checkout_timeout=ldap_checkout_timeout,
+                max_waiters=ldap_max_waiters, min_idle=ldap_min_idle,
+                maintenance_interval=ldap_maintenance_interval,
+                use_async=ldap_use_async, server_policy=ldap_server_policy,
+                failure_threshold=ldap_failure_threshold,
+                failure_cooldown=ldap_failure_cooldown,
+                master_uri=ldap_master_uri)
+
+        # user binds can be kept away from the admin/search pool
+        if ldap_auth_mode not in AUTH_MODES:
+            raise ValueError('Unknown LDAP auth mode %r' % ldap_auth_mode)
+        self.auth_mode = ldap_auth_mode
+        if ldap_auth_mode == 'pool':
+            self.bind_check = self.conn
+        else:
+            self.bind_check = ConnectionManager(
+                ldapuri, use_tls=use_tls, timeout=ldap_timeout,
+                size=ldap_bind_check_size, use_pool=True,
+                connector_cls=connector_cls, max_lifetime=ldap_max_lifetime,
+                server_policy=ldap_server_policy,
+                failure_threshold=ldap_failure_threshold,
+                failure_cooldown=ldap_failure_cooldown,
+                master_uri=ldap_master_uri)
+
+        # user name <-> (user id, dn) lookups, unknown users included
+        self._dn_cache = LRUCache(ldap_dn_cache_size, ldap_dn_cache_ttl)
+        self.dn_cache_negative_ttl = float(ldap_dn_cache_negative_ttl)
+
         sqlkw = {'pool_size': int(pool_size),
                  'pool_recycle': int(pool_recycle),
                  'logging_name': 'weaveserver'}
@@ -131,90 +172,176 @@ class LDAPAuth(ResetCodeManager):
             engine = None
 
         self.check_node = check_node
+        if engine is not None:
+            self._nodes = NodeAllocator(engine, available_nodes,
+                                        nodes_refresh_interval,
+                                        nodes_flush_interval)
+        else:
+            self._nodes = None
+        # user ids reserved by this process, and not handed out yet
+        self.id_block_size = int(id_block_size)
+        self._next_id = self._last_id = 0
+        self._id_lock = Lock()
         self.logger = CLIENT_HOLDER.default_client
-        ResetCodeManager.__init__(self, engine, create_tables=create_tables)
+        ResetCodeManager.__init__(self, engine, create_tables=create_tables,
+                                  sweep_interval=sweep_interval)
+
+    def _conn(self, bind=None, passwd=None, write=False):
+        return self.conn.connection(bind, passwd, write=write)
 
-    def _conn(self, bind=None, passwd=None):
-        return self.conn.connection(bind, passwd)
+    def _user_conn(self, bind, passwd, write=False):
+        """Returns a connector bound as a user.
+
+        Unless the auth mode is "pool", these come from the dedicated
+        bind-check connectors instead of the admin/search pool.
+        """
+        if self.bind_check is self.conn or passwd is None:
+            return self._conn(bind, passwd, write=write)
+        return self.bind_check.connection(bind, passwd, write=write)
 
     def _purge_conn(self, bind, passwd=None):
         self.conn.purge(bind, passwd=None)
+        if self.bind_check is not self.conn:
+            self.bind_check.purge(bind, passwd=None)
+
+    def _compare_password(self, dn, password):
+        """Checks a user password with an LDAP compare on the admin pool."""
+        if isinstance(password, unicode):
+            password = password.encode('utf8')
+        with self._conn() as conn:
+            try:
+                return bool(conn.compare_s(dn, 'userPassword', password))
+            except ldap.NO_SUCH_OBJECT:
+                return False
+            except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
+                self.logger.debug('Could not compare the user password.')
+                raise backend_error(e)
 
-    def _get_dn_by_filter(self, filter):
-        dn = self.users_root
-        scope = ldap.SCOPE_SUBTREE
+    def _search_user(self, filter, attrs):
+        """Returns the (dn, attrs) of the first user matching filter."""
         with self._conn() as conn:
             try:
-                user = conn.search_st(dn, scope, filterstr=filter,
-                                      attrlist=[],
+                user = conn.search_st(self.users_root, ldap.SCOPE_SUBTREE,
+                                      filterstr=filter, attrlist=attrs,
                                       timeout=self.ldap_timeout)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not get the user info from ldap')
-                raise BackendError(str(e))
+                raise backend_error(e)
             except ldap.NO_SUCH_OBJECT:
                 return None
 
         if user is None or len(user) == 0:
             return None
+        return user[0]
+
+    def _cache_user(self, user_name, user_id, dn):
+        self._dn_cache.set(('name', user_name), (dn, user_id))
+        self._dn_cache.set(('id', user_id), (user_name, dn))
+
+    def _forget_user(self, user_name=None, user_id=None):
+        """Removes a user from the DN cache."""
+        if user_id is not None:
+            cached = self._dn_cache.get(('id', str(user_id)))
+            if cached is not None and user_name is None:
+                user_name = cached[0]
+            self._dn_cache.delete(('id', str(user_id)))
+        if user_name is not None:
+            self._dn_cache.delete(('name', user_name))
+
+    def _lookup_name(self, user_name):
+        """Returns the (dn, user id) of a user name, or None."""
+        key = ('name', user_name)
+        res = self._dn_cache.get(key, MISSING)
+        if res is not MISSING:
+            return res
+
+        user = self._search_user('(uid=%s)' % user_name, ['uidNumber'])
+        if user is None:
+            self._dn_cache.set(key, None, self.dn_cache_negative_ttl)
+            return None
+
+        dn, attrs = user
+        user_id = attrs['uidNumber'][0]
+        self._cache_user(user_name, user_id, dn)
+        return dn, user_id
+
+    def _lookup_id(self, user_id):
+        """Returns the (user name, dn) of a user id, or None."""
+        user_id = str(user_id)
+        key = ('id', user_id)
+        res = self._dn_cache.get(key, MISSING)
+        if res is not MISSING:
+            return res
+
+        user = self._search_user('(uidNumber=%s)' % user_id, ['uid'])
+        if user is None:
+            self._dn_cache.set(key, None, self.dn_cache_negative_ttl)
+            return None
 
-        return user[0][0]
+        dn, attrs = user
+        user_name = attrs['uid'][0]
+        self._cache_user(user_name, user_id, dn)
+        return user_name, dn
 
     def _userid2dn(self, user_id):
-        return self._get_dn_by_filter('(uidNumber=%s)' % user_id)
+        res = self._lookup_id(user_id)
+        return res and res[1]
 
     def _username2dn(self, user_name):
-        return self._get_dn_by_filter('(uid=%s)' % user_name)
+        res = self._lookup_name(user_name)
+        return res and res[0]
 
     def _get_username(self, user_id):
         """Returns the name for a user id"""
-        dn = self.users_root
-        scope = ldap.SCOPE_SUBTREE
-        filter = '(uidNumber=%s)' % user_id
-
-        with self._conn() as conn:
-            try:
-                user = conn.search_st(dn, scope, filterstr=filter,
-                                      attrlist=['uid'],
-                                      timeout=self.ldap_timeout)
-            except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
-                self.logger.debug('Could not get the user info from ldap')
-                raise BackendError(str(e))
-            except ldap.NO_SUCH_OBJECT:
-                return None
-
-        if user is None or len(user) == 0:
-            return None
-
-        user = user[0][1]
-        return user['uid'][0]
+        res = self._lookup_id(user_id)
+        return res and res[0]
 
     def get_user_id(self, user_name):
         """Returns the id for a user name"""
-        dn = self.users_root
-        scope = ldap.SCOPE_SUBTREE
-        filter = '(uid=%s)' % user_name
+        res = self._lookup_name(user_name)
+        return res and res[1]
 
-        with self._conn() as conn:
-            try:
-                user = conn.search_st(dn, scope, filterstr=filter,
-                                      attrlist=['uidNumber'],
-                                      timeout=self.ldap_timeout)
-            except (ldap.TIMEOUT, ldap.OTHER), e:
-                self.logger.debug('Could not get the user id from ldap.')
-                raise BackendError(str(e))
-            except ldap.NO_SUCH_OBJECT:
-                return None
+    def _reserve_user_ids(self, size):
+        """Reserves size user ids, and returns the first one.
 
-        if user is None or len(user) == 0:
-            return None
-        user = user[0][1]
-        return user['uidNumber'][0]
+        The last id of the block is inserted in user_ids while the end of
+        the table is locked, so a block always starts above every id handed
+        out before, whatever the block size used by the other processes.
+        """
+        if size == 1:
+            # XXX see if we could use back-sql instead to deal with autoinc
+            res = self._engine.execute(insert(userids))
+            return res.inserted_primary_key[0]
+
+        query = select([userids.c.id], for_update=True)
+        query = query.order_by(userids.c.id.desc()).limit(1)
+        conn = self._engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                last = conn.execute(query).scalar() or 0
+                conn.execute(insert(userids).values(id=last + size))
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+        return last + 1
 
     def _get_next_user_id(self):
-        """Returns the next user id"""
-        # XXX see if we could use back-sql instead to deal with autoinc
-        res = self._engine.execute(insert(userids))
-        return res.inserted_primary_key[0]
+        """Returns the next user id
+
+        Ids are reserved by blocks of id_block_size in user_ids, and then
+        handed out by this process.
+        """
+        with self._id_lock:
+            if self._next_id >= self._last_id:
+                self._next_id = self._reserve_user_ids(self.id_block_size)
+                self._last_id = self._next_id + self.id_block_size
+            user_id = self._next_id
+            self._next_id += 1
+            return user_id
 
     def create_user(self, user_name, password, email):
         """Creates a user. Returns True on success."""
@@ -238,13 +365,16 @@ class LDAPAuth(ResetCodeManager):
         user = user.items()
         dn = "uidNumber=%i,%s" % (user_id, self.users_base_dn)
 
-        with self._conn(self.admin_user, self.admin_password) as conn:
+        with self._conn(self.admin_user, self.admin_password,
+                        write=True) as conn:
             try:
                 res, __ = conn.add_s(dn, user)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not create the user.')
-                raise BackendError(str(e))
+                raise backend_error(e)
 
+        # the name might have been cached as unknown
+        self._forget_user(user_name, user_id)
         return res == ldap.RES_ADD
 
     def authenticate_user(self, user_name, password, host=None):
@@ -265,8 +395,16 @@ class LDAPAuth(ResetCodeManager):
         if self.check_node:
             attrs.append('primaryNode')
 
+        if self.auth_mode == 'compare':
+            if not self._compare_password(dn, password):
+                return None
+            # the password is good, let's read the entry as admin
+            user_conn = self._conn()
+        else:
+            user_conn = self._user_conn(dn, password)
+
         try:
-            with self._conn(dn, password) as conn:
+            with user_conn as conn:
                 user = conn.search_st(dn, ldap.SCOPE_BASE,
                                       attrlist=attrs,
                                       timeout=self.ldap_timeout)
@@ -274,7 +412,7 @@ class LDAPAuth(ResetCodeManager):
             return None
         except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
             self.logger.debug('Could not authenticate the user.')
-            raise BackendError(str(e))
+            raise backend_error(e)
 
         if user is None:
             return None
@@ -319,7 +457,7 @@ class LDAPAuth(ResetCodeManager):
                                      timeout=self.ldap_timeout)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not get the user info in ldap.')
-                raise BackendError(str(e))
+                raise backend_error(e)
             except ldap.NO_SUCH_OBJECT:
                 return None, None
 
@@ -351,12 +489,12 @@ class LDAPAuth(ResetCodeManager):
         user_name = self._get_username(user_id)
         dn = self._username2dn(user_name)
 
-        with self._conn(dn, password) as conn:
+        with self._user_conn(dn, password, write=True) as conn:
             try:
                 res, __ = conn.modify_s(dn, user)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not update the email field in ldap.')
-                raise BackendError(str(e))
+                raise backend_error(e)
 
         return res == ldap.RES_MODIFY
 
@@ -382,16 +520,18 @@ class LDAPAuth(ResetCodeManager):
         user = [(ldap.MOD_REPLACE, 'userPassword', [password_hash])]
 
         try:
-            with self._conn(user_dn, old_password) as conn:
+            with self._user_conn(user_dn, old_password,
+                                 write=True) as conn:
                 try:
                     res, __ = conn.modify_s(user_dn, user)
                 except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                     self.logger.debug('Could not update the password in ldap.')
-                    raise BackendError(str(e))
+                    raise backend_error(e)
         except ldap.INVALID_CREDENTIALS:
             return False
 
         self._purge_conn(user_dn, new_password)
+        notify(USER_CHANGED, user_id)
         return res == ldap.RES_MODIFY
 
     def admin_update_password(self, user_id, new_password, key):
@@ -422,16 +562,18 @@ class LDAPAuth(ResetCodeManager):
         user = [(ldap.MOD_REPLACE, 'userPassword', [password_hash])]
 
         try:
-            with self._conn(self.admin_user, self.admin_password) as conn:
+            with self._conn(self.admin_user, self.admin_password,
+                            write=True) as conn:
                 try:
                     res, __ = conn.modify_s(user_dn, user)
                 except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                     self.logger.debug('Could not update the password in ldap.')
-                    raise BackendError(str(e))
+                    raise backend_error(e)
         except ldap.INVALID_CREDENTIALS:
             return False
 
         self._purge_conn(user_dn, new_password)
+        notify(USER_CHANGED, user_id)
         return res == ldap.RES_MODIFY
 
     def delete_user(self, user_id, password=None):
@@ -447,18 +589,21 @@ class LDAPAuth(ResetCodeManager):
         dn = self._userid2dn(user_id)
 
         try:
-            with self._conn(self.admin_user, self.admin_password) as conn:
+            with self._conn(self.admin_user, self.admin_password,
+                            write=True) as conn:
                 try:
                     res, __ = conn.delete_s(dn)
                 except ldap.NO_SUCH_OBJECT:
                     return False
                 except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                     self.logger.debug('Could not delete the user in ldap')
-                    raise BackendError(str(e))
+                    raise backend_error(e)
         except ldap.INVALID_CREDENTIALS:
             return False
 
+        self._forget_user(user_id=user_id)
         self._purge_conn(dn)
+        notify(USER_CHANGED, user_id)
         return res == ldap.RES_DELETE
 
     def get_user_node(self, user_id, assign=True):
@@ -476,7 +621,7 @@ class LDAPAuth(ResetCodeManager):
                                      timeout=self.ldap_timeout)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not get the user node in ldap')
-                raise BackendError(str(e))
+                raise backend_error(e)
 
         res = res[0][1]
 
@@ -490,49 +635,38 @@ class LDAPAuth(ResetCodeManager):
         if not assign:
             return None
 
-        # the user don't have a node yet, let's pick the most bored node
-        where = and_(available_nodes.c.available_assignments > 0,
-                     available_nodes.c.downed == 0)
-        query = select([available_nodes]).where(where)
-        query = query.order_by(available_nodes.c.actives).limit(1)
-
-        res = self._engine.execute(query)
-        res = res.fetchone()
-        if res is None:
+        # the user don't have a node yet, let's pick the most bored node.
+        # The assignment is taken before updating LDAP, and given back if
+        # that fails.
+        node = self._nodes.allocate()
+        if node is None:
             # unable to get a node
             msg = 'Unable to get a node for user id: %s'
             self.logger.debug(msg % str(user_id))
             raise NodeAttributionError(user_id)
 
-        node = str(res.node)
-        available = res.available_assignments
-        actives = res.actives
+        try:
+            self._set_user_node(user_id, dn, node)
+        except (BackendError, NodeAttributionError):
+            self._nodes.release(node)
+            raise
+
+        return '%s://%s/' % (self.nodes_scheme, node)
 
-        # updating LDAP now
+    def _set_user_node(self, user_id, dn, node):
         user = [(ldap.MOD_REPLACE, 'primaryNode', ['weave:%s' % node]),
                 (ldap.MOD_REPLACE, 'syncNode', node)]
 
-        with self._conn(self.admin_user, self.admin_password) as conn:
+        with self._conn(self.admin_user, self.admin_password,
+                        write=True) as conn:
             try:
                 ldap_res, __ = conn.modify_s(dn, user)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not update the server node in LDAP')
-                raise BackendError(str(e))
+                raise backend_error(e)
 
         if ldap_res != ldap.RES_MODIFY:
             # unable to set the node in LDAP
             self.logger.debug('Unable to set the newly attributed node '
                               'in LDAP for %s' % str(user_id))
             raise NodeAttributionError(user_id)
-
-        # node is set at this point
-        try:
-            # book-keeping in sql
-            query = update(available_nodes)
-            query = query.where(available_nodes.c.node == node)
-            query = query.values(available_assignments=available - 1,
-                                 actives=actives + 1)
-            self._engine.execute(query)
-        finally:
-            # we want to return the node even if the sql update fails
-            return '%s://%s/' % (self.nodes_scheme, node)
@@ -0,0 +1,209 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Node allocation
+
+Assigns the new users to the nodes listed in the available_nodes table,
+without a round-trip to pick the node.
+"""
+import time
+import atexit
+import weakref
+from threading import Lock, Timer
+
+from sqlalchemy.sql import select, update, bindparam, and_
+
+from metlog.holder import CLIENT_HOLDER
+from services.util import safe_execute
+from services.exceptions import BackendError
+
+
+# flushed when the process exits
+_ALLOCATORS = weakref.WeakSet()
+
+
+class NodeAllocator(object):
+    """Picks the nodes of the new users.
+
+    The nodes accepting users are cached, and reloaded every
+    `refresh_interval` seconds, or when none of them has room left. The
+    least busy one is picked, then an assignment is taken from it with a
+    relative, conditional decrement, so that concurrent processes can't
+    overbook a node.
+
+    The actives counts are only used to order the nodes, so they are
+    incremented in memory, and written `flush_interval` seconds after the
+    first change, once `flush_threshold` of them are pending, and when the
+    process exits.
+    """
+    def __init__(self, engine, table, refresh_interval=60, flush_interval=5,
+                 flush_threshold=100):
+        self._engine = engine
+        self._table = table
+        self.refresh_interval = float(refresh_interval)
+        self.flush_interval = float(flush_interval)
+        self.flush_threshold = int(flush_threshold)
+        # node -> [available assignments, actives]
+        self._nodes = {}
+        self._refreshed = 0
+        # node -> actives not written yet
+        self._pending = {}
+        self._timer = None
+        self._lock = Lock()
+        self.logger = CLIENT_HOLDER.default_client
+        _ALLOCATORS.add(self)
+
+        node = table.c.node == bindparam('node_name')
+        available = table.c.available_assignments
+        self._reserve = update(table).where(and_(node, available > 0))
+        self._reserve = self._reserve.values(
+                available_assignments=available - 1)
+        self._release = update(table).where(node).values(
+                available_assignments=available + 1)
+        self._add_actives = update(table).where(node).values(
+                actives=table.c.actives + bindparam('count'))
+
+    def _refresh(self):
+        table = self._table
+        query = select([table.c.node, table.c.available_assignments,
+                        table.c.actives])
+        query = query.where(and_(table.c.available_assignments > 0,
+                                 table.c.downed == 0))
+        nodes = {}
+        for row in safe_execute(self._engine, query):
+            nodes[str(row.node)] = [row.available_assignments,
+                                    (row.actives or 0) +
+                                    self._pending.get(str(row.node), 0)]
+        self._nodes = nodes
+        self._refreshed = time.time()
+
+    def _pick(self, exclude):
+        """Returns the node with the less actives, or None."""
+        candidates = [(actives, node)
+                      for node, (available, actives) in self._nodes.items()
+                      if available > 0 and node not in exclude]
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+    def allocate(self):
+        """Takes an assignment from the least busy node, and returns the
+        node. Returns None if every node is full.
+        """
+        full = set()
+        refreshed = False
+        while True:
+            with self._lock:
+                if time.time() - self._refreshed > self.refresh_interval:
+                    self._refresh()
+                    refreshed = True
+                node = self._pick(full)
+                if node is None and not refreshed:
+                    # nodes may have been added or reopened meanwhile
+                    self._refresh()
+                    refreshed = True
+                    node = self._pick(full)
+            if node is None:
+                return None
+
+            res = safe_execute(self._engine, self._reserve, node_name=node)
+            with self._lock:
+                counts = self._nodes.get(node)
+                if res.rowcount != 1:
+                    # another process took the last assignments
+                    if counts is not None:
+                        counts[0] = 0
+                    full.add(node)
+                    continue
+                if counts is not None:
+                    counts[0] -= 1
+                    counts[1] += 1
+                self._add_pending(node, 1)
+                flush = (sum(self._pending.values()) >=
+                         self.flush_threshold)
+
+            if flush:
+                self.flush()
+            return node
+
+    def _add_pending(self, node, count):
+        """Counts actives to write. Lock must be held."""
+        self._pending[node] = self._pending.get(node, 0) + count
+        if self._timer is None:
+            self._timer = Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def release(self, node):
+        """Gives back an assignment taken by allocate(), when the user
+        could not be set on the node."""
+        safe_execute(self._engine, self._release, node_name=node)
+        with self._lock:
+            counts = self._nodes.get(node)
+            if counts is not None:
+                counts[0] += 1
+                counts[1] -= 1
+            self._add_pending(node, -1)
+
+    def flush(self):
+        """Writes the actives counts."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for node, count in pending.items():
+            if count == 0:
+                continue
+            try:
+                safe_execute(self._engine, self._add_actives, node_name=node,
+                             count=count)
+            except BackendError:
+                # kept for the next flush
+                with self._lock:
+                    self._add_pending(node, count)
+                if self.logger is not None:
+                    self.logger.debug('Could not update the actives of %s'
+                                      % node)
+
+
+@atexit.register
+def _flush_allocators():
+    for allocator in list(_ALLOCATORS):
+        try:
+            allocator.flush()
+        except Exception:
+            # the database may be gone already
+            pass
@@ -43,11 +43,13 @@ import datetime
 
 from sqlalchemy.ext.declarative import declarative_base, Column
 from sqlalchemy import String, DateTime
-from sqlalchemy.sql import bindparam, select, insert, delete
+from sqlalchemy.sql import bindparam, select, delete, and_
 
 from metlog.holder import CLIENT_HOLDER
 from services.util import safe_execute
 from services.resetcodes import ResetCode
+from services.resetcodes.sweeper import get_sweeper
+from services.resetcodes.rc_sql import store_reset_code
 
 
 _Base = declarative_base()
@@ -58,24 +60,32 @@ class ResetCodes(_Base):
 
     username = Column(String(32), primary_key=True, nullable=False)
     reset = Column(String(32))
-    expiration = Column(DateTime())
+    expiration = Column(DateTime(), index=True)
 
 reset_codes = ResetCodes.__table__
 
-_USER_RESET_CODE = select([reset_codes.c.expiration,
-                           reset_codes.c.reset],
-              reset_codes.c.username == bindparam('user_name'))
+_USER_RESET_CODE = select([reset_codes.c.reset],
+              and_(reset_codes.c.username == bindparam('user_name'),
+                   reset_codes.c.expiration > bindparam('now')))
 
 
 class ResetCodeManager(object):
     """ Implements the reset code methods for auth backends.
+
+    Expired codes can be deleted by a background sweeper every
+    `sweep_interval` seconds (0, the default, disables it). The sweeper
+    is started on the first write, so that it runs in forked workers.
     """
-    def __init__(self, engine, create_tables=False):
+    def __init__(self, engine, create_tables=False, sweep_interval=0,
+                 sweep_batch_size=1000):
         self._engine = engine
+        self._sweeper = None
         if engine is not None:
             reset_codes.metadata.bind = engine
             if create_tables:
                 reset_codes.create(checkfirst=True)
+            self._sweeper = get_sweeper(engine, reset_codes,
+                                        sweep_interval, sweep_batch_size)
         self.rc = ResetCode()
         self.logger = CLIENT_HOLDER.default_client
 
@@ -83,54 +93,34 @@ class ResetCodeManager(object):
     # Private methods
     #
     def _get_reset_code(self, user_id):
-        res = self._engine.execute(_USER_RESET_CODE, user_name=user_id)
+        # expired codes are left to the sweeper
+        res = safe_execute(self._engine, _USER_RESET_CODE, user_name=user_id,
+                           now=datetime.datetime.now())
         res = res.fetchone()
-
-        if res is None or res.reset is None or res.expiration is None:
+        if res is None:
             return None
-
-        if isinstance(res.expiration, basestring):
-            exp = datetime.datetime.strptime(res.expiration,
-                                             '%Y-%m-%d %H:%M:%S.%f')
-        else:
-            exp = res.expiration
-
-        if exp < datetime.datetime.now():
-            # expired
-            self.clear_reset_code(user_id)
-            return None
-
         return res.reset
 
-    def _set_reset_code(self, user_id):
+    def _set_reset_code(self, user_id, overwrite=True):
+        """Stores a new code, and returns the stored one: unless overwrite
+        is True, a valid code stored already is kept and returned."""
+        if self._sweeper is not None:
+            self._sweeper.start()
         code = self.rc._generate_reset_code()
         expiration = datetime.datetime.now() + datetime.timedelta(hours=6)
-        query = delete(reset_codes).where(reset_codes.c.username == user_id)
-        self._engine.execute(query)
-
-        query = insert(reset_codes).values(reset=code,
-                                           expiration=expiration,
-                                           username=user_id)
-
-        res = safe_execute(self._engine, query)
-
-        if res.rowcount != 1:
+        stored = store_reset_code(self._engine, reset_codes,
+                                  {'username': user_id}, code, expiration,
+                                  overwrite)
+        if stored is None and overwrite:
             self.logger.debug('Unable to add a new reset code in the'
                          ' reset_code table')
-            return None  # XXX see if appropriate
-
-        return code
+        return stored  # XXX see if None is appropriate
 
     #
     # Public methods
     #
     def generate_reset_code(self, user_id, overwrite=False):
-        if not overwrite:
-            stored_code = self._get_reset_code(user_id)
-            if stored_code is not None:
-                return stored_code
-
-        return self._set_reset_code(user_id)
+        return self._set_reset_code(user_id, overwrite)
 
     def verify_reset_code(self, user_id, code):
         if not self.rc._check_reset_code(code):
@@ -42,13 +42,16 @@ import urlparse
 
 from sqlalchemy import create_engine
 from sqlalchemy.interfaces import PoolListener
-from sqlalchemy.sql import bindparam, select, insert, update, delete
+from sqlalchemy.sql import (bindparam, select, insert, update, delete, and_,
+                            or_)
 from sqlalchemy.pool import NullPool
 
 from metlog.holder import CLIENT_HOLDER
-from services.util import validate_password, ssha256, safe_execute
+from services.util import (validate_password, ssha256, safe_execute,
+                           parse_weighted_uris, ReadRouter)
 from services.auth.resetcode import ResetCodeManager
 from services.resetcodes import ResetCode
+from services.events import notify, USER_CHANGED
 
 # sharing the same table than the sql storage
 from services.auth.sqlmappers import users
@@ -68,8 +71,9 @@ _USER_AUTH = select([users.c.id, users.c.password_hash, users.c.status],
 _USER_PASSWORD = select([users.c.id, users.c.password_hash],
                          users.c.id == bindparam('user_id'))
 
-_USER_RESET_CODE = select([users.c.reset_expiration, users.c.reset],
-                          users.c.id == bindparam('user_id'))
+_USER_RESET_CODE = select([users.c.reset],
+                          and_(users.c.id == bindparam('user_id'),
+                               users.c.reset_expiration > bindparam('now')))
 
 
 class SetTextFactory(PoolListener):
@@ -84,7 +88,8 @@ class SQLAuth(ResetCodeManager):
     """SQL authentication."""
 
     def __init__(self, sqluri=_SQLURI, pool_size=20, pool_recycle=60,
-                 create_tables=False, no_pool=False, **kw):
+                 create_tables=False, no_pool=False, read_sqluris=None,
+                 replica_retry_after=30, read_write_window=5, **kw):
         sqlkw = {'logging_name': 'weaveserver'}
         if sqluri.startswith('sqlite'):
             sqlkw['listeners'] = [SetTextFactory()]
@@ -104,19 +109,46 @@ class SQLAuth(ResetCodeManager):
             users.create(checkfirst=True)
         self.sqluri = sqluri
         self.logger = CLIENT_HOLDER.default_client
-        ResetCodeManager.__init__(self, engine, create_tables=create_tables)
+        # the codes are kept in the users rows, there's no table to sweep
+        ResetCodeManager.__init__(self, engine, create_tables=create_tables,
+                                  sweep_interval=0)
+
+        # read-only lookups can go to replicas
+        read_engines = []
+        if read_sqluris is not None:
+            for uri, weight in parse_weighted_uris(read_sqluris):
+                read_engines.append((create_engine(uri, **sqlkw), weight))
+        self._reads = ReadRouter(engine, read_engines,
+                                 retry_after=replica_retry_after,
+                                 write_window=read_write_window)
+
+    def _written(self, user_id=None, user_name=None):
+        """Sends the next reads about this user to the primary.
+
+        Must be called before the write, since the user name is looked up
+        on the primary when not given.
+        """
+        if not self._reads.replicas:
+            return
+        if user_name is None and user_id is not None:
+            user = safe_execute(self._engine, _USER_NAME,
+                                uid=user_id).fetchone()
+            if user is not None:
+                user_name = user.username
+        self._reads.written(('user_id', user_id), ('user_name', user_name))
 
     def _get_username(self, uid):
         """Returns the id for a user name"""
-        user = safe_execute(self._engine, _USER_NAME, uid=uid).fetchone()
+        user = self._reads.execute(_USER_NAME, ('user_id', uid),
+                                   uid=uid).fetchone()
         if user is None:
             return None
         return user.username
 
     def get_user_id(self, user_name):
         """Returns the id for a user name"""
-        user = safe_execute(self._engine, _USER_ID,
-                            user_name=user_name).fetchone()
+        user = self._reads.execute(_USER_ID, ('user_name', user_name),
+                                   user_name=user_name).fetchone()
         if user is None:
             return None
         return user.id
@@ -126,6 +158,7 @@ class SQLAuth(ResetCodeManager):
         password_hash = ssha256(password)
         query = insert(users).values(username=user_name, email=email,
                                      password_hash=password_hash, status=1)
+        self._written(user_name=user_name)
         res = safe_execute(self._engine, query)
         return res.rowcount == 1
 
@@ -133,8 +166,8 @@ class SQLAuth(ResetCodeManager):
         """Authenticates a user given a user_name and password.
 
         Returns the user id in case of success. Returns None otherwise."""
-        user = safe_execute(self._engine, _USER_AUTH,
-                            user_name=user_name).fetchone()
+        user = self._reads.execute(_USER_AUTH, ('user_name', user_name),
+                                   user_name=user_name).fetchone()
         if user is None:
             return None
 
@@ -153,8 +186,8 @@ class SQLAuth(ResetCodeManager):
         Returns:
             tuple: username, email
         """
-        res = safe_execute(self._engine, _USER_INFO,
-                           user_id=user_id).fetchone()
+        res = self._reads.execute(_USER_INFO, ('user_id', user_id),
+                                  user_id=user_id).fetchone()
         if res is None:
             return None, None
 
@@ -171,6 +204,7 @@ class SQLAuth(ResetCodeManager):
             True if the change was successful, False otherwise
         """
         query = update(users).where(users.c.id == user_id)
+        self._written(user_id)
         res = safe_execute(self._engine, query.values(email=email))
         return res.rowcount == 1
 
@@ -189,8 +223,10 @@ class SQLAuth(ResetCodeManager):
         #
         password_hash = ssha256(password)
         query = update(users).where(users.c.id == user_id)
+        self._written(user_id)
         res = safe_execute(self._engine,
                            query.values(password_hash=password_hash))
+        notify(USER_CHANGED, user_id)
         return res.rowcount == 1
 
     def admin_update_password(self, user_id, password, key):
@@ -212,8 +248,10 @@ class SQLAuth(ResetCodeManager):
 
         password_hash = ssha256(password)
         query = update(users).where(users.c.id == user_id)
+        self._written(user_id)
         res = safe_execute(self._engine,
                            query.values(password_hash=password_hash))
+        notify(USER_CHANGED, user_id)
         return res.rowcount == 1
 
     def delete_user(self, user_id, password=None):
@@ -237,7 +275,9 @@ class SQLAuth(ResetCodeManager):
                 return False
 
         query = delete(users).where(users.c.id == user_id)
+        self._written(user_id)
         res = safe_execute(self._engine, query)
+        notify(USER_CHANGED, user_id)
         return res.rowcount == 1
 
     def get_user_node(self, user_id, assign=True):
@@ -256,32 +296,30 @@ class SQLAuth(ResetCodeManager):
         return res.rowcount == 1
 
     def _get_reset_code(self, user_id):
-        res = self._engine.execute(_USER_RESET_CODE, user_id=user_id)
+        # an expired code is simply ignored, and overwritten by the next one
+        res = safe_execute(self._engine, _USER_RESET_CODE, user_id=user_id,
+                           now=datetime.datetime.now())
         res = res.fetchone()
-
-        if res is None or res.reset is None or res.reset_expiration is None:
-            return None
-
-        if isinstance(res.reset_expiration, basestring):
-            exp = datetime.datetime.strptime(res.expiration,
-                                             '%Y-%m-%d %H:%M:%S.%f')
-        else:
-            exp = res.reset_expiration
-
-        if exp < datetime.datetime.now():
-            # expired
-            self.clear_reset_code(user_id)
+        if res is None:
             return None
-
         return res.reset
 
-    def _set_reset_code(self, user_id):
+    def _set_reset_code(self, user_id, overwrite=True):
         rc = ResetCode()
         code = rc._generate_reset_code()
-        expiration = datetime.datetime.now() + datetime.timedelta(hours=6)
+        now = datetime.datetime.now()
+        expiration = now + datetime.timedelta(hours=6)
         query = update(users).values(reset=code, reset_expiration=expiration)
-        res = safe_execute(self._engine, query.where(users.c.id == user_id))
+        where = users.c.id == user_id
+        if not overwrite:
+            # keeps a code that did not expire yet
+            where = and_(where, or_(users.c.reset_expiration == None,  # NOQA
+                                    users.c.reset_expiration <= now))
+        res = safe_execute(self._engine, query.where(where))
         if res.rowcount != 1:
+            if not overwrite:
+                # a valid code was already there
+                return self._get_reset_code(user_id)
             self.logger.debug('Unable to add a new reset code')
             return None  # XXX see if appropriate
         return code
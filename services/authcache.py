@@ -0,0 +1,231 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Cache of the successful authentications, shared by the auth pipelines.
+
+Recently authenticated credentials skip the backend, and the username
+normalization, for a few seconds. This is what ProxyCacheUser does for
+the whoami proxy, for every backend.
+
+The tradeoffs are the same:
+
+    * Authentication failures are always treated as a cache miss, so a new
+      password works right away.
+
+    * Node re-assignments are not picked up until the entry expires.
+
+Password changes and deletions are picked up right away when they go
+through a backend of this process: the backends notify USER_CHANGED, and
+the entries of the user are then invalidated. With memcached, the other
+processes pick them up within `generation_ttl` seconds. Changes made
+elsewhere are picked up when the entries expire, so the ttl sets how long
+an old password keeps working in that case.
+
+The cache is configured in the "auth_cache" section, and is disabled if
+the section is missing. Its "backend" option can name another class
+with the same get(), set() and forget() methods.
+"""
+import os
+import time
+import hmac
+import hashlib
+import simplejson as json
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+from metlog.holder import CLIENT_HOLDER
+
+from services.cache import LRUCache
+from services.events import subscribe, USER_CHANGED
+from services.pluginreg import load_and_configure
+
+
+_METLOG_PREFIX = 'services.authcache.'
+
+
+class AuthCache(object):
+    """Keeps the userid and syncNode of recently authenticated users.
+
+    The entries live in an in-process LRU and optionally in memcached,
+    under a HMAC of the username and the password, so that the cached
+    data can't be used to check a password without the secret key.
+
+    Each entry records its expiration time and the generation of its user,
+    and is only used while that generation is the current one. forget()
+    starts a new generation, and is called on USER_CHANGED. A user whose
+    generation was lost, e.g. evicted from memcached, gets a new one, so
+    entries never outlive their generation. The cached data has to hold
+    the "userid".
+
+    With memcached, the generations are kept for `generation_ttl` seconds
+    in the process, so that the entries found in the LRU are used without
+    any network call.
+    """
+    def __init__(self, size=1000, ttl=60, secret_key=None,
+                 cache_servers=None, cache_prefix='AuthCache/',
+                 generation_ttl=5):
+        if isinstance(cache_servers, str):
+            cache_servers = cache_servers.split()
+        if secret_key is None:
+            if cache_servers:
+                # a random key would make the entries useless to the
+                # other processes
+                raise ValueError("cache_servers needs a secret_key")
+            secret_key = os.urandom(32)
+        elif len(secret_key) < 32:
+            raise ValueError("secret_key should be at least 256 bit")
+        self.hmac_master = hmac.new(secret_key, "", hashlib.sha256)
+        self.ttl = int(ttl)
+        self._cache = LRUCache(int(size), self.ttl)
+        self.cache_prefix = cache_prefix
+        if cache_servers:
+            if memcache is None:
+                raise ValueError('cache_servers needs python-memcached')
+            self._memcache = memcache.Client(cache_servers)
+            self._generations = LRUCache(int(size), generation_ttl)
+        else:
+            self._memcache = None
+            # the only copy: it lives as long as the entries made with it
+            self._generations = LRUCache(int(size), self.ttl)
+        subscribe(USER_CHANGED, self.forget)
+
+    def _key(self, username, password):
+        if isinstance(username, unicode):
+            username = username.encode('utf8')
+        if isinstance(password, unicode):
+            password = password.encode('utf8')
+        hasher = self.hmac_master.copy()
+        hasher.update('%d:%s%s' % (len(username), username, password))
+        return hasher.hexdigest()
+
+    def _generation_key(self, userid):
+        return '%sgeneration/%s' % (self.cache_prefix, userid)
+
+    def _generation(self, userid, create=False):
+        """Returns the current generation of the entries of a user, or None
+        if there's none. With create, one is started if needed."""
+        key = self._generation_key(userid)
+        generation = self._generations.get(key)
+        if self._memcache is None:
+            if generation is None and create:
+                generation = os.urandom(8).encode('hex')
+            if create:
+                self._generations.set(key, generation)
+            return generation
+
+        if generation is None:
+            generation = self._memcache.get(key)
+            if generation is None and create:
+                generation = os.urandom(8).encode('hex')
+                if not self._memcache.add(key, generation):
+                    # started by another process meanwhile
+                    generation = self._memcache.get(key)
+            if generation is not None:
+                self._generations.set(key, generation)
+        return generation
+
+    def _valid(self, entry):
+        generation, expires, data = entry
+        return (expires > time.time() and
+                generation == self._generation(data['userid']))
+
+    def _incr(self, name):
+        logger = CLIENT_HOLDER.default_client
+        if logger is not None:
+            logger.incr(_METLOG_PREFIX + name)
+
+    def get(self, username, password):
+        """Returns the data cached for these credentials, or None."""
+        key = self._key(username, password)
+        entry = self._cache.get(key)
+        if entry is not None and not self._valid(entry):
+            entry = None
+        if entry is None and self._memcache is not None:
+            value = self._memcache.get(self.cache_prefix + key)
+            if value is not None:
+                entry = json.loads(value)
+                if self._valid(entry):
+                    # the entry expires when it was meant to, in both tiers
+                    self._cache.set(key, entry, entry[1] - time.time())
+                else:
+                    entry = None
+        self._incr(entry is None and 'miss' or 'hit')
+        return entry and entry[2]
+
+    def set(self, username, password, data):
+        """Caches the data of credentials that were just authenticated."""
+        generation = self._generation(data['userid'], create=True)
+        if generation is None:
+            # memcached is unreachable
+            return
+        key = self._key(username, password)
+        entry = [generation, time.time() + self.ttl, data]
+        self._cache.set(key, entry)
+        if self._memcache is not None:
+            self._memcache.set(self.cache_prefix + key, json.dumps(entry),
+                               self.ttl)
+
+    def forget(self, userid):
+        """Invalidates the entries of a user, whose password changed or
+        who was deleted."""
+        if userid is None:
+            return
+        key = self._generation_key(userid)
+        generation = os.urandom(8).encode('hex')
+        if self._memcache is not None:
+            # kept until evicted: the user then gets a new one
+            self._memcache.set(key, generation, 0)
+        self._generations.set(key, generation)
+
+
+def get_auth_cache(config):
+    """Returns the cache set up in the auth_cache section of the config,
+    or None if there's none."""
+    params = config.get_section('auth_cache')
+    if not params:
+        return None
+    params.setdefault('backend', 'services.authcache.AuthCache')
+    return load_and_configure(params)
+
+
+def checks_node(backend, config):
+    """Returns True if the users may only authenticate on their node."""
+    if hasattr(backend, 'generate_reset_code'):
+        return bool(getattr(backend, 'check_node', False))
+    return bool(config.get('auth.check_node'))
@@ -61,7 +61,9 @@ from webob.exc import (HTTPNotFound, HTTPServiceUnavailable,
                        HTTPException, HTTPMethodNotAllowed)
 
 from services.util import (CatchErrorMiddleware, round_time, BackendError,
-                           create_hash, HTTPJsonServiceUnavailable)
+                           create_hash, HTTPJsonServiceUnavailable,
+                           configure_hash_pool, configure_credential_cache,
+                           configure_scrypt)
 from services.config import Config
 from services.controllers import StandardController
 from services.events import REQUEST_STARTS, REQUEST_ENDS, APP_ENDS, notify
@@ -97,6 +99,16 @@ class SyncServerApp(object):
         # check if we want to clean when the app ends
         self.sigclean = self.config.get('global.clean_shutdown', True)
 
+        # password hashing, shared by every backend of the process
+        configure_hash_pool(self.config.get('global.hash_pool_size'),
+                            self.config.get('global.hash_max_queue'))
+        configure_credential_cache(
+                self.config.get('global.credential_cache_size'),
+                self.config.get('global.credential_cache_ttl'))
+        configure_scrypt(self.config.get('global.scrypt_n'),
+                         self.config.get('global.scrypt_r'),
+                         self.config.get('global.scrypt_p'))
+
         # load the specified plugin modules
         self.modules = dict()
         app_modules = self.config.get('app.modules', [])
@@ -42,6 +42,12 @@ import StringIO
 
 from services.formatters import html_response, text_response
 
+try:
+    from services.ldappool import get_debug_info as ldap_debug_info
+except ImportError:
+    # python-ldap is not installed
+    ldap_debug_info = None
+
 
 _DEBUG_TMPL = """
 <html>
@@ -87,7 +93,8 @@ class StandardController(object):
         environ.
 
         Application based on SyncServerApp can implement _debug_server to
-        add their own tests.
+        add their own tests. The stats of the LDAP connection pools are
+        also displayed.
 
         IMPORTANT: this page must not be published without any form of
         authentication since it can display sensitive information.
@@ -118,7 +125,10 @@ class StandardController(object):
         data = {'environ': out.read()}
 
         # extra info
-        extra = '\n'.join(self._debug_server(request))
+        extra = list(self._debug_server(request))
+        if ldap_debug_info is not None:
+            extra.extend(ldap_debug_info())
+        extra = '\n'.join(extra)
         if extra == '':
             extra = 'None.'
 
@@ -65,6 +65,10 @@ REQUEST_STARTS = 'server-core.request-starts'
 # The callable is called with the response object
 REQUEST_ENDS = 'server-core.request-ends'
 
+# called when the password of a user changes, or when a user is deleted.
+# The callable is called with the user id
+USER_CHANGED = 'server-core.user-changed'
+
 # Called when the app shuts down (SIGTERM/SIGINT)
 # the callable is called with no option
 APP_ENDS = 'server-code.app.ends'
@@ -54,6 +54,8 @@ from gunicorn.workers.ggevent import GeventWorker
 
 from metlog.holder import CLIENT_HOLDER
 
+from services.util import set_deadline
+
 # Take references to un-monkey-patched versions of stuff we need.
 # Monkey-patching will have already been done by the time we come to
 # use these functions at runtime.
@@ -82,7 +84,8 @@ class MozSvcWorker(GeventWorker):
           event-loop, and logs tracebacks if blocking code is found.
 
         * a timeout enforced on each individual request, rather than on
-          inactivity of the worker as a whole.
+          inactivity of the worker as a whole, and passed to the database
+          queries as a deadline.
 
         * a signal handler to dump memory usage data on SIGUSR2.
 
@@ -128,8 +131,15 @@ class MozSvcWorker(GeventWorker):
         # Apply the configured 'timeout' value to each individual request.
         # Note that self.timeout is set to half the configured timeout by
         # the arbiter, so we use the value directly from the config.
+        # The time left is also given to the backends as a deadline, so
+        # that a slow query gets cancelled instead of holding a pooled
+        # connection until the timeout.
         with gevent.Timeout(self.cfg.timeout):
-            return super(MozSvcWorker, self).handle_request(*args)
+            set_deadline(self.cfg.timeout)
+            try:
+                return super(MozSvcWorker, self).handle_request(*args)
+            finally:
+                set_deadline(None)
 
     def _greenlet_switch_tracer(self, what, (origin, target)):
         """Callback method executed on every greenlet switch.
@@ -40,9 +40,20 @@ import socket
 import base64
 from urlparse import urlparse, urlunparse
 
+from services.retry import RetryPolicy
+
+
+# how get_url retries the idempotent calls failing with a gateway error.
+# The time budget avoids retrying after a timeout.
+HTTP_RETRY_POLICY = RetryPolicy(max_attempts=2, base_delay=.1, time_budget=1,
+                                name='http')
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+_RETRY_STATUSES = (502, 503, 504)
+
 
 def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
-            get_body=True, extra_headers=None):
+            get_body=True, extra_headers=None,
+            retry_policy=HTTP_RETRY_POLICY):
     """Performs a synchronous url call and returns the status and body.
 
     This function is to be used to provide a gateway service.
@@ -55,6 +66,9 @@ def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
 
     Other errors are managed by the urrlib2.urllopen call.
 
+    GET, HEAD and OPTIONS calls getting a 502, 503 or 504 are retried
+    according to `retry_policy`, with a retry budget per host.
+
     Args:
         - url: url to visit
         - method: method to use
@@ -64,6 +78,7 @@ def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
         - timeout: timeout in seconds.
         - extra headers: mapping of headers to add
         - get_body: if set to False, the body is not retrieved
+        - retry_policy: a services.retry.RetryPolicy, or None
 
     Returns:
         - tuple : status code, headers, body
@@ -82,6 +97,18 @@ def get_url(url, method='GET', data=None, user=None, password=None, timeout=5,
         for name, value in extra_headers.items():
             req.add_header(name, value)
 
+    if retry_policy is None or method not in _IDEMPOTENT_METHODS:
+        return _open(req, timeout, get_body)
+
+    for attempt in retry_policy.attempts(urlparse(url).netloc):
+        status, headers, body = _open(req, timeout, get_body)
+        if status not in _RETRY_STATUSES:
+            break
+    return status, headers, body
+
+
+def _open(req, timeout, get_body):
+    """Opens the request, returns the status, headers and body."""
     try:
         res = urllib2.urlopen(req, timeout=timeout)
     except urllib2.HTTPError, e:
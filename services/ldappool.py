@@ -36,15 +36,69 @@
 """ LDAP Connection Pool.
 """
 import time
+import select
+from bisect import bisect_left
+from collections import OrderedDict, deque
 from contextlib import contextmanager
-from threading import RLock
+from threading import RLock, Event, Thread
+from weakref import WeakSet
+
+try:
+    from gevent.monkey import is_module_patched
+    from gevent.event import Event as GeventEvent
+except ImportError:
+    is_module_patched = None
 
 from ldap.ldapobject import ReconnectLDAPObject
 import ldap
+
+from metlog.holder import CLIENT_HOLDER
+from services.retry import RetryPolicy
 from services.exceptions import (BackendError, BackendTimeoutError,
                                  MaxConnectionReachedError)
 
 
+_METLOG_PREFIX = 'services.ldappool.'
+
+# How the LDAP backends check user passwords:
+# - pool: binds as the user on a connector from the shared pool
+# - bind: binds as the user on a small, dedicated set of connectors
+# - compare: does an LDAP compare on userPassword, with the admin pool
+AUTH_MODES = ('pool', 'bind', 'compare')
+
+# python-ldap synchronous calls that are timed, by operation type.
+# binds are timed by the ConnectionManager, for all connector classes.
+# ReconnectLDAPObject sends compare_s through compare_ext_s
+_TIMED_CALLS = {'search_ext_s': 'search',
+                'modify_ext_s': 'modify',
+                'add_ext_s': 'add',
+                'delete_ext_s': 'delete',
+                'compare_ext_s': 'compare'}
+
+# every ConnectionManager created, for the debug page
+_MANAGERS = WeakSet()
+
+
+def _make_event():
+    """Returns an Event suited to the current concurrency model.
+
+    When the threading module was monkey-patched by gevent, a native gevent
+    Event is used since it wakes up waiters right away, instead of polling.
+    """
+    if is_module_patched is not None and is_module_patched('threading'):
+        return GeventEvent()
+    return Event()
+
+
+class _Waiter(object):
+    """A caller waiting for a connector to be released."""
+    def __init__(self):
+        self.event = _make_event()
+        # set when a connector, or a free slot, was handed over
+        self.handed = False
+        self.conn = None
+
+
 class StateConnector(ReconnectLDAPObject):
     """Just remembers who is connected, and if connected"""
     def __init__(self, *args, **kw):
@@ -53,6 +107,7 @@ class StateConnector(ReconnectLDAPObject):
         self.who = ''
         self.cred = ''
         self._connection_time = None
+        self.stats = None
 
     def get_lifetime(self):
         """Returns the lifetime of the connection on the server in seconds."""
@@ -95,6 +150,18 @@ class StateConnector(ReconnectLDAPObject):
             self.who = None
             self.cred = None
 
+    def _apply_method_s(self, func, *args, **kwargs):
+        op = _TIMED_CALLS.get(func.__name__)
+        if op is None or self.stats is None:
+            return ReconnectLDAPObject._apply_method_s(self, func, *args,
+                                                       **kwargs)
+        start = time.time()
+        try:
+            return ReconnectLDAPObject._apply_method_s(self, func, *args,
+                                                       **kwargs)
+        finally:
+            self.stats.observe(op, time.time() - start)
+
     def add_s(self, *args, **kwargs):
         return self._apply_method_s(ReconnectLDAPObject.add_s, *args,
                                     **kwargs)
@@ -104,72 +171,615 @@ class StateConnector(ReconnectLDAPObject):
                                     **kwargs)
 
 
+class _PendingResult(object):
+    """An asynchronous LDAP operation waiting for its result."""
+    def __init__(self, op):
+        self.event = _make_event()
+        self.result = None
+        self.error = None
+        self.op = op
+        self.start = time.time()
+
+
+class AsyncConnector(object):
+    """Shares one bound connector between concurrent callers.
+
+    Operations are sent with the asynchronous python-ldap APIs, so several
+    of them can be in flight on the same connection. A reader thread (a
+    greenlet under gevent) polls the results of the pending operations by
+    msgid, and hands each one to the caller waiting for it.
+
+    The blocking-style methods mirror the ones of StateConnector, so the
+    backends can use either kind of connector.
+    """
+    def __init__(self, conn, poll_interval=.05):
+        self.conn = conn
+        self.poll_interval = poll_interval
+        self._pending = {}
+        self._lock = RLock()
+        self._reader = None
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __str__(self):
+        return 'Async ' + str(self.conn)
+
+    def close(self, timeout=None):
+        """Waits up to timeout seconds for the pending operations, then
+        unbinds the connector."""
+        with self._lock:
+            reader = self._reader
+        if reader is not None:
+            reader.join(timeout)
+        try:
+            self.conn.unbind_ext_s()
+        except ldap.LDAPError:
+            # avoid error on invalid state
+            pass
+
+    def _send(self, op, method, *args):
+        """Sends an operation, and registers it for the reader."""
+        with self._lock:
+            msgid = method(*args)
+            pending = self._pending[msgid] = _PendingResult(op)
+            if self._reader is None:
+                self._reader = Thread(target=self._read)
+                self._reader.daemon = True
+                self._reader.start()
+        return msgid, pending
+
+    def _wait(self, msgid, pending, timeout=-1):
+        """Waits for the result of an operation."""
+        if timeout is None or timeout < 0:
+            timeout = None
+        try:
+            return self._get_result(msgid, pending, timeout)
+        finally:
+            if self.stats is not None:
+                self.stats.observe(pending.op, time.time() - pending.start)
+
+    def _get_result(self, msgid, pending, timeout):
+        if not pending.event.wait(timeout):
+            with self._lock:
+                self._pending.pop(msgid, None)
+            try:
+                self.conn.abandon_ext(msgid)
+            except ldap.LDAPError:
+                pass
+            raise ldap.TIMEOUT({'desc': 'Timed out'})
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _read(self):
+        """Dispatches results until no operation is pending."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._reader = None
+                    return
+                msgids = list(self._pending)
+
+            delivered = False
+            for msgid in msgids:
+                try:
+                    result = self.conn.result3(msgid, 1, 0)
+                except ldap.LDAPError, exc:
+                    # COMPARE_TRUE and COMPARE_FALSE also end up here
+                    if isinstance(exc, ldap.SERVER_DOWN):
+                        self.conn.connected = False
+                    self._deliver(msgid, error=exc)
+                else:
+                    if result[0] is None:
+                        # not there yet
+                        continue
+                    self._deliver(msgid, result=result)
+                delivered = True
+
+            if not delivered:
+                # nothing buffered - let's wait for the server
+                try:
+                    fd = self.conn.get_option(ldap.OPT_DESC)
+                    select.select([fd], [], [], self.poll_interval)
+                except (select.error, ldap.LDAPError, TypeError, ValueError):
+                    time.sleep(self.poll_interval)
+
+    def _deliver(self, msgid, result=None, error=None):
+        with self._lock:
+            pending = self._pending.pop(msgid, None)
+        if pending is None:
+            # abandoned
+            return
+        pending.result = result
+        pending.error = error
+        pending.event.set()
+
+    def search_st(self, base, scope, filterstr='(objectClass=*)',
+                  attrlist=None, attrsonly=0, timeout=-1):
+        msgid, pending = self._send('search', self.conn.search_ext, base,
+                                    scope, filterstr, attrlist, attrsonly)
+        return self._wait(msgid, pending, timeout)[1]
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, attrsonly=0):
+        return self.search_st(base, scope, filterstr, attrlist, attrsonly,
+                              self.conn.timeout)
+
+    def add_s(self, dn, modlist):
+        msgid, pending = self._send('add', self.conn.add_ext, dn, modlist)
+        return self._wait(msgid, pending, self.conn.timeout)[:2]
+
+    def modify_s(self, dn, modlist):
+        msgid, pending = self._send('modify', self.conn.modify_ext, dn,
+                                    modlist)
+        return self._wait(msgid, pending, self.conn.timeout)[:2]
+
+    def delete_s(self, dn):
+        msgid, pending = self._send('delete', self.conn.delete_ext, dn)
+        return self._wait(msgid, pending, self.conn.timeout)[:2]
+
+    def compare_s(self, dn, attr, value):
+        msgid, pending = self._send('compare', self.conn.compare_ext, dn,
+                                    attr, value)
+        try:
+            self._wait(msgid, pending, self.conn.timeout)
+        except ldap.COMPARE_TRUE:
+            return 1
+        except ldap.COMPARE_FALSE:
+            return 0
+        return None
+
+
+class _Histogram(object):
+    """Latency distribution of an operation, in milliseconds."""
+
+    # upper bounds of the buckets - the last one has no bound
+    BOUNDS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.buckets[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, ratio):
+        """Returns the upper bound of the bucket holding that percentile."""
+        rank = ratio * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                break
+        if index < len(self.BOUNDS):
+            return self.BOUNDS[index]
+        return self.max
+
+    def __str__(self):
+        if self.count == 0:
+            return 'count=0'
+        return ('count=%d avg=%.1fms p50<=%sms p99<=%sms max=%.1fms' %
+                (self.count, self.total / self.count, self.percentile(.5),
+                 self.percentile(.99), self.max))
+
+
+class PoolStats(object):
+    """Counters and latency histograms of a ConnectionManager.
+
+    Everything is also sent to metlog as it happens.
+    """
+    COUNTERS = ('created', 'rebinds', 'expired', 'discarded', 'max_reached')
+
+    def __init__(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.latency = {}
+        self._lock = RLock()
+        self.logger = CLIENT_HOLDER.default_client
+
+    def incr(self, name):
+        with self._lock:
+            self.counters[name] += 1
+        if self.logger is not None:
+            self.logger.incr(_METLOG_PREFIX + name)
+
+    def observe(self, op, duration):
+        """Records how long an operation took, in seconds."""
+        duration *= 1000
+        with self._lock:
+            histogram = self.latency.get(op)
+            if histogram is None:
+                histogram = self.latency[op] = _Histogram()
+            histogram.add(duration)
+        if self.logger is not None:
+            self.logger.timer_send(_METLOG_PREFIX + op, duration)
+
+
+# errors caused by the caller, rather than by the server
+_LOGIC_ERRORS = (ldap.NO_SUCH_OBJECT, ldap.INVALID_CREDENTIALS,
+                 ldap.INVALID_DN_SYNTAX)
+
+# errors telling that a server is unreachable or unresponsive
+_SERVER_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR,
+                  ldap.UNAVAILABLE, ldap.BUSY)
+
+# How a server is picked when several LDAP URIs are configured:
+# - round_robin: each server in turn
+# - least_outstanding: the server with the fewest checked out connectors
+# - ewma: the server with the lowest decaying average latency, weighted
+#   by its checked out connectors
+SERVER_POLICIES = ('round_robin', 'least_outstanding', 'ewma')
+
+
+def backend_error(exc, msg=None):
+    """Returns the BackendError to raise for an LDAP error met while using
+    a connector of the pool.
+
+    The LDAP error is kept as the cause of the BackendError, so that the
+    pool can tell when the server is at fault.
+    """
+    if msg is None:
+        msg = str(exc)
+    error = BackendError(msg)
+    error.cause = exc
+    return error
+
+
+def _split_uris(uri):
+    """Returns a list of URIs, from a list or a space/comma separated
+    string."""
+    if isinstance(uri, basestring):
+        uri = uri.replace(',', ' ').split()
+    return [item.strip() for item in uri if item.strip()]
+
+
+class _Server(object):
+    """Health and load of one LDAP server."""
+    def __init__(self, uri):
+        self.uri = uri
+        self.outstanding = 0
+        self.latency = 0.
+        self.failures = 0
+        self.ejected_until = 0
+
+    def __str__(self):
+        return self.uri
+
+
+class ServerSet(object):
+    """Picks an LDAP server among several, and tracks their health.
+
+    After failure_threshold consecutive failures, a server is ejected for
+    cooldown seconds. When all servers are ejected, the one that comes
+    back first is used anyway.
+
+    Args:
+        - uris: a list of LDAP URIs
+        - policy: one of SERVER_POLICIES
+        - failure_threshold: consecutive failures before ejecting a server
+        - cooldown: how long an ejected server is left alone, in seconds
+        - decay: weight of the last sample in the latency average
+    """
+    def __init__(self, uris, policy='round_robin', failure_threshold=3,
+                 cooldown=30, decay=.3):
+        if policy not in SERVER_POLICIES:
+            raise ValueError('Unknown server policy %r' % policy)
+        # an empty URI lets the LDAP library use its defaults
+        uris = _split_uris(uris) or ['']
+        self.servers = [_Server(uri) for uri in uris]
+        self.policy = policy
+        self.failure_threshold = int(failure_threshold)
+        self.cooldown = float(cooldown)
+        self.decay = float(decay)
+        self._next = 0
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self.servers)
+
+    def available(self, server):
+        """Returns True if the server is not ejected."""
+        return server.ejected_until <= time.time()
+
+    def pick(self, exclude=()):
+        """Returns the server to use for a new connector.
+
+        Servers in exclude are only picked if there's nothing else.
+        """
+        with self._lock:
+            candidates = [server for server in self.servers
+                          if server not in exclude and self.available(server)]
+            if not candidates:
+                candidates = [server for server in self.servers
+                              if server not in exclude] or self.servers
+                # everything is down, let's try the first one back
+                return min(candidates, key=lambda s: s.ejected_until)
+
+            if len(candidates) == 1:
+                return candidates[0]
+
+            if self.policy == 'least_outstanding':
+                return min(candidates, key=lambda s: s.outstanding)
+            elif self.policy == 'ewma':
+                return min(candidates,
+                           key=lambda s: s.latency * (s.outstanding + 1))
+
+            server = candidates[self._next % len(candidates)]
+            self._next += 1
+            return server
+
+    def checkout(self, server):
+        with self._lock:
+            server.outstanding += 1
+
+    def release(self, server):
+        with self._lock:
+            server.outstanding -= 1
+
+    def success(self, server, duration=None):
+        """Records a successful call to the server."""
+        with self._lock:
+            server.failures = 0
+            server.ejected_until = 0
+            if duration is not None:
+                server.latency += self.decay * (duration - server.latency)
+
+    def failure(self, server):
+        """Records a failed call, and ejects the server if needed."""
+        with self._lock:
+            server.failures += 1
+            if server.failures >= self.failure_threshold:
+                server.ejected_until = time.time() + self.cooldown
+
+
 class ConnectionManager(object):
     """LDAP Connection Manager.
 
     Provides a context manager for LDAP connectors.
+
+    Idle connectors are indexed by their (bind, password) pair, and also
+    kept in a global least-recently-used list, so that checking out,
+    releasing and evicting a connector never has to scan the whole pool.
+
+    When the pool is full, callers wait in a FIFO queue for at most
+    `checkout_timeout` seconds. A released connector is handed directly
+    to the longest-waiting caller. If `max_waiters` is set, callers that
+    would make the queue grow beyond it fail right away.
+
+    If `maintenance_interval` is set, a background thread (a greenlet
+    under gevent) runs maintain() at that interval, so that connect and
+    bind costs are paid outside of the request path.
+
+    If `use_async` is set, callers asking for the default bind share a
+    single AsyncConnector instead of checking out a connector each. It
+    takes a slot of the pool, and is replaced after max_lifetime too.
+
+    `uri` can be a list of servers (or a space separated string). New
+    connectors go to the server picked by `server_policy`, and servers
+    that keep failing are ejected for `failure_cooldown` seconds. If
+    `master_uri` is set, connections asked with write=True are taken from
+    a second pool, connected to that server.
+
+    Failed connections are retried following `retry_policy`, by default
+    retry_max attempts with an exponential backoff from retry_delay.
+
+    The pool occupancy is sent to metlog at most every `stats_interval`
+    seconds, from a checkout or from the maintenance thread.
     """
     def __init__(self, uri, bind=None, passwd=None, size=10, retry_max=3,
                  retry_delay=.1, use_tls=False, single_box=False, timeout=-1,
                  connector_cls=StateConnector, use_pool=False,
-                 max_lifetime=600, **kw):
-        self._pool = []
+                 max_lifetime=600, checkout_timeout=None, max_waiters=None,
+                 min_idle=0, maintenance_interval=0, lifetime_margin=None,
+                 use_async=False, server_policy='round_robin',
+                 failure_threshold=3, failure_cooldown=30, master_uri=None,
+                 retry_policy=None, stats_interval=10, **kw):
+        # every connector owned by the pool, active or not
+        self._pool = set()
+        # idle connectors, per (bind, passwd) - most recently used last
+        self._idle = {}
+        # idle connectors, across all binds - least recently used first
+        self._lru = OrderedDict()
+        # callers waiting for a connector - longest waiting first
+        self._waiters = deque()
+        # slots reserved for connectors being created
+        self._creating = 0
         self.size = size
         self.retry_max = retry_max
         self.retry_delay = retry_delay
-        self.uri = uri
+        if retry_policy is None:
+            retry_policy = RetryPolicy(max_attempts=retry_max,
+                                       base_delay=retry_delay, name='ldap')
+        self.retry_policy = retry_policy
+        self.servers = ServerSet(uri, server_policy, failure_threshold,
+                                 failure_cooldown)
+        self.uri = ' '.join(server.uri for server in self.servers.servers)
         self.bind = bind
         self.passwd = passwd
         self._pool_lock = RLock()
+        self.stats_interval = float(stats_interval)
+        self._next_report = 0
         self.use_tls = False
         self.timeout = timeout
         self.connector_cls = connector_cls
         self.use_pool = use_pool
         self.max_lifetime = max_lifetime
+        if checkout_timeout is None:
+            checkout_timeout = retry_max * retry_delay
+        self.checkout_timeout = float(checkout_timeout)
+        if max_waiters is not None:
+            max_waiters = int(max_waiters)
+        self.max_waiters = max_waiters
+        self.min_idle = int(min_idle)
+        self.maintenance_interval = float(maintenance_interval)
+        if lifetime_margin is None:
+            lifetime_margin = self.maintenance_interval
+        self.lifetime_margin = float(lifetime_margin)
+        self.use_async = use_async
+        self._async = None
+        self._async_creating = 0
+        self.logger = CLIENT_HOLDER.default_client
+        self.stats = PoolStats()
+        _MANAGERS.add(self)
+        self._maintenance = None
+        if master_uri is not None:
+            self._master = ConnectionManager(master_uri, bind, passwd,
+                    size=size, retry_max=retry_max, retry_delay=retry_delay,
+                    use_tls=use_tls, timeout=timeout,
+                    connector_cls=connector_cls, use_pool=use_pool,
+                    max_lifetime=max_lifetime,
+                    checkout_timeout=checkout_timeout,
+                    max_waiters=max_waiters,
+                    failure_threshold=failure_threshold,
+                    failure_cooldown=failure_cooldown,
+                    retry_policy=retry_policy)
+        else:
+            self._master = None
+        if self.use_pool and self.maintenance_interval > 0:
+            self.start_maintenance()
 
     def __len__(self):
         return len(self._pool)
 
-    def _match(self, bind, passwd):
+    def _key(self, bind, passwd):
         if isinstance(passwd, unicode):
             passwd = passwd.encode('utf8')
+        return bind or '', passwd or ''
+
+    @contextmanager
+    def _locked(self):
+        """Acquires the pool lock, and yields how long it took."""
+        start = time.time()
         with self._pool_lock:
-            inactives = []
+            yield time.time() - start
 
-            for conn in reversed(self._pool):
-                # already in usage
-                if conn.active:
-                    continue
+    def _report_stats(self, lock_wait=None):
+        """Sends the pool occupancy, and a lock wait time sample, to metlog.
+
+        This is done at most once per stats_interval seconds, so that the
+        checkouts don't send metrics each.
+        """
+        now = time.time()
+        if self.logger is None or now < self._next_report:
+            return
+        self._next_report = now + self.stats_interval
+        with self._locked():
+            size, idle = len(self._pool), len(self._lru)
+            waiters = len(self._waiters)
+        self._gauge('size', size)
+        self._gauge('idle', idle)
+        self._gauge('active', size - idle)
+        self._gauge('waiters', waiters)
+        if lock_wait is not None:
+            self.logger.timer_send(_METLOG_PREFIX + 'lock_wait',
+                                   lock_wait * 1000)
+
+    def _gauge(self, name, value):
+        self.logger.metlog('gauge', payload=str(value),
+                           fields={'name': _METLOG_PREFIX + name})
+
+    def _push_idle(self, conn):
+        """Marks a connector as idle, and indexes it. Lock must be held."""
+        conn.active = False
+        key = self._key(conn.who, conn.cred)
+        idle = self._idle.get(key)
+        if idle is None:
+            idle = self._idle[key] = OrderedDict()
+        idle[conn] = None
+        self._lru[conn] = key
+
+    def _pop_idle(self, conn):
+        """Removes a connector from the idle indexes. Lock must be held."""
+        key = self._lru.pop(conn)
+        idle = self._idle[key]
+        del idle[conn]
+        if not idle:
+            del self._idle[key]
 
-                # let's check the lifetime
-                if conn.get_lifetime() > self.max_lifetime:
-                    # this connector has lived for too long,
-                    # we want to unbind it and remove it from the pool
-                    try:
-                        conn.unbind_s()
-                    except Exception:
-                        pass  # XXX we will see later
+    def _discard(self, conn):
+        """Removes a connector from the pool. Lock must be held.
 
-                    self._pool.remove(conn)
+        If callers are waiting, the freed slot is handed to the first one.
+        """
+        if conn in self._pool:
+            self._pool.remove(conn)
+            self._handoff(None)
+
+    def _handoff(self, conn):
+        """Hands a connector to the longest-waiting caller, if any.
+
+        If conn is None, a slot is reserved for the caller to create
+        its own connector. Lock must be held.
+
+        Returns True if a caller was waiting.
+        """
+        if not self._waiters:
+            return False
+        waiter = self._waiters.popleft()
+        if conn is None:
+            self._creating += 1
+        waiter.conn = conn
+        waiter.handed = True
+        waiter.event.set()
+        return True
+
+    def _drop(self, conn):
+        """Removes a connector from the pool, and unbinds it."""
+        self._discard(conn)
+        try:
+            conn.unbind_s()
+        except Exception:
+            pass  # XXX we will see later
+
+    def _expired(self, conn):
+        return (conn.get_lifetime() > self.max_lifetime or
+                not self.servers.available(conn.server))
+
+    def _match(self, bind, passwd):
+        key = self._key(bind, passwd)
+        with self._locked():
+            # first, the most recently used connector for this bind
+            idle = self._idle.get(key)
+            while idle:
+                conn, __ = idle.popitem()
+                del self._lru[conn]
+                if not idle:
+                    del self._idle[key]
+                    idle = None
+
+                # this connector has lived for too long,
+                # we want to unbind it and remove it from the pool
+                if self._expired(conn):
+                    self.stats.incr('expired')
+                    self._drop(conn)
                     continue
 
-                # we found a connector for this bind
-                if conn.who == bind and conn.cred == passwd:
-                    conn.active = True
-                    return conn
+                conn.active = True
+                return conn
 
-                inactives.append(conn)
+            # no connector was available, let's rebind the least recently
+            # used inactive one
+            while self._lru:
+                conn = next(iter(self._lru))
+                self._pop_idle(conn)
 
-            # no connector was available, let's rebind the latest inactive one
-            if len(inactives) > 0:
-                for conn in inactives:
-                    try:
-                        self._bind(conn, bind, passwd)
-                        return conn
-                    except Exception:
-                        self._pool.remove(conn)
+                if self._expired(conn):
+                    self.stats.incr('expired')
+                    self._drop(conn)
+                    continue
 
-                return None
+                try:
+                    self._bind(conn, bind, passwd)
+                    self.stats.incr('rebinds')
+                    return conn
+                except Exception:
+                    self.stats.incr('discarded')
+                    self._discard(conn)
 
         # There are no connector that match
         return None
@@ -180,7 +790,11 @@ class ConnectionManager(object):
             conn.start_tls_s()
 
         if bind is not None:
-            conn.simple_bind_s(bind, passwd)
+            start = time.time()
+            try:
+                conn.simple_bind_s(bind, passwd)
+            finally:
+                self.stats.observe('bind', time.time() - start)
 
         conn.active = True
 
@@ -191,29 +805,39 @@ class ConnectionManager(object):
             - bind: login
             - passwd: password
         """
-        tries = 0
         connected = False
         exc = None
         if isinstance(passwd, unicode):
             passwd = passwd.encode('utf8')
 
-        # trying retry_max times in a row with a fresh connector
-        while tries < self.retry_max and not connected:
+        # trying with a fresh connector, as long as the retry policy allows
+        # it, and moving to another server after each failure
+        failed = []
+        for attempt in self.retry_policy.attempts(self):
+            server = self.servers.pick(exclude=failed)
             try:
-                conn = self.connector_cls(self.uri, retry_max=self.retry_max,
+                conn = self.connector_cls(server.uri,
+                                          retry_max=self.retry_max,
                                           retry_delay=self.retry_delay)
                 conn.timeout = self.timeout
+                conn.server = server
+                conn.stats = self.stats
                 self._bind(conn, bind, passwd)
                 connected = True
+                self.stats.incr('created')
+                self.servers.success(server)
+                break
             except ldap.LDAPError, exc:
-                time.sleep(self.retry_delay)
-                tries += 1
+                if isinstance(exc, _LOGIC_ERRORS):
+                    # retrying won't help
+                    break
+                if isinstance(exc, _SERVER_ERRORS):
+                    self.servers.failure(server)
+                    failed.append(server)
 
         if not connected:
             # pass through logic errors directly.
-            if isinstance(exc, (ldap.NO_SUCH_OBJECT,
-                                ldap.INVALID_CREDENTIALS,
-                                ldap.INVALID_DN_SYNTAX)):
+            if isinstance(exc, _LOGIC_ERRORS):
                 raise exc
 
             # operational errors become a BackendError.
@@ -230,38 +854,99 @@ class ConnectionManager(object):
         if passwd is None:
             passwd = self.passwd
 
-        if self.use_pool:
+        if not self.use_pool:
+            # with no pool, the connector is always active
+            conn = self._create_connector(bind, passwd)
+            conn.active = True
+            return conn
+
+        waiter = None
+        with self._locked() as lock_wait:
+            self._report_stats(lock_wait)
             # let's try to recycle an existing one
             conn = self._match(bind, passwd)
             if conn is not None:
                 return conn
 
-            # the pool is full
-            if len(self._pool) >= self.size:
+            if len(self._pool) + self._creating < self.size:
+                # there's room for a new connector, let's book it
+                self._creating += 1
+            elif (self.max_waiters is not None and
+                  len(self._waiters) >= self.max_waiters):
+                # the pool is full, and so is the wait queue
+                self.stats.incr('max_reached')
                 raise MaxConnectionReachedError(self.uri)
+            else:
+                # the pool is full, let's wait in line
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+
+        if waiter is not None:
+            conn = self._wait(waiter)
+            if conn is not None:
+                if self._key(conn.who, conn.cred) == self._key(bind, passwd):
+                    return conn
+                try:
+                    self._bind(conn, bind, passwd)
+                    self.stats.incr('rebinds')
+                    return conn
+                except Exception:
+                    # we keep the slot, and try with a fresh connector
+                    self.stats.incr('discarded')
+                    with self._locked():
+                        self._pool.discard(conn)
+                        self._creating += 1
+            # else we were handed a free slot
 
         # we need to create a new connector
-        conn = self._create_connector(bind, passwd)
+        try:
+            conn = self._create_connector(bind, passwd)
+        except Exception:
+            with self._locked():
+                self._creating -= 1
+                self._handoff(None)
+            raise
 
         # adding it to the pool
-        if self.use_pool:
-            with self._pool_lock:
-                self._pool.append(conn)
-        else:
-            # with no pool, the connector is always active
-            conn.active = True
-
+        with self._locked():
+            self._creating -= 1
+            self._pool.add(conn)
         return conn
 
+    def _wait(self, waiter):
+        """Waits until a connector or a slot is handed to the waiter.
+
+        Returns the connector, or None if a slot was handed over.
+        Raises a MaxConnectionReachedError on timeout.
+        """
+        start = time.time()
+        waiter.event.wait(self.checkout_timeout)
+        with self._locked():
+            if not waiter.handed:
+                # nothing came in time
+                self._waiters.remove(waiter)
+                self.stats.incr('max_reached')
+                raise MaxConnectionReachedError(self.uri)
+        if self.logger is not None:
+            self.logger.timer_send(_METLOG_PREFIX + 'checkout_wait',
+                                   (time.time() - start) * 1000)
+        return waiter.conn
+
     def _release_connection(self, connection):
         if self.use_pool:
-            with self._pool_lock:
+            with self._locked():
                 if not connection.connected:
                     # unconnected connector, let's drop it
-                    self._pool.remove(connection)
-                else:
-                    # can be reused - let's mark is as not active
-                    connection.active = False
+                    self.stats.incr('discarded')
+                    self._discard(connection)
+                elif getattr(connection, 'purged', False):
+                    # purged while in use
+                    self._discard(connection)
+                elif connection in self._pool:
+                    # can be reused - let's hand it to the next caller
+                    # in line, or mark is as not active
+                    if not self._handoff(connection):
+                        self._push_idle(connection)
 
                     # done.
                     return
@@ -276,66 +961,266 @@ class ConnectionManager(object):
             pass
 
     @contextmanager
-    def connection(self, bind=None, passwd=None):
+    def connection(self, bind=None, passwd=None, write=False):
         """Creates a context'ed connector, binds it, and returns it
 
+        If the pool is full, waits up to checkout_timeout seconds for a
+        connector to be released, then raises MaxConnectionReachedError.
+
         Args:
             - bind: login
             - passwd: password
+            - write: if True, the connector is for add/modify/delete
+              calls and goes to the master server, if any.
         """
+        if write and self._master is not None:
+            with self._master.connection(bind, passwd) as conn:
+                yield conn
+            return
 
-        tries = 0
-        conn = None
-        while tries < self.retry_max:
-            try:
-                conn = self._get_connection(bind, passwd)
-            except MaxConnectionReachedError:
-                tries += 1
-                time.sleep(0.1)
-
-                # removing the first inactive connector going backward
-                with self._pool_lock:
-                    reversed_list = reversed(list(enumerate(self._pool)))
-                    for index, conn_ in reversed_list:
-                        if not conn_.active:
-                            self._pool.pop(index)
-                            break
-            else:
-                break
-
-        if conn is None:
-            raise MaxConnectionReachedError(self.uri)
+        shared = self.use_async and bind is None and passwd is None
+        if shared:
+            # the shared connector is never released
+            conn = self._get_async_connector()
+        else:
+            conn = self._get_connection(bind, passwd)
 
+        server = conn.server
+        self.servers.checkout(server)
+        start = time.time()
         try:
             yield conn
+        except _SERVER_ERRORS:
+            conn.connected = False
+            self.servers.failure(server)
+            raise
+        except BackendError, exc:
+            # the backends wrap the LDAP errors - see backend_error()
+            if isinstance(getattr(exc, 'cause', None), _SERVER_ERRORS):
+                conn.connected = False
+                self.servers.failure(server)
+            raise
+        except ldap.LDAPError:
+            # the server did answer
+            self.servers.success(server, time.time() - start)
+            raise
+        else:
+            self.servers.success(server, time.time() - start)
         finally:
-            self._release_connection(conn)
+            self.servers.release(server)
+            if not shared:
+                self._release_connection(conn)
+
+    def _get_async_connector(self):
+        """Returns the shared AsyncConnector, bound with the default bind.
+
+        The shared connector takes a slot of the pool. A new one is created
+        if the previous one lost its connection or expired, and the old one
+        is closed in the background once its pending operations are done.
+        """
+        with self._locked():
+            current = self._async
+            if (current is not None and current.connected and
+                (self._async_creating or not self._expired(current))):
+                # an expiring connector is fine while the next one is built
+                return current
+            self._async_creating += 1
+
+        try:
+            conn = AsyncConnector(self._create_connector(self.bind,
+                                                         self.passwd))
+        finally:
+            with self._locked():
+                self._async_creating -= 1
+
+        with self._locked():
+            if self._async is current:
+                # the new connector takes the slot of the old one
+                self._pool.discard(current)
+                self._pool.add(conn)
+                self._async, old = conn, current
+            else:
+                # another caller replaced it meanwhile
+                old = conn
+            conn = self._async
+
+        if old is not None:
+            if old is current:
+                self.stats.incr(old.connected and 'expired' or 'discarded')
+            self._close_async(old)
+        return conn
+
+    def _close_async(self, conn):
+        """Closes an AsyncConnector that is not shared anymore."""
+        timeout = self.timeout
+        if timeout is None or timeout < 0:
+            timeout = None
+        closer = Thread(target=conn.close, args=(timeout,))
+        closer.daemon = True
+        closer.start()
+
+    def get_stats(self):
+        """Returns the pool occupancy, counters and latency histograms."""
+        with self._locked():
+            idle = len(self._lru)
+            stats = {'size': len(self._pool), 'idle': idle,
+                     'active': len(self._pool) - idle,
+                     'waiters': len(self._waiters)}
+        with self.stats._lock:
+            stats.update(self.stats.counters)
+            stats['latency'] = dict((op, str(histogram)) for op, histogram
+                                    in self.stats.latency.items())
+        return stats
 
     def purge(self, bind, passwd=None):
         """Purge a connector
 
+        The idle connectors of the bind are unbound right away. The ones
+        in use are dropped when they are released, and the shared
+        connector is left alone.
+
         Args:
             - bind: login
             - passwd: password
         """
+        if self._master is not None:
+            self._master.purge(bind, passwd)
 
-        if self.use_pool:
+        if not self.use_pool:
             return
 
         if passwd is not None:
             passwd = passwd.encode('utf8')
 
-        with self._pool_lock:
+        with self._locked():
             for conn in list(self._pool):
-                if conn.who != bind:
+                if conn is self._async or conn.who != bind:
                     continue
 
                 if passwd is not None and conn.cred == passwd:
                     continue
+
+                if conn not in self._lru:
+                    # in use: dropped by _release_connection
+                    conn.purged = True
+                    continue
+
                 # let's drop it
                 try:
                     conn.unbind_ext_s()
                 except ldap.LDAPError:
                     # invalid state
                     pass
-                self._pool.remove(conn)
+                self._pop_idle(conn)
+                self._discard(conn)
+
+    #
+    # Background maintenance
+    #
+    def start_maintenance(self):
+        """Starts the background maintenance thread."""
+        if self._maintenance is not None:
+            return
+        self._stopped = _make_event()
+        self._maintenance = Thread(target=self._maintenance_loop)
+        self._maintenance.daemon = True
+        self._maintenance.start()
+
+    def stop_maintenance(self):
+        """Stops the background maintenance thread."""
+        if self._maintenance is None:
+            return
+        self._stopped.set()
+        self._maintenance.join()
+        self._maintenance = None
+
+    def _maintenance_loop(self):
+        while not self._stopped.wait(self.maintenance_interval):
+            try:
+                self.maintain()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception('LDAP pool maintenance failed')
+
+    def _probe(self, conn):
+        """Checks that an idle connector still works."""
+        conn.whoami_s()
+
+    def maintain(self):
+        """Performs one maintenance pass on the idle connectors.
+
+        - connectors that are close to max_lifetime, or connected to an
+          ejected server, are unbound and removed, so that requests don't
+          hit the expiry
+        - the other idle connectors are probed, and removed on failure
+        - connectors bound with the default bind are created until there
+          are min_idle of them, or the pool is full
+        """
+        limit = self.max_lifetime - self.lifetime_margin
+        with self._locked():
+            idle = list(self._lru)
+
+        # connectors are checked out one at a time, so that requests
+        # can still use the rest of the pool meanwhile
+        for conn in idle:
+            with self._locked():
+                if conn not in self._lru:
+                    # it was checked out in the meantime
+                    continue
+                self._pop_idle(conn)
+                conn.active = True
+                if conn.get_lifetime() > limit:
+                    self.stats.incr('expired')
+                    conn.connected = False
+                elif not self.servers.available(conn.server):
+                    conn.connected = False
+
+            if conn.connected:
+                try:
+                    self._probe(conn)
+                except ldap.LDAPError:
+                    conn.connected = False
+
+            # dead or expiring connectors get dropped here
+            self._release_connection(conn)
+
+        self._prewarm()
+        self._report_stats()
+
+    def _prewarm(self):
+        """Creates idle connectors for the default bind, up to min_idle."""
+        key = self._key(self.bind, self.passwd)
+        while True:
+            with self._locked():
+                idle = len(self._idle.get(key, ()))
+                if (idle >= self.min_idle or self._waiters or
+                    len(self._pool) + self._creating >= self.size):
+                    return
+                self._creating += 1
+
+            try:
+                conn = self._create_connector(self.bind, self.passwd)
+            except Exception:
+                with self._locked():
+                    self._creating -= 1
+                    self._handoff(None)
+                raise
+
+            with self._locked():
+                self._creating -= 1
+                self._pool.add(conn)
+            self._release_connection(conn)
+
+
+def get_debug_info():
+    """Returns the stats of every LDAP pool, as lines of text."""
+    lines = []
+    for manager in list(_MANAGERS):
+        stats = manager.get_stats()
+        latency = stats.pop('latency')
+        lines.append('LDAP pool %s' % manager.uri)
+        lines.append('  ' + ' '.join('%s=%s' % (name, stats[name])
+                                     for name in sorted(stats)))
+        for op in sorted(latency):
+            lines.append('  %s: %s' % (op, latency[op]))
+    return lines
@@ -39,7 +39,7 @@
 import re
 import string
 
-from services.util import randchar
+from services.util import randchars
 from services.user import NoUserIDError
 
 
@@ -71,12 +71,8 @@ class ResetCode(object):
         Returns:
             reset code
         """
-        chars = string.ascii_uppercase + string.digits
-
-        def _4chars():
-            return ''.join([randchar(chars) for i in range(4)])
-
-        code = '-'.join([_4chars() for i in range(4)])
+        chars = randchars(16, string.ascii_uppercase + string.digits)
+        code = '-'.join([chars[i:i + 4] for i in range(0, 16, 4)])
         return code
 
     def _check_reset_code(self, code):
@@ -44,10 +44,12 @@ import datetime
 
 from sqlalchemy.ext.declarative import declarative_base, Column
 from sqlalchemy import String, DateTime
-from sqlalchemy.sql import bindparam, select, insert, delete, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import bindparam, select, insert, delete, and_, or_, text
 
 from services.util import safe_execute, create_engine
 from services.resetcodes import ResetCode
+from services.resetcodes.sweeper import get_sweeper
 from services.exceptions import BackendError
 
 
@@ -60,76 +62,171 @@ class ResetCodes(_Base):
     username = Column(String(32), primary_key=True, nullable=False)
     product = Column(String(32), primary_key=True, nullable=False)
     reset = Column(String(32))
-    expiration = Column(DateTime())
+    expiration = Column(DateTime(), index=True)
 
 reset_codes = ResetCodes.__table__
 
-_USER_RESET_CODE = select([reset_codes.c.expiration, reset_codes.c.reset],
+_USER_RESET_CODE = select([reset_codes.c.reset],
                         and_(reset_codes.c.username == bindparam('user_name'),
-                             reset_codes.c.product == bindparam('product')))
+                             reset_codes.c.product == bindparam('product'),
+                             reset_codes.c.expiration > bindparam('now')))
+
+# upsert statements, per (table, dialect, overwrite)
+_UPSERTS = {}
+
+
+def _upsert(table, dialect, overwrite):
+    """Returns a statement storing a reset code, or None if the dialect
+    has no upsert.
+
+    Unless overwrite is True, a code that did not expire yet is kept,
+    and nothing is stored. On MySQL the check is done in the update of the
+    duplicate row, which is locked by the insert, so two concurrent calls
+    can't both store their code. A kept code sets the insert id of the
+    statement to 1, as the affected rows can't tell it from an insert.
+    """
+    key = table, dialect, overwrite
+    if key in _UPSERTS:
+        return _UPSERTS[key]
+
+    columns = [column.name for column in table.columns]
+    values = ', '.join(':' + name for name in columns)
+    if dialect == 'mysql':
+        query = 'INSERT INTO'
+    elif dialect == 'sqlite':
+        query = 'INSERT OR REPLACE INTO'
+    else:
+        _UPSERTS[key] = None
+        return None
+
+    query += ' %s (%s) ' % (table.name, ', '.join(columns))
+    if overwrite or dialect == 'mysql':
+        query += 'VALUES (%s)' % values
+    else:
+        where = ' AND '.join('%s = :%s' % (column.name, column.name)
+                             for column in table.primary_key.columns)
+        query += ('SELECT %s WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s '
+                  'AND expiration > :now)' % (values, table.name, where))
+
+    if dialect == 'mysql':
+        # expiration is updated last, so every test sees the old one
+        updated = [column.name for column in table.columns
+                   if not column.primary_key and column.name != 'expiration']
+        updated.append('expiration')
+        if overwrite:
+            updates = ['%s = VALUES(%s)' % (name, name) for name in updated]
+        else:
+            kept = dict((name, name) for name in updated)
+            kept['expiration'] = 'IF(LAST_INSERT_ID(1), expiration, NULL)'
+            updates = ['%s = IF(expiration > :now, %s, VALUES(%s))'
+                       % (name, kept[name], name) for name in updated]
+        query += ' ON DUPLICATE KEY UPDATE ' + ', '.join(updates)
+
+    query = text(query, bindparams=[bindparam('expiration', type_=DateTime()),
+                                    bindparam('now', type_=DateTime())])
+    _UPSERTS[key] = query
+    return query
+
+
+def _stored_code(engine, table, keys, now):
+    where = and_(table.c.expiration > now,
+                 *[table.c[name] == value for name, value in keys.items()])
+    res = safe_execute(engine, select([table.c.reset], where)).fetchone()
+    return res and res.reset
+
+
+def store_reset_code(engine, table, keys, code, expiration, overwrite=True):
+    """Stores a reset code in the table, in a single statement.
+
+    `keys` maps the primary key columns to their values. Unless overwrite
+    is True, a code that did not expire yet is kept. Returns the code that
+    is stored: the new one, or the kept one, which is then read back.
+    Returns None if nothing could be stored.
+    """
+    now = datetime.datetime.now()
+    query = _upsert(table, engine.dialect.name, overwrite)
+    if query is not None:
+        res = safe_execute(engine, query, reset=code, expiration=expiration,
+                           now=now, **keys)
+        if engine.dialect.name == 'mysql':
+            # MySQL counts 2 rows when a row gets updated, and a kept row
+            # as found, like an inserted one - see _upsert
+            stored = res.rowcount > 0 and not res.lastrowid
+        else:
+            stored = res.rowcount > 0
+        if stored:
+            return code
+        if overwrite:
+            return None
+        return _stored_code(engine, table, keys, now)
+
+    # no upsert for this database: delete, then insert
+    where = and_(*[table.c[name] == value for name, value in keys.items()])
+    if not overwrite:
+        where = and_(where, or_(table.c.expiration == None,  # NOQA
+                                table.c.expiration <= now))
+    safe_execute(engine, delete(table).where(where))
+    values = dict(keys, reset=code, expiration=expiration)
+    try:
+        res = safe_execute(engine, insert(table).values(**values))
+    except IntegrityError:
+        # a valid code is stored already
+        return _stored_code(engine, table, keys, now)
+    if res.rowcount == 1:
+        return code
+    return None
 
 
 class ResetCodeSQL(ResetCode):
     """ Implements the reset code methods for a sql backend
+
+    Expired codes can be deleted by a background sweeper every
+    `sweep_interval` seconds (0, the default, disables it). The sweeper
+    is started on the first write, so that it runs in forked workers.
     """
     def __init__(self, engine=None, product='auth', create_tables=False,
-                 expiration=21600, sqluri=None, **kw):
+                 expiration=21600, sqluri=None, sweep_interval=0,
+                 sweep_batch_size=1000, **kw):
         self._engine = engine
         if self._engine is None:
             self._engine = create_engine(sqluri)
 
         self.product = product
         self.expiration = expiration
+        self._sweeper = None
         if self._engine is not None:
             reset_codes.metadata.bind = self._engine
             if create_tables:
                 reset_codes.create(checkfirst=True)
+            self._sweeper = get_sweeper(self._engine, reset_codes,
+                                        sweep_interval, sweep_batch_size)
 
     #
     # Private methods
     #
     def _get_reset_code(self, user_id):
-        res = self._engine.execute(_USER_RESET_CODE,
-                                   user_name=user_id, product=self.product)
+        # expired codes are left to the sweeper
+        res = safe_execute(self._engine, _USER_RESET_CODE, user_name=user_id,
+                           product=self.product, now=datetime.datetime.now())
         res = res.fetchone()
-
-        if res is None or res.reset is None or res.expiration is None:
-            return None
-
-        if isinstance(res.expiration, basestring):
-            exp = datetime.datetime.strptime(res.expiration,
-                                             '%Y-%m-%d %H:%M:%S.%f')
-        else:
-            exp = res.expiration
-
-        if exp < datetime.datetime.now():
-            # expired
-            self._delete_reset_code(user_id)
+        if res is None:
             return None
-
         return res.reset
 
-    def _set_reset_code(self, user_id):
+    def _set_reset_code(self, user_id, overwrite=True):
+        """Stores a new code, and returns the stored one: unless overwrite
+        is True, a valid code stored already is kept and returned."""
+        if self._sweeper is not None:
+            self._sweeper.start()
         code = self._generate_reset_code()
-        query = delete(reset_codes).where(
-                                   and_(reset_codes.c.username == user_id,
-                                        reset_codes.c.product == self.product))
-        self._engine.execute(query)
-
         expiration_time = datetime.datetime.now() + \
                             datetime.timedelta(seconds=self.expiration)
-
-        query = insert(reset_codes).values(reset=code,
-                                           expiration=expiration_time,
-                                           product=self.product,
-                                           username=user_id)
-
-        res = safe_execute(self._engine, query)
-
-        if res.rowcount != 1:
+        keys = {'username': user_id, 'product': self.product}
+        stored = store_reset_code(self._engine, reset_codes, keys, code,
+                                  expiration_time, overwrite)
+        if stored is None and overwrite:
             raise BackendError('adding a reset code to the reset table failed')
-
-        return code
+        return stored
 
     def _delete_reset_code(self, user_id):
         query = delete(reset_codes).where(reset_codes.c.username == user_id)
@@ -141,12 +238,7 @@ class ResetCodeSQL(ResetCode):
     #
     def generate_reset_code(self, user, overwrite=False):
         user_id = self._get_user_id(user)
-        if not overwrite:
-            stored_code = self._get_reset_code(user_id)
-            if stored_code is not None:
-                return stored_code
-
-        return self._set_reset_code(user_id)
+        return self._set_reset_code(user_id, overwrite)
 
     def verify_reset_code(self, user, code):
         user_id = self._get_user_id(user)
@@ -0,0 +1,187 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Background removal of the expired reset codes.
+
+The reset codes are read with a filter on their expiration, so expired
+rows are never returned, and are deleted here in bounded batches instead
+of on the request path.
+
+Sweeping is opt-in: each process sweeping the table runs its own sweeper,
+so it is usually enabled on a few processes only.
+"""
+import os
+import atexit
+import datetime
+import threading
+
+from sqlalchemy.sql import select, delete, and_, or_
+
+from metlog.holder import CLIENT_HOLDER
+from services.util import safe_execute
+
+
+# sweepers, one per table and database
+_SWEEPERS = {}
+_LOCK = threading.Lock()
+
+
+def sweep_expired(engine, table, batch_size=1000):
+    """Deletes the rows of table expired before now, batch_size at a time.
+
+    Each batch is located through the index on the expiration column, and
+    deleted by primary key. Returns the number of deleted rows.
+    """
+    now = datetime.datetime.now()
+    expired = table.c.expiration < now
+    keys = list(table.primary_key.columns)
+    query = select(keys, expired).limit(batch_size)
+    deleted = 0
+    while True:
+        rows = safe_execute(engine, query).fetchall()
+        if not rows:
+            break
+        if len(keys) == 1:
+            where = keys[0].in_([row[0] for row in rows])
+        else:
+            where = or_(*[and_(*[key == value for key, value
+                                 in zip(keys, row)]) for row in rows])
+        # the expiration is checked again, in case a code was regenerated
+        res = safe_execute(engine, delete(table).where(and_(where, expired)))
+        deleted += res.rowcount
+        if len(rows) < batch_size:
+            break
+    return deleted
+
+
+class ExpirySweeper(object):
+    """Thread calling sweep_expired every `interval` seconds."""
+    def __init__(self, engine, table, interval=600, batch_size=1000,
+                 key=None):
+        self.engine = engine
+        self.table = table
+        self.interval = float(interval)
+        self.batch_size = int(batch_size)
+        self.logger = CLIENT_HOLDER.default_client
+        self._key = key
+        self._thread = None
+        self._pid = None
+
+    def sweep(self):
+        deleted = sweep_expired(self.engine, self.table, self.batch_size)
+        if self.logger is not None:
+            self.logger.incr('services.resetcodes.swept', deleted)
+        return deleted
+
+    def start(self):
+        """Starts the thread, unless it runs already. A forked process
+        gets a thread of its own."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with _LOCK:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # looked up now, so that a gevent-patched Event is used
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._loop)
+            self._thread.daemon = True
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the thread, and unregisters the sweeper."""
+        with _LOCK:
+            if _SWEEPERS.get(self._key) is self:
+                del _SWEEPERS[self._key]
+        if self._thread is None:
+            return
+        self._stopped.set()
+        if self._pid == os.getpid():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception('Reset codes sweep failed')
+
+
+@atexit.register
+def _stop_sweepers():
+    # stopped before the interpreter shutdown tears the modules down
+    # under the threads
+    for sweeper in _SWEEPERS.values():
+        sweeper.stop(timeout=1)
+
+
+def _database_key(engine):
+    """Returns what identifies the database of an engine."""
+    url = engine.url
+    if url.drivername.startswith('sqlite') and url.database in (None, '',
+                                                                ':memory:'):
+        # every in-memory SQLite engine has a database of its own
+        return engine
+    return str(url)
+
+
+def get_sweeper(engine, table, interval=0, batch_size=1000):
+    """Returns the sweeper of the table, shared by the backends of this
+    process, or None if interval is 0. The sweeper is not started: the
+    backends start it on their first write, so that it runs in the
+    processes forked after their creation.
+    """
+    if not interval or float(interval) <= 0:
+        return None
+    key = _database_key(engine), table.name
+    with _LOCK:
+        sweeper = _SWEEPERS.get(key)
+        if sweeper is None:
+            sweeper = _SWEEPERS[key] = ExpirySweeper(engine, table, interval,
+                                                     batch_size, key)
+    return sweeper
+
+
+def start_sweeper(engine, table, interval=600, batch_size=1000):
+    """Starts sweeping the table, unless it is already swept by another
+    backend of this process. Returns the sweeper, or None if interval is 0.
+    """
+    sweeper = get_sweeper(engine, table, interval, batch_size)
+    if sweeper is not None:
+        sweeper.start()
+    return sweeper
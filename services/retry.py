@@ -0,0 +1,161 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Retry policies, with exponential backoff and jitter.
+
+A policy yields the attempts of an operation, sleeping between them, and
+stops yielding when the attempts, the time budget or the retry budget of
+the retried resource are exhausted::
+
+    for attempt in policy.attempts(engine):
+        try:
+            return do_something()
+        except SomeError:
+            if not retryable:
+                raise
+    raise SomeError('Giving up')
+
+The retry budget is a token bucket per resource (an engine, a server...)
+shared by every caller: each operation adds `budget_ratio` token and each
+retry takes one, so that when a backend is down, retries can't multiply
+the load on it.
+"""
+import random
+import time
+from threading import Lock
+
+from metlog.holder import CLIENT_HOLDER
+
+
+class RetryBudget(object):
+    """Token bucket allowing about `ratio` retries per operation, and at
+    most `max_tokens` retries in a row."""
+    def __init__(self, ratio=.1, max_tokens=10):
+        self.ratio = float(ratio)
+        self.max_tokens = float(max_tokens)
+        self.tokens = self.max_tokens
+        self._lock = Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Takes a token, returns False if there is none left."""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """Describes how an operation gets retried.
+
+    Args:
+        - max_attempts: number of attempts, including the first one.
+        - base_delay: delay before the first retry, in seconds. It is
+          doubled after every retry...
+        - max_delay: ...up to this value.
+        - jitter: fraction of the delay that is randomized, so that
+          clients don't retry in lockstep.
+        - time_budget: no retry is attempted past this many seconds after
+          the first attempt. None for no limit.
+        - budget_ratio, budget_max: configure the retry budget of each
+          resource. A budget_max of 0 disables the retry budgets.
+        - name: used in the metlog counters.
+    """
+    def __init__(self, max_attempts=2, base_delay=.05, max_delay=1.,
+                 jitter=.5, time_budget=None, budget_ratio=.1,
+                 budget_max=10, name='default'):
+        self.max_attempts = int(max_attempts)
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.jitter = float(jitter)
+        if time_budget is not None:
+            time_budget = float(time_budget)
+        self.time_budget = time_budget
+        self.budget_ratio = float(budget_ratio)
+        self.budget_max = float(budget_max)
+        self.name = name
+        self._budgets = {}
+        self._lock = Lock()
+
+    def delay(self, retry):
+        """Returns how long to wait before the given retry (1 for the
+        first one)."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def budget(self, key):
+        """Returns the retry budget of a resource, or None."""
+        if key is None or self.budget_max <= 0:
+            return None
+        with self._lock:
+            budget = self._budgets.get(key)
+            if budget is None:
+                budget = self._budgets[key] = RetryBudget(self.budget_ratio,
+                                                          self.budget_max)
+            return budget
+
+    def attempts(self, key=None):
+        """Yields the attempt numbers (0 for the first one), sleeping
+        before each retry.
+
+        `key` identifies the retried resource, for the retry budget.
+        """
+        budget = self.budget(key)
+        if budget is not None:
+            budget.deposit()
+        start = time.time()
+        yield 0
+        for retry in range(1, self.max_attempts):
+            delay = self.delay(retry)
+            if self.time_budget is not None:
+                if time.time() - start + delay > self.time_budget:
+                    self._incr('time_budget_exceeded')
+                    return
+            if budget is not None and not budget.withdraw():
+                self._incr('budget_exhausted')
+                return
+            self._incr('retry')
+            time.sleep(delay)
+            yield retry
+
+    def _incr(self, name):
+        logger = CLIENT_HOLDER.default_client
+        if logger is not None:
+            logger.incr('services.retry.%s.%s' % (self.name, name))
@@ -190,6 +190,26 @@ class TestBaseApp(unittest.TestCase):
         for value in app.get_infos(request).values():
             self.assertTrue(value in errors[1])
 
+    def test_hashing_config(self):
+        from services.util import SCRYPT_PARAMS, HASH_POOL
+        old = dict(SCRYPT_PARAMS), HASH_POOL.size, HASH_POOL.max_queue
+        config = {'global.hash_pool_size': 2,
+                  'global.hash_max_queue': 10,
+                  'global.scrypt_n': 1024,
+                  'app.modules': ['metlog_loader'],
+                  'metlog_loader.backend': 'services.metrics.MetlogLoader',
+                  'metlog_loader.config': metlog_cfg_path,
+                  'auth.backend': 'services.auth.dummy.DummyAuth'}
+        try:
+            SyncServerApp([], {}, config, auth_class=self.auth_class)
+            self.assertEqual(SCRYPT_PARAMS['N'], 1024)
+            self.assertEqual(HASH_POOL.size, 2)
+            self.assertEqual(HASH_POOL.max_queue, 10)
+        finally:
+            SCRYPT_PARAMS.update(old[0])
+            HASH_POOL.resize(old[1])
+            HASH_POOL.max_queue = old[2]
+
     def test_heartbeat_debug_pages(self):
 
         config = {'global.heartbeat_page': '__heartbeat__',
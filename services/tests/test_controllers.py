@@ -34,6 +34,9 @@
 #
 # ***** END LICENSE BLOCK *****
 import unittest
+
+from nose.plugins.skip import SkipTest
+
 from services.controllers import StandardController
 from services.tests.support import make_request
 
@@ -124,6 +127,22 @@ class TestStandardController(unittest.TestCase):
         # make sure we don't have any password left
         self.assertTrue('xxxx' not in debug.body)
 
+    def test_ldap_stats(self):
+        try:
+            from services.ldappool import ConnectionManager
+        except ImportError:
+            raise SkipTest
+
+        pool = ConnectionManager('ldap://debug', use_pool=True)
+        pool.stats.incr('created')
+        pool.stats.observe('search', .012)
+
+        req = make_request("/__debug__", _ENVIRON)
+        debug = StandardController(None)._debug(req)
+        self.assertTrue('LDAP pool ldap://debug' in debug.body)
+        self.assertTrue('created=1' in debug.body)
+        self.assertTrue('search: count=1' in debug.body)
+
 
 def test_suite():
     suite = unittest.TestSuite()
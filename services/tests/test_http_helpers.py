@@ -39,6 +39,7 @@ import unittest
 import urllib2
 import socket
 from services.http_helpers import get_url, proxy
+from services.retry import RetryPolicy
 
 
 class FakeResult(object):
@@ -55,6 +56,7 @@ class FakeResult(object):
 class TestHttp(unittest.TestCase):
 
     def setUp(self):
+        self.opened = []
         self.oldopen = urllib2.urlopen
         urllib2.urlopen = self._urlopen
 
@@ -63,6 +65,7 @@ class TestHttp(unittest.TestCase):
 
     def _urlopen(self, req, timeout=None):
         url = req.get_full_url()
+        self.opened.append((req.get_method(), url))
         if url == 'impossible url':
             raise ValueError()
         if url == 'http://dwqkndwqpihqdw.com':
@@ -127,6 +130,29 @@ class TestHttp(unittest.TestCase):
         code, headers, body = get_url('http://error', get_body=False)
         self.assertEquals(code, 500)
 
+    def test_get_url_retry(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0)
+
+        # gateway errors get retried
+        code, headers, body = get_url('http://timeout', retry_policy=policy)
+        self.assertEquals(code, 504)
+        self.assertEquals(len(self.opened), 3)
+
+        # not the other errors
+        del self.opened[:]
+        get_url('http://error', retry_policy=policy)
+        self.assertEquals(len(self.opened), 1)
+
+        # nor the non-idempotent calls
+        del self.opened[:]
+        get_url('http://timeout', 'POST', retry_policy=policy)
+        self.assertEquals(len(self.opened), 1)
+
+        # nor without a policy
+        del self.opened[:]
+        get_url('http://timeout', retry_policy=None)
+        self.assertEquals(len(self.opened), 1)
+
     def test_proxy(self):
         class FakeRequest(object):
             url = 'http://locahost'
@@ -70,6 +70,10 @@ def _bind_fails2(self, who='', cred='', **kw):
 _CALL_COUNTER = 0
 
 
+def _actives(cm):
+    return len([conn for conn in cm._pool if conn.active])
+
+
 def _bind_fails3(self, who='', cred='', **kw):
     global _CALL_COUNTER
     _CALL_COUNTER += 1
@@ -109,8 +113,7 @@ class TestLDAPConnection(unittest.TestCase):
                 self.assertEqual(len(cm), 2)
 
                 # every connector is marked active
-                self.assertTrue(cm._pool[0].active)
-                self.assertTrue(cm._pool[1].active)
+                self.assertEqual(_actives(cm), 2)
 
                 # if we ask a new one the pool is full
                 try:
@@ -122,16 +125,15 @@ class TestLDAPConnection(unittest.TestCase):
                     raise AssertionError()
 
             # down to one active
-            self.assertFalse(cm._pool[1].active)
-            self.assertTrue(cm._pool[0].active)
+            self.assertEqual(_actives(cm), 1)
+            self.assertEqual(len(cm._lru), 1)
 
             # if we ask a new one the pool is full
             # but we get the inactive one
             with cm.connection('dn', 'pass'):
                 self.assertEqual(len(cm), 2)
 
-            self.assertFalse(cm._pool[1].active)
-            self.assertTrue(cm._pool[0].active)
+            self.assertEqual(_actives(cm), 1)
 
             # if we ask a new one the pool is full
             # but we get the inactive one, and rebind it
@@ -142,8 +144,8 @@ class TestLDAPConnection(unittest.TestCase):
         self.assertEqual(len(cm), 2)
 
         # every connector is marked inactive
-        self.assertFalse(cm._pool[0].active)
-        self.assertFalse(cm._pool[1].active)
+        self.assertEqual(_actives(cm), 0)
+        self.assertEqual(len(cm._lru), 2)
 
     def test_simple_bind_fails(self):
         if not LDAP:
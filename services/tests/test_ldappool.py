@@ -33,12 +33,16 @@
 # the terms of any one of the MPL, the GPL or the LGPL.
 #
 # ***** END LICENSE BLOCK *****
+import os
 import unittest
 import threading
 import time
+
+import simplejson as json
 try:
     import ldap
-    from services.ldappool import ConnectionManager, StateConnector
+    from services.ldappool import (ConnectionManager, StateConnector,
+                                   ServerSet)
     from services.exceptions import MaxConnectionReachedError
     LDAP = True
 except ImportError:
@@ -56,6 +60,8 @@ if LDAP:
                                                     'uidNumber': ['100']}}
 
     def _simple_bind(self, who='', cred='', *args):
+        if 'down' in self._uri:
+            raise ldap.SERVER_DOWN
         self.connected = True
         self.who = who
         self.cred = cred
@@ -105,6 +111,45 @@ if LDAP:
 
     StateConnector.delete_s = _delete
 
+    def _whoami(self):
+        if self.who == 'dead':
+            raise ldap.SERVER_DOWN
+        return 'dn:' + self.who
+
+    StateConnector.whoami_s = _whoami
+
+    class AsyncStateConnector(StateConnector):
+        """Answers asynchronous operations, in reverse order."""
+
+        def __init__(self, *args, **kw):
+            StateConnector.__init__(self, *args, **kw)
+            self._msgid = 0
+            self._results = {}
+            self._fd, fd = os.pipe()
+            os.write(fd, 'x')
+
+        def get_option(self, option):
+            return self._fd
+
+        def search_ext(self, base, scope, filterstr, attrlist, attrsonly):
+            self._msgid += 1
+            try:
+                res = self.search_s(base, scope, filterstr=filterstr)
+                res = (ldap.RES_SEARCH_RESULT, res, self._msgid, [])
+            except ldap.LDAPError, exc:
+                res = exc
+            self._results[self._msgid] = res
+            return self._msgid
+
+        def result3(self, msgid, all=1, timeout=None):
+            # only the most recent operation is answered
+            if msgid != max(self._results):
+                return None, None, None, None
+            res = self._results.pop(msgid)
+            if isinstance(res, Exception):
+                raise res
+            return res
+
 
 class LDAPWorker(threading.Thread):
 
@@ -149,7 +194,7 @@ class TestLDAPSQLAuth(unittest.TestCase):
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
         pool = ConnectionManager('ldap://localhost', dn, passwd, size=1,
-                              retry_delay=1., retry_max=5, use_pool=True)
+                                 checkout_timeout=1., use_pool=True)
 
         class Worker(threading.Thread):
 
@@ -264,6 +309,32 @@ class TestLDAPSQLAuth(unittest.TestCase):
 
         self.assertTrue(conn is conn2)
 
+    def test_purge(self):
+        if not LDAP:
+            return
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd,
+                                 use_pool=True)
+
+        with pool.connection('bind', 'passwd') as idle:
+            pass
+
+        with pool.connection('bind', 'passwd') as conn:
+            self.assertTrue(conn is idle)
+            with pool.connection('bind', 'passwd') as other:
+                pass
+            # only the idle connector is dropped
+            pool.purge('bind', 'newpasswd')
+            self.assertFalse(other.connected)
+            self.assertTrue(conn.connected)
+            self.assertTrue(conn in pool._pool)
+            self.assertFalse(other in pool._pool)
+
+        # the other one is dropped once released
+        self.assertFalse(conn in pool._pool)
+        self.assertEqual(len(pool), 0)
+
     def test_max_lifetime(self):
         if not LDAP:
             return
@@ -293,3 +364,359 @@ class TestLDAPSQLAuth(unittest.TestCase):
 
         self.assertTrue(conn3 is not conn2)
         self.assertTrue(conn3 is not conn)
+
+    def test_pool_lru(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd, size=2,
+                                 use_pool=True)
+
+        with pool.connection('bind1', 'passwd') as conn1:
+            with pool.connection('bind2', 'passwd') as conn2:
+                pass
+
+        # both connectors are idle, indexed by their bind
+        self.assertEqual(len(pool._lru), 2)
+        self.assertEqual(sorted(pool._idle.keys()),
+                         [('bind1', 'passwd'), ('bind2', 'passwd')])
+
+        # a known bind gets its own connector back
+        with pool.connection('bind2', 'passwd') as conn:
+            self.assertTrue(conn is conn2)
+            self.assertEqual(len(pool._lru), 1)
+
+        # an unknown bind rebinds the least recently used connector
+        with pool.connection('bind3', 'passwd') as conn:
+            self.assertTrue(conn is conn1)
+
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(sorted(pool._idle.keys()),
+                         [('bind2', 'passwd'), ('bind3', 'passwd')])
+
+    def test_pool_wait_queue(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd, size=1,
+                                 checkout_timeout=2., max_waiters=2,
+                                 use_pool=True)
+        order = []
+
+        class Worker(threading.Thread):
+
+            def __init__(self, name):
+                threading.Thread.__init__(self)
+                self.name = name
+
+            def run(self):
+                with pool.connection() as conn:
+                    order.append((self.name, conn))
+                    time.sleep(.1)
+
+        with pool.connection() as conn:
+            workers = []
+            for name in ('first', 'second'):
+                worker = Worker(name)
+                worker.start()
+                workers.append(worker)
+                time.sleep(.1)
+
+            # the wait queue is full
+            self.assertEqual(len(pool._waiters), 2)
+            self.assertRaises(MaxConnectionReachedError,
+                              pool._get_connection)
+
+        for worker in workers:
+            worker.join()
+
+        # the connector was handed over in order
+        self.assertEqual([name for name, __ in order], ['first', 'second'])
+        self.assertTrue(order[0][1] is conn)
+        self.assertTrue(order[1][1] is conn)
+        self.assertEqual(len(pool._waiters), 0)
+        self.assertEqual(len(pool), 1)
+
+    def test_maintenance(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd, size=3,
+                                 min_idle=2, max_lifetime=10,
+                                 lifetime_margin=1, use_pool=True)
+
+        # the pool gets pre-warmed with the default bind
+        pool.maintain()
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool._idle.keys(), [(dn, passwd)])
+        with pool.connection() as conn:
+            self.assertEqual(conn.who, dn)
+
+        # dead connectors are removed, and replaced
+        with pool.connection('dead', 'dead') as dead:
+            pass
+        self.assertTrue(dead in pool._pool)
+        pool.maintain()
+        self.assertEqual(len(pool), 2)
+        self.assertFalse(dead in pool._pool)
+        self.assertEqual(len(pool._idle[dn, passwd]), 2)
+
+        # connectors close to their max lifetime are rotated
+        old = list(pool._pool)
+        for conn in old:
+            conn._connection_time -= 9.5
+        pool.maintain()
+        self.assertEqual(len(pool), 2)
+        for conn in old:
+            self.assertFalse(conn in pool._pool)
+
+    def test_maintenance_thread(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd, size=3,
+                                 min_idle=1, maintenance_interval=.1,
+                                 use_pool=True)
+        try:
+            time.sleep(.3)
+            self.assertEqual(len(pool), 1)
+        finally:
+            pool.stop_maintenance()
+        self.assertTrue(pool._maintenance is None)
+
+    def test_async(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd,
+                                 connector_cls=AsyncStateConnector,
+                                 use_async=True, use_pool=True)
+
+        workers = [LDAPWorker(pool) for i in range(5)]
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+            self.assertEquals(len(worker.results), 10)
+            cn = worker.results[0][0][1]['cn']
+            self.assertEquals(cn, ['admin'])
+
+        # every search went through the same connector, that has a slot
+        self.assertEqual(len(pool), 1)
+        with pool.connection() as conn:
+            self.assertTrue(conn is pool._async)
+            self.assertEqual(conn.who, dn)
+            self.assertRaises(ldap.NO_SUCH_OBJECT, conn.search_st,
+                              'cn=unknown', ldap.SCOPE_BASE)
+
+        self.assertEqual(conn._pending, {})
+
+        # other binds still use the pool
+        with pool.connection('bind', 'passwd') as conn:
+            self.assertTrue(conn is not pool._async)
+        self.assertEqual(len(pool), 2)
+
+        # an expired connector is replaced, and unbound once closed
+        old = pool._async
+        old.conn._connection_time = time.time() - pool.max_lifetime - 1
+        with pool.connection() as conn:
+            self.assertTrue(conn is pool._async)
+            self.assertTrue(conn is not old)
+        self.assertEqual(len(pool), 2)
+        self.assertFalse(old in pool._pool)
+
+        # and so is a disconnected one
+        old = pool._async
+        try:
+            with pool.connection() as conn:
+                raise ldap.SERVER_DOWN
+        except ldap.SERVER_DOWN:
+            pass
+        with pool.connection() as conn:
+            self.assertTrue(conn is not old)
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.get_stats()['discarded'], 1)
+
+        time.sleep(.1)
+        self.assertFalse(old.conn.connected)
+        self.assertEqual(old.conn.who, None)
+
+    def test_server_policies(self):
+        if not LDAP:
+            return
+
+        servers = ServerSet('ldap://one, ldap://two ldap://three')
+        self.assertEqual(len(servers), 3)
+        one, two, three = servers.servers
+        picked = [servers.pick() for i in range(6)]
+        self.assertEqual(picked, [one, two, three, one, two, three])
+
+        servers = ServerSet(['ldap://one', 'ldap://two'],
+                            policy='least_outstanding')
+        one, two = servers.servers
+        servers.checkout(servers.pick())
+        self.assertEqual(servers.pick(), two)
+        servers.checkout(two)
+        servers.checkout(two)
+        self.assertEqual(servers.pick(), one)
+
+        servers = ServerSet(['ldap://one', 'ldap://two'], policy='ewma')
+        one, two = servers.servers
+        servers.success(one, 1.)
+        servers.success(two, .1)
+        self.assertEqual(servers.pick(), two)
+
+        self.assertRaises(ValueError, ServerSet, 'ldap://one', 'random')
+
+    def test_server_ejection(self):
+        if not LDAP:
+            return
+
+        servers = ServerSet(['ldap://one', 'ldap://two'],
+                            failure_threshold=2, cooldown=.2)
+        one, two = servers.servers
+        servers.failure(one)
+        self.assertTrue(servers.available(one))
+        servers.failure(one)
+        self.assertFalse(servers.available(one))
+        self.assertEqual([servers.pick() for i in range(3)], [two] * 3)
+
+        # everything is down: the first server back is used anyway
+        servers.failure(two)
+        servers.failure(two)
+        self.assertEqual(servers.pick(), one)
+
+        # after the cooldown, the server is tried again
+        time.sleep(.2)
+        self.assertTrue(servers.available(one))
+        servers.success(one)
+        self.assertEqual(one.failures, 0)
+
+    def test_failover(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://down ldap://up', dn, passwd,
+                                 use_pool=True, retry_delay=0,
+                                 failure_threshold=1)
+        down, up = pool.servers.servers
+
+        # the dead server is skipped, then ejected
+        for i in range(3):
+            with pool.connection() as conn:
+                self.assertEqual(conn._uri, 'ldap://up')
+        self.assertFalse(pool.servers.available(down))
+        self.assertEqual(up.outstanding, 0)
+
+        # a connector failing in use is dropped, and its server ejected
+        try:
+            with pool.connection() as conn:
+                raise ldap.SERVER_DOWN
+        except ldap.SERVER_DOWN:
+            pass
+        self.assertFalse(conn in pool._pool)
+        self.assertFalse(pool.servers.available(up))
+
+    def test_master(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://replica1 ldap://replica2', dn,
+                                 passwd, use_pool=True,
+                                 master_uri='ldap://master')
+
+        with pool.connection() as conn:
+            self.assertTrue(conn._uri.startswith('ldap://replica'))
+
+        with pool.connection(write=True) as conn:
+            self.assertEqual(conn._uri, 'ldap://master')
+            self.assertEqual(conn.who, dn)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(len(pool._master), 1)
+
+    def test_stats(self):
+        if not LDAP:
+            return
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd, size=1,
+                                 use_pool=True, checkout_timeout=.1)
+
+        with pool.connection() as conn:
+            # the pool is full
+            try:
+                with pool.connection():
+                    pass
+            except MaxConnectionReachedError:
+                pass
+
+        # the idle connector gets rebound
+        with pool.connection('bind', 'passwd'):
+            pass
+
+        stats = pool.get_stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['rebinds'], 1)
+        self.assertEqual(stats['max_reached'], 1)
+        self.assertTrue(stats['latency']['bind'].startswith('count=2 '))
+
+        # synchronous python-ldap calls are timed by the connector
+        def search_ext_s(conn, delay):
+            time.sleep(delay)
+
+        conn._apply_method_s(search_ext_s, 0)
+        conn._apply_method_s(search_ext_s, .2)
+        histogram = pool.stats.latency['search']
+        self.assertEqual(histogram.percentile(.5), 1)
+        self.assertEqual(histogram.percentile(.99), 250)
+
+        def compare_ext_s(conn, *args):
+            return 1
+
+        conn._apply_method_s(compare_ext_s, 'dn', 'attr', 'value')
+        self.assertEqual(pool.stats.latency['compare'].count, 1)
+
+    def test_stats_sampling(self):
+        if not LDAP:
+            return
+        from metlog.client import MetlogClient
+        from metlog.senders.dev import DebugCaptureSender
+
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        pool = ConnectionManager('ldap://localhost', dn, passwd,
+                                 use_pool=True, stats_interval=60)
+        pool.logger = MetlogClient(DebugCaptureSender(), 'test')
+
+        # the occupancy is reported once per interval, not per checkout
+        for i in range(5):
+            with pool.connection():
+                pass
+        names = [json.loads(msg)['fields'].get('name')
+                 for msg in pool.logger.sender.msgs]
+        self.assertEqual(names.count('services.ldappool.size'), 1)
+        self.assertEqual(names.count('services.ldappool.lock_wait'), 1)
+
+        pool._next_report = 0
+        pool.maintain()
+        names = [json.loads(msg)['fields'].get('name')
+                 for msg in pool.logger.sender.msgs]
+        self.assertEqual(names.count('services.ldappool.size'), 2)
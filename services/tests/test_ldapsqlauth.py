@@ -36,6 +36,7 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import random
+import time
 
 from services.util import BackendError, BackendTimeoutError
 from sqlalchemy.exc import OperationalError
@@ -43,7 +44,8 @@ from sqlalchemy.exc import OperationalError
 try:
     import ldap
     from services.ldappool import StateConnector
-    from services.auth.ldapsql import LDAPAuth
+    from services.auth.ldapsql import LDAPAuth, available_nodes
+    from services.auth.nodes import NodeAllocator
     LDAP = True
 except ImportError:
     LDAP = False
@@ -101,6 +103,7 @@ if LDAP:
             self._uri = uri
             self._next_id = 30
             self._l = self
+            self._connection_time = None
             self.connected = False
             self.who = ''
 
@@ -126,6 +129,12 @@ if LDAP:
             self.who = who
             self.cred = passwd
 
+        def compare_s(self, dn, attr, value):
+            if dn not in self.users:
+                raise ldap.NO_SUCH_OBJECT(dn)
+            stored = self.users[dn][attr][0]
+            return validate_password(value.decode('utf8'), stored)
+
         def search_st(self, dn, *args, **kw):
             if dn in self.users:
                 return [(dn, self.users[dn])]
@@ -272,6 +281,93 @@ class TestLDAPSQLAuth(unittest.TestCase):
         self.assertEquals(auth.get_user_node(uid, False), None)
         self.assertEquals(auth.get_user_node(uid), 'https://node1/')
 
+    def test_node_allocator(self):
+        if not LDAP:
+            return
+
+        auth = self._get_auth()
+        sql = ('insert into available_nodes '
+               '(node, available_assignments, actives, downed) '
+                'values("%s", %d, %d, %d)')
+        for node, ct, actives, downed in (('node1', 2, 10, 0),
+                                          ('node2', 5, 11, 0),
+                                          ('node3', 5, 0, 1)):
+            auth._engine.execute(sql % (node, ct, actives, downed))
+
+        allocator = NodeAllocator(auth._engine, available_nodes,
+                                  flush_interval=3600)
+        nodes = [allocator.allocate() for i in range(4)]
+        self.assertEqual(nodes, ['node1', 'node1', 'node2', 'node2'])
+
+        def _counts():
+            rows = auth._engine.execute('select node, available_assignments,'
+                                        ' actives from available_nodes '
+                                        'order by node')
+            return [tuple(row) for row in rows]
+
+        # the assignments are taken right away, the actives are batched
+        self.assertEqual(_counts(), [('node1', 0, 10), ('node2', 3, 11),
+                                     ('node3', 5, 0)])
+        allocator.flush()
+        self.assertEqual(_counts(), [('node1', 0, 12), ('node2', 3, 13),
+                                     ('node3', 5, 0)])
+
+        # assignments taken by another process are not overbooked
+        auth._engine.execute('update available_nodes set '
+                             'available_assignments = 0')
+        self.assertEqual(allocator.allocate(), None)
+
+        # a full cache is reloaded before giving up
+        allocator.release('node2')
+        self.assertEqual(allocator.allocate(), 'node2')
+
+        # the actives are written once enough of them are pending
+        allocator = NodeAllocator(auth._engine, available_nodes,
+                                  flush_interval=3600, flush_threshold=2)
+        auth._engine.execute('update available_nodes set '
+                             'available_assignments = 5')
+
+        def _actives():
+            return sum(actives for node, available, actives in _counts())
+
+        allocator.allocate()
+        self.assertEqual(_actives(), 25)
+        allocator.allocate()
+        self.assertEqual(_actives(), 27)
+
+        # or after flush_interval, by a timer
+        flushed = []
+        allocator.flush = lambda: flushed.append(allocator._pending)
+        allocator.flush_interval = .1
+        allocator.allocate()
+        time.sleep(.3)
+        self.assertEqual(len(flushed), 1)
+
+    def test_id_blocks(self):
+        if not LDAP:
+            return
+
+        auth = self._get_auth(id_block_size=3)
+        del auth._get_next_user_id
+
+        # one row per block of 3 ids
+        ids = [auth._get_next_user_id() for i in range(7)]
+        self.assertEqual(ids, [1, 2, 3, 4, 5, 6, 7])
+        rows = auth._engine.execute('select count(*) from user_ids')
+        self.assertEqual(rows.fetchone()[0], 3)
+
+        # processes using other block sizes never get the same ids
+        others = []
+        for size in (1, 5, 2):
+            other = self._get_auth(id_block_size=size)
+            del other._get_next_user_id
+            other._engine = auth._engine
+            others.append(other)
+        for i in range(6):
+            for allocator in [auth] + others:
+                ids.append(allocator._get_next_user_id())
+        self.assertEqual(len(set(ids)), len(ids))
+
     def test_md5_dn(self):
         if not LDAP:
             return
@@ -348,9 +444,9 @@ class TestLDAPSQLAuth(unittest.TestCase):
         calls = []
         auth._conn2 = auth._conn
 
-        def conn(bind=None, passwd=None):
+        def conn(bind=None, passwd=None, write=False):
             calls.append((bind, passwd))
-            return auth._conn2(bind, passwd)
+            return auth._conn2(bind, passwd, write)
 
         old = auth.verify_reset_code
         auth.verify_reset_code = lambda userid, key: True
@@ -403,12 +499,78 @@ class TestLDAPSQLAuth(unittest.TestCase):
         pool = [conn.who for conn in auth.conn._pool]
         self.assertTrue('uid=joe,ou=users,dc=mozilla' not in pool)
 
+    def test_auth_modes(self):
+        if not LDAP:
+            return
+
+        self.assertRaises(ValueError, self._get_auth, ldap_auth_mode='meh')
+
+        for mode in ('bind', 'compare'):
+            auth = self._get_auth(ldap_use_pool=True, ldap_auth_mode=mode,
+                                  ldap_bind_check_size=2)
+            self._create_user(auth, 'bob', u'bobé', 'tarek@ziade.org')
+            uid = auth.get_user_id('bob')
+            dn = auth._username2dn('bob')
+
+            self.assertEqual(auth.authenticate_user('bob', u'bobé'), uid)
+            self.assertEqual(auth.authenticate_user('bob', 'bad'), None)
+
+            # the admin/search pool never gets bound as the user
+            self.assertTrue(len(auth.conn) > 0)
+            pool = [conn.who for conn in auth.conn._pool]
+            self.assertTrue(dn not in pool)
+
+            # user-bound updates use the bind-check connectors
+            self.assertTrue(auth.update_password(uid, u'newé', u'bobé'))
+            self.assertEqual(auth.authenticate_user('bob', u'bobé'), None)
+            self.assertEqual(auth.authenticate_user('bob', u'newé'), uid)
+            self.assertTrue(len(auth.bind_check) <= 2)
+            auth.delete_user(uid)
+
+    def test_dn_cache(self):
+        if not LDAP:
+            return
+
+        auth = self._get_auth(ldap_dn_cache_size=10)
+        searches = []
+        search = auth._search_user
+
+        def _search_user(filter, attrs):
+            searches.append(filter)
+            return search(filter, attrs)
+
+        auth._search_user = _search_user
+
+        # unknown users are cached too
+        self.assertEqual(auth.get_user_id('bob'), None)
+        self.assertEqual(auth._username2dn('bob'), None)
+        self.assertEqual(len(searches), 1)
+
+        # creating the user invalidates the cache
+        auth.create_user('bob', 'bob', 'bob@example.com')
+        uid = auth.get_user_id('bob')
+        self.assertTrue(uid is not None)
+        self.assertEqual(auth.authenticate_user('bob', 'bob'), uid)
+        self.assertEqual(len(searches), 2)
+
+        # the same search also filled the id -> name lookups
+        name, email = auth.get_user_info(uid)
+        self.assertEqual(name, 'bob')
+        self.assertEqual(auth._userid2dn(uid), auth._username2dn('bob'))
+        self.assertEqual(len(searches), 2)
+
+        # deleting the user invalidates the cache
+        auth.delete_user(uid)
+        self.assertEqual(auth.get_user_id('bob'), None)
+        self.assertEqual(auth._get_username(uid), None)
+        self.assertEqual(len(searches), 4)
+
     def test_get_user_id_fail(self):
         if not LDAP:
             return
 
         auth = self._get_auth(users_base_dn='dc=mozilla',
-                              check_account_state=False)
+                              check_account_state=False, ldap_use_pool=True)
 
         self._create_user(auth, 'tarek', 'tarek', 'tarek@ziade.org')
         uid = auth.get_user_id('tarek')
@@ -423,11 +585,16 @@ class TestLDAPSQLAuth(unittest.TestCase):
             raise TIMEOUT
 
         MemoryStateConnector.search_st = _search
+        self.assertEqual(len(auth.conn), 1)
         try:
             self.assertRaises(BackendError, auth.get_user_id, 'tarek')
         finally:
             MemoryStateConnector.search_st = old
 
+        # the failing connector was dropped, and the server blamed
+        self.assertEqual(len(auth.conn), 0)
+        self.assertEqual(auth.conn.servers.servers[0].failures, 1)
+
     def test_ldap_no_pool(self):
         if not LDAP:
             return
@@ -36,6 +36,7 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import time
+import datetime
 
 from services.pluginreg import load_and_configure
 from services.auth import User
@@ -46,8 +47,14 @@ from services.resetcodes import AlreadySentError
 from services.respcodes import ERROR_NO_EMAIL_ADDRESS
 from services.tests.support import check_memcache
 from services.exceptions import BackendError
+from services.resetcodes.rc_sql import (reset_codes, store_reset_code,
+                                       _upsert)
+from services.util import create_engine
+from services.resetcodes import sweeper
+from services.resetcodes.sweeper import sweep_expired, start_sweeper
 
 from nose.plugins.skip import SkipTest
+from sqlalchemy.dialects import mysql
 
 
 class TestResetCodeManager(unittest.TestCase):
@@ -98,6 +105,150 @@ class TestResetCodeManager(unittest.TestCase):
                           user, True)
         rc_sql.safe_execute = old_safe
 
+    def test_sweep_expired(self):
+        config = {'backend': 'services.resetcodes.rc_sql.ResetCodeSQL',
+                  'sqluri': 'sqlite:///:memory:',
+                  'create_tables': True,
+                  'expiration': -1,
+                  'sweep_interval': 0}
+        storage = load_and_configure(config)
+        user = User()
+        for user_id in range(1, 6):
+            user['userid'] = user_id
+            storage.generate_reset_code(user)
+        storage.expiration = 3600
+        user['userid'] = 6
+        code = storage.generate_reset_code(user)
+
+        self.assertEqual(sweep_expired(storage._engine, reset_codes,
+                                       batch_size=2), 5)
+        rows = storage._engine.execute(reset_codes.select()).fetchall()
+        self.assertEqual([(row.username, row.reset) for row in rows],
+                         [('6', code)])
+        self.assertEqual(sweep_expired(storage._engine, reset_codes), 0)
+
+    def test_start_sweeper(self):
+        one = create_engine('sqlite://')
+        two = create_engine('sqlite:///:memory:')
+        started = [start_sweeper(engine, reset_codes, interval=3600)
+                   for engine in (one, two, one)]
+        try:
+            # each in-memory engine has a database, and a sweeper, of its own
+            self.assertTrue(started[0] is started[2])
+            self.assertTrue(started[0] is not started[1])
+        finally:
+            for started_sweeper in started[:2]:
+                started_sweeper.stop()
+        # stopped sweepers are unregistered
+        for engine in (one, two):
+            key = sweeper._database_key(engine), reset_codes.name
+            self.assertFalse(key in sweeper._SWEEPERS)
+        self.assertEqual(start_sweeper(one, reset_codes, interval=0), None)
+
+    def test_lazy_sweeper(self):
+        config = {'backend': 'services.resetcodes.rc_sql.ResetCodeSQL',
+                  'sqluri': 'sqlite:///:memory:',
+                  'create_tables': True}
+        storage = load_and_configure(config)
+        self.assertEqual(storage._sweeper, None)
+
+        config['sweep_interval'] = 3600
+        storage = load_and_configure(config)
+        try:
+            # started by the first write only
+            self.assertEqual(storage._sweeper._thread, None)
+            user = User()
+            user['userid'] = 1
+            storage.generate_reset_code(user)
+            self.assertTrue(storage._sweeper._thread.is_alive())
+        finally:
+            storage._sweeper.stop()
+
+    def test_store_reset_code(self):
+        engine = create_engine('sqlite:///:memory:')
+        reset_codes.create(engine)
+        keys = {'username': '1', 'product': 'auth'}
+        now = datetime.datetime.now()
+        expired = now - datetime.timedelta(seconds=1)
+        valid = now + datetime.timedelta(hours=1)
+
+        def _stored():
+            return engine.execute(reset_codes.select()).fetchall()
+
+        self.assertEqual(store_reset_code(engine, reset_codes, keys, 'A',
+                                          expired, overwrite=False), 'A')
+        # an expired code gets replaced
+        self.assertEqual(store_reset_code(engine, reset_codes, keys, 'B',
+                                          valid, overwrite=False), 'B')
+        # not a valid one, unless asked to: it is returned instead
+        self.assertEqual(store_reset_code(engine, reset_codes, keys, 'C',
+                                          valid, overwrite=False), 'B')
+        self.assertEqual([row.reset for row in _stored()], ['B'])
+        self.assertEqual(store_reset_code(engine, reset_codes, keys, 'D',
+                                          valid), 'D')
+        self.assertEqual([row.reset for row in _stored()], ['D'])
+
+    def test_mysql_upsert(self):
+        def _compiled(overwrite):
+            query = _upsert(reset_codes, 'mysql', overwrite)
+            return str(query.compile(dialect=mysql.dialect()))
+
+        self.assertEqual(_compiled(True),
+            'INSERT INTO reset_codes (username, product, reset, expiration) '
+            'VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE '
+            'reset = VALUES(reset), expiration = VALUES(expiration)')
+        # a valid code is kept by the update of the locked row, which
+        # sets the insert id
+        self.assertEqual(_compiled(False),
+            'INSERT INTO reset_codes (username, product, reset, expiration) '
+            'VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE '
+            'reset = IF(expiration > %s, reset, VALUES(reset)), '
+            'expiration = IF(expiration > %s, '
+            'IF(LAST_INSERT_ID(1), expiration, NULL), VALUES(expiration))')
+
+    def test_mysql_store_reset_code(self):
+        import services.resetcodes.rc_sql as rc_sql
+
+        class _Result(object):
+            def __init__(self, rowcount, lastrowid=0, reset=None):
+                self.rowcount = rowcount
+                self.lastrowid = lastrowid
+                self.reset = reset
+
+            def fetchone(self):
+                return self
+
+        class _Engine(object):
+            class dialect(object):
+                name = 'mysql'
+
+        results = []
+        calls = []
+
+        def _execute(engine, query, **params):
+            calls.append(query)
+            return results.pop(0)
+
+        old_safe = rc_sql.safe_execute
+        rc_sql.safe_execute = _execute
+        keys = {'username': '1', 'product': 'auth'}
+        valid = datetime.datetime.now() + datetime.timedelta(hours=1)
+        try:
+            # inserted, or replacing an expired code: a single round trip
+            for rowcount in (1, 2):
+                results[:] = [_Result(rowcount)]
+                self.assertEqual(store_reset_code(_Engine, reset_codes, keys,
+                                                  'A', valid, False), 'A')
+            self.assertEqual(len(calls), 2)
+
+            # kept: the insert id is set, and the stored code is read
+            results[:] = [_Result(1, lastrowid=1), _Result(1, reset='B')]
+            self.assertEqual(store_reset_code(_Engine, reset_codes, keys,
+                                              'A', valid, False), 'B')
+            self.assertEqual(len(calls), 4)
+        finally:
+            rc_sql.safe_execute = old_safe
+
     def test_reset_code_memcache(self):
         if check_memcache() is False:
             raise SkipTest()
@@ -0,0 +1,86 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import time
+
+from services.retry import RetryPolicy, RetryBudget
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_attempts(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=.01, jitter=0)
+        start = time.time()
+        self.assertEqual(list(policy.attempts()), [0, 1, 2])
+        # .01 then .02
+        self.assertTrue(time.time() - start >= .03)
+
+    def test_backoff(self):
+        policy = RetryPolicy(base_delay=.1, max_delay=.3, jitter=0)
+        self.assertEqual([policy.delay(retry) for retry in (1, 2, 3, 4)],
+                         [.1, .2, .3, .3])
+        policy.jitter = .5
+        for i in range(20):
+            self.assertTrue(.1 <= policy.delay(2) <= .2)
+
+    def test_time_budget(self):
+        policy = RetryPolicy(max_attempts=10, base_delay=.05, jitter=0,
+                             time_budget=.1)
+        # .05 fits in the budget, .05 + .1 doesn't
+        self.assertEqual(list(policy.attempts()), [0, 1])
+
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=.5, max_tokens=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+        # the budget is shared by the callers retrying the same resource
+        policy = RetryPolicy(max_attempts=2, base_delay=0, budget_max=1,
+                             budget_ratio=.5)
+        self.assertEqual(list(policy.attempts('db')), [0, 1])
+        self.assertEqual(list(policy.attempts('db')), [0])
+        self.assertEqual(list(policy.attempts('db')), [0, 1])
+        self.assertEqual(list(policy.attempts('other')), [0, 1])
+        self.assertTrue(policy.budget('db') is policy.budget('db'))
+
+        # no budget, no limit
+        policy.budget_max = 0
+        for i in range(5):
+            self.assertEqual(list(policy.attempts('db')), [0, 1])
@@ -44,6 +44,7 @@ from services.tests.support import initenv, cleanupenv
 from services.auth.sql import SQLAuth
 from services.auth import ServicesAuth
 from services.util import ssha, BackendError, safe_execute
+from services.resetcodes import sweeper
 
 ServicesAuth.register(SQLAuth)
 
@@ -106,6 +107,11 @@ class TestSQLAuth(unittest.TestCase):
         self._safe_execute(text(query), expiration=expiration)
         self.assertFalse(self.auth.verify_reset_code(self.user_id, code))
 
+        # the codes live in the users rows, nothing to sweep
+        engines = [key[0] for key in sweeper._SWEEPERS]
+        self.assertFalse(self.auth._engine in engines)
+        self.assertFalse(str(self.auth._engine.url) in engines)
+
     def test_status(self):
         if not isinstance(self.auth, SQLAuth):
             # not supported yet
@@ -38,6 +38,7 @@
 import unittest
 import time
 import os
+import Queue
 
 from nose.plugins.skip import SkipTest
 
@@ -87,6 +88,16 @@ class Request(object):
         self.environ = environ
 
 
+class _Memcache(dict):
+    """Enough of memcache.Client for the SQLUser row cache."""
+    def set(self, key, value, time=0):
+        self[key] = value
+        return True
+
+    def delete(self, key):
+        return self.pop(key, None) is not None
+
+
 class TestUser(unittest.TestCase):
 
     def _tests(self, mgr):
@@ -222,6 +233,44 @@ class TestUser(unittest.TestCase):
         self.assertEquals(mgr.authenticate_user(user2, credentials2),
                           user2_id)
 
+    def _test_resolve_users(self, mgr):
+        names = ['user%d' % i for i in range(5)]
+        for name in names:
+            mgr.delete_user(User(name))
+        ids = [mgr.create_user(name, 'password', '%s@mozilla.com' % name)
+               ['userid'] for name in names[:4]]
+        mgr.delete_user(User(u'user\xe9'))
+        unicode_id = mgr.create_user(u'user\xe9', 'password',
+                                     'user5@mozilla.com')['userid']
+
+        try:
+            found = mgr.resolve_users(names, ['mail'], batch_size=3)
+            self.assertEquals(sorted(found), names[:4])
+            self.assertEquals(found['user1']['userid'], ids[1])
+            self.assertEquals(found['user1']['mail'], 'user1@mozilla.com')
+
+            found = mgr.resolve_users(ids[1:], key='userid', batch_size=2)
+            self.assertEquals(sorted(found), ids[1:])
+            self.assertEquals(found[ids[2]]['username'], 'user2')
+
+            # results are mapped back to the values given, whatever their
+            # type, and invalid values are not found
+            given = [str(ids[1]), long(ids[2]), 'nope']
+            found = mgr.resolve_users(given, key='userid')
+            self.assertEquals(sorted(found), sorted(given[:2]))
+            self.assertEquals(found[given[0]]['username'], 'user1')
+
+            given = [u'user\xe9', 'user\xc3\xa9', 'user1']
+            found = mgr.resolve_users(given)
+            self.assertEquals(len(found), 3)
+            self.assertTrue(found[given[0]] is found[given[1]])
+            self.assertEquals(found[given[1]]['userid'], unicode_id)
+
+            self.assertRaises(ValueError, mgr.resolve_users, ids, key='mail')
+        finally:
+            for name in names + [u'user\xe9']:
+                mgr.delete_user(User(name))
+
     def test_user_memory(self):
         self._tests(load_and_configure(memory_config))
 
@@ -231,10 +280,203 @@ class TestUser(unittest.TestCase):
         except ImportError:
             raise SkipTest
 
-        self._tests(load_and_configure(sql_config))
+        mgr = load_and_configure(sql_config)
+        self._tests(mgr)
+        self._test_resolve_users(mgr)
         if os.path.exists(TEMP_DATABASE_FILE):
             os.unlink(TEMP_DATABASE_FILE)
 
+    def test_user_sql_statements(self):
+        try:
+            from services.user import sql
+        except ImportError:
+            raise SkipTest
+
+        mgr = load_and_configure(sql_config)
+        try:
+            mgr.delete_user(User('user1'))
+            mgr.create_user('user1', 'password1', 'test@mozilla.com')
+            sql._COMPILED.clear()
+
+            # the statements are compiled once per set of attributes
+            for attrs in (['mail', 'syncNode'], ['syncNode', 'mail']):
+                user = User('user1')
+                mgr.authenticate_user(user, 'password1', attrs)
+                self.assertEquals(user['mail'], 'test@mozilla.com')
+                mgr.get_user_info(User('user1'), attrs)
+            self.assertEquals(len(sql._COMPILED), 2)
+
+            mgr.get_user_info(User('user1'), ['mail'])
+            self.assertEquals(len(sql._COMPILED), 3)
+        finally:
+            mgr.delete_user(User('user1'))
+            if os.path.exists(TEMP_DATABASE_FILE):
+                os.unlink(TEMP_DATABASE_FILE)
+
+    def test_user_sql_cache(self):
+        try:
+            import sqlalchemy  # NOQA
+        except ImportError:
+            raise SkipTest
+
+        config = dict(sql_config, cache_size=100)
+        mgr = load_and_configure(config)
+        try:
+            self._tests(mgr)
+
+            user = mgr.create_user('cached', 'password', 'cached@mozilla.com')
+            self.assertEquals(mgr.get_user_info(User('cached'),
+                                                ['mail'])['mail'],
+                              'cached@mozilla.com')
+
+            # the row is served from the cache, whatever the columns asked
+            mgr._engine.execute("update user set mail = 'other@mozilla.com',"
+                                " syncNode = 'node' where username = 'cached'")
+            info = mgr.get_user_info(User('cached'), ['mail', 'syncNode'])
+            self.assertEquals(info['mail'], 'cached@mozilla.com')
+            self.assertEquals(info['syncNode'], None)
+
+            # until the user is updated through the backend
+            mgr.admin_update_field(user, 'accountStatus', 0)
+            info = mgr.get_user_info(User('cached'), ['mail', 'syncNode',
+                                                      'accountStatus'])
+            self.assertEquals(info['mail'], 'other@mozilla.com')
+            self.assertEquals(info['syncNode'], 'node')
+            self.assertEquals(info['accountStatus'], 0)
+
+            # ids given as strings share the cached row, and its
+            # invalidation
+            user_id = user['userid']
+            info = mgr.get_user_info(User(None, str(user_id)), ['mail'])
+            self.assertEquals(info['mail'], 'other@mozilla.com')
+            mgr.admin_update_field(User(None, user_id), 'mail',
+                                   'new@mozilla.com')
+            info = mgr.get_user_info(User(None, str(user_id)), ['mail'])
+            self.assertEquals(info['mail'], 'new@mozilla.com')
+
+            # the rows read back from memcached have the same types
+            mgr._memcache = _Memcache()
+            mgr._forget_user(user_id)
+            fields = ['mail', 'accountStatus', 'syncNode']
+            local = mgr.get_user_info(User(None, user_id), fields)
+            mgr._cache.clear()
+            remote = mgr.get_user_info(User(None, user_id), fields)
+            self.assertEquals(remote, local)
+            self.assertEquals([type(remote[field]) for field in fields],
+                              [type(local[field]) for field in fields])
+            self.assertTrue(isinstance(remote['mail'], str))
+            mgr._memcache = None
+
+            mgr.delete_user(user)
+            info = mgr.get_user_info(User(None, user_id), ['mail'])
+            self.assertEquals(info.get('mail'), None)
+        finally:
+            mgr.delete_user(User('cached'))
+            if os.path.exists(TEMP_DATABASE_FILE):
+                os.unlink(TEMP_DATABASE_FILE)
+
+    def test_user_sql_rehash(self):
+        try:
+            import sqlalchemy  # NOQA
+        except ImportError:
+            raise SkipTest
+
+        from services.util import sscrypt, configure_scrypt, SCRYPT_PARAMS
+
+        def _stored():
+            mgr._rehash_queue.join()
+            return mgr._engine.execute("select password from user where "
+                                       "username = 'rehash'").scalar()
+
+        mgr = load_and_configure(sql_config)
+        old_n = SCRYPT_PARAMS['N']
+        try:
+            user = mgr.create_user('rehash', u'password', 'r@mozilla.com')
+            self.assertTrue(_stored().startswith('{SSCRYPT2}%d$' % old_n))
+
+            # old hashes are upgraded after a successful login
+            mgr.admin_update_field(user, 'password', sscrypt(u'password'))
+            self.assertEquals(mgr.authenticate_user(User('rehash'),
+                                                    u'wrong'), None)
+            self.assertTrue(_stored().startswith('{SSCRYPT}'))
+            self.assertTrue(mgr.authenticate_user(User('rehash'),
+                                                  u'password'))
+            self.assertTrue(_stored().startswith('{SSCRYPT2}%d$' % old_n))
+
+            # and so are the ones made with other parameters
+            configure_scrypt(N=1024)
+            self.assertTrue(mgr.authenticate_user(User('rehash'),
+                                                  u'password'))
+            self.assertTrue(_stored().startswith('{SSCRYPT2}1024$8$1$'))
+            self.assertTrue(mgr.authenticate_user(User('rehash'),
+                                                  u'password'))
+
+            # past rehash_max_queue pending rehashes, they are dropped
+            class _Busy(object):
+                def is_alive(self):
+                    return True
+
+            mgr._rehash_queue = Queue.Queue(1)
+            mgr._rehash_worker = _Busy()
+            mgr._rehash_password(1, 'one', u'password', 'hash')
+            mgr._rehash_password(1, 'one', u'password', 'hash')
+            mgr._rehash_password(2, 'two', u'password', 'hash')
+            self.assertEquals(mgr._rehashing, set([1]))
+            self.assertEquals(mgr._rehash_queue.qsize(), 1)
+        finally:
+            configure_scrypt(N=old_n)
+            mgr.delete_user(User('rehash'))
+            if os.path.exists(TEMP_DATABASE_FILE):
+                os.unlink(TEMP_DATABASE_FILE)
+
+    def test_user_sql_bulk(self):
+        try:
+            import sqlalchemy  # NOQA
+        except ImportError:
+            raise SkipTest
+
+        mgr = load_and_configure(sql_config)
+        names = ['bulk%d' % i for i in range(5)]
+        try:
+            records = [{'username': name, 'password': 'password',
+                        'mail': '%s@mozilla.com' % name}
+                       for name in names[:3]]
+            user = mgr.create_user('hashed', 'secret', 'hashed@mozilla.com')
+            hashed = mgr.get_user_info(user, ['password'])['password']
+            mgr.delete_user(user)
+            records += [{'username': name, 'password_hash': hashed,
+                         'accountStatus': 0} for name in names[3:]]
+
+            self.assertEquals(mgr.import_users(iter(records), batch_size=2),
+                              5)
+            user = User('bulk1')
+            self.assertTrue(mgr.authenticate_user(user, 'password', ['mail']))
+            self.assertEquals(user['mail'], 'bulk1@mozilla.com')
+            user = User('bulk4')
+            mgr.check_account_state = False
+            self.assertTrue(mgr.authenticate_user(user, 'secret'))
+            mgr.check_account_state = True
+
+            exported = list(mgr.export_users(batch_size=2))
+            self.assertEquals([record['username'] for record in exported],
+                              names)
+            self.assertEquals(exported[4]['accountStatus'], 0)
+            self.assertEquals(exported[4]['password_hash'], hashed)
+
+            # a failing batch is rolled back, the previous ones are kept
+            records = [{'username': 'bulk5'}, {'username': 'bulk6'},
+                       {'username': 'bulk7'}, {'username': 'bulk0'}]
+            self.assertRaises(sqlalchemy.exc.IntegrityError,
+                              mgr.import_users, records, batch_size=2)
+            names.extend(['bulk5', 'bulk6', 'bulk7'])
+            exported = [record['username'] for record in mgr.export_users()]
+            self.assertEquals(exported, names[:7])
+        finally:
+            for name in names:
+                mgr.delete_user(User(name))
+            if os.path.exists(TEMP_DATABASE_FILE):
+                os.unlink(TEMP_DATABASE_FILE)
+
     def test_user_ldap(self):
         try:
             import ldap  # NOQA
@@ -248,6 +490,7 @@ class TestUser(unittest.TestCase):
             raise SkipTest
 
         self._tests(mgr)
+        self._test_resolve_users(mgr)
 
     def test_user_sreg(self):
         if not CAN_MOCK_WSGI:
@@ -34,6 +34,7 @@
 # the terms of any one of the MPL, the GPL or the LGPL.
 #
 # ***** END LICENSE BLOCK *****
+import os
 import unittest
 import time
 import urllib2
@@ -41,13 +42,26 @@ import socket
 import StringIO
 import sys
 import warnings
+import thread
+import threading
+from hashlib import sha256
 from test.test_support import check_warnings
 
+import simplejson as json
+from metlog.holder import CLIENT_HOLDER
+from metlog.senders.dev import DebugCaptureSender
+
+from services import util
 from services.util import (function_moved, bigint2time, time2bigint,
                            batch, validate_password, ssha,
                            ssha256, valid_password, get_source_ip,
-                           CatchErrorMiddleware, round_time)
-from services.exceptions import BackendError
+                           CatchErrorMiddleware, round_time, create_engine,
+                           parse_weighted_uris, ReadRouter, safe_execute,
+                           set_deadline, get_time_left, HashPool,
+                           configure_credential_cache, sscrypt2,
+                           configure_scrypt, password_needs_rehash,
+                           register_hash_scheme, randchars)
+from services.exceptions import BackendError, BackendTimeoutError
 from services.tests.support import initenv, cleanupenv
 
 
@@ -176,12 +190,260 @@ class TestUtil(unittest.TestCase):
         self.assertEquals(len(list(batch(range(190)))), 2)
         self.assertEquals(len(list(batch(range(24, 25)))), 1)
 
+    def test_parse_weighted_uris(self):
+        uris = 'sqlite:///one#3\n  sqlite:///two'
+        self.assertEquals(parse_weighted_uris(uris),
+                          [('sqlite:///one', 3), ('sqlite:///two', 1)])
+        self.assertEquals(parse_weighted_uris(['sqlite:///one']),
+                          [('sqlite:///one', 1)])
+
+    def test_read_router(self):
+        def _engine(name):
+            engine = create_engine('sqlite://')
+            engine.execute('create table t (name varchar(10))')
+            engine.execute("insert into t values ('%s')" % name)
+            return engine
+
+        query = 'select name from t'
+        primary = _engine('primary')
+        router = ReadRouter(primary, [(_engine('one'), 2),
+                                      (_engine('two'), 1)], retry_after=.1)
+
+        # weighted round-robin
+        names = [router.execute(query).fetchone().name for i in range(6)]
+        self.assertEquals(names, ['one', 'two', 'one'] * 2)
+
+        # reads about a modified user go to the primary for a while
+        router.written('bob')
+        self.assertEquals(router.execute(query, 'bob').fetchone().name,
+                          'primary')
+        self.assertNotEquals(router.execute(query, 'alice').fetchone().name,
+                             'primary')
+
+        # a request out of time doesn't put the replicas down
+        set_deadline(-1)
+        try:
+            self.assertRaises(BackendTimeoutError, router.execute, query)
+        finally:
+            set_deadline(None)
+        self.assertTrue(all(replica.down_until == 0
+                            for replica in router.replicas))
+
+        # failing replicas are skipped, until retry_after
+        for replica in router.replicas:
+            replica.engine.execute('drop table t')
+        self.assertEquals(router.execute(query).fetchone().name, 'primary')
+        self.assertEquals(router.execute(query).fetchone().name, 'primary')
+        self.assertTrue(router._pick() is None)
+        time.sleep(.1)
+        self.assertTrue(router._pick() is not None)
+
+    def test_sql_metrics(self):
+        engine = create_engine('sqlite://', slow_query_threshold=0)
+        safe_execute(engine, 'create table users (name varchar(10))')
+
+        logger = CLIENT_HOLDER.default_client
+        old_sender = logger.sender
+        logger.sender = DebugCaptureSender()
+        try:
+            safe_execute(engine, "select * from users")
+            msgs = [json.loads(msg) for msg in logger.sender.msgs]
+        finally:
+            logger.sender = old_sender
+
+        names = [msg['fields'].get('name') for msg in msgs]
+        self.assertTrue('services.util.sql.checkout_wait' in names)
+        self.assertTrue('services.util.sql.query.select' in names)
+        self.assertTrue('services.util.sql.slow_query.select' in names)
+        slow = [msg for msg in msgs if msg['type'] == 'oldstyle']
+        self.assertTrue('select * from users' in slow[0]['payload'])
+
+    def test_deadline(self):
+        engine = create_engine('sqlite://', statement_timeout=5)
+        self.assertEquals(engine.statement_timeout, 5.)
+        self.assertTrue(get_time_left() is None)
+
+        set_deadline(10)
+        try:
+            self.assertTrue(9 < get_time_left() <= 10)
+            self.assertEquals(safe_execute(engine, 'select 1').scalar(), 1)
+
+            # past the deadline, queries don't even start
+            set_deadline(-1)
+            self.assertRaises(BackendTimeoutError, safe_execute, engine,
+                              'select 1')
+        finally:
+            set_deadline(None)
+
+        self.assertTrue(get_time_left() is None)
+        self.assertEquals(safe_execute(engine, 'select 1').scalar(), 1)
+
+    def test_mysql_timeout_hint(self):
+        from sqlalchemy import Table, Column, Integer, MetaData, select
+        from sqlalchemy.dialects import mysql
+        table = Table('t', MetaData(), Column('id', Integer))
+        query = util._mysql_timeout_hint(select([table.c.id]), 1.2)
+        self.assertEquals(str(query.compile(dialect=mysql.dialect())),
+                          'SELECT /*+ MAX_EXECUTION_TIME(1200) */ t.id '
+                          '\nFROM t')
+        self.assertEquals(util._mysql_timeout_hint('select 1', .0001),
+                          'select /*+ MAX_EXECUTION_TIME(1) */ 1')
+        # only the SELECTs get a hint
+        for query in ('delete from t', table.delete()):
+            self.assertTrue(util._mysql_timeout_hint(query, 1) is query)
+        query = select([table.c.id])
+        self.assertTrue(util._mysql_timeout_hint(query, None) is query)
+
+    def test_hash_pool(self):
+        pool = HashPool(size=2, max_queue=1)
+        self.assertEquals(pool.run(sha256, 'x').digest(),
+                          sha256('x').digest())
+
+        # admission control
+        def _nested():
+            return pool.run(sha256, 'y')
+
+        self.assertRaises(BackendError, pool.run, _nested)
+        self.assertEquals(pool.pending, 0)
+
+        # with gevent, the hashes run in native threads
+        try:
+            from gevent.threadpool import ThreadPool
+        except ImportError:
+            return
+        threads = ThreadPool(2)
+        pool._get_pool = lambda: threads
+        self.assertNotEquals(pool.run(thread.get_ident), thread.get_ident())
+
+        # a resized pool lets the threads of the previous one go
+        pool._pool, pool._pid = threads, os.getpid()
+        pool.resize(3)
+        self.assertEquals(pool.size, 3)
+        self.assertTrue(pool._pool is None)
+        self.assertEquals(threads.size, 0)
+
+    def test_hash_pool_creation(self):
+        created = []
+
+        def _thread_pool(size):
+            created.append(size)
+            time.sleep(.05)
+            return object()
+
+        old = util.ThreadPool, util.is_module_patched
+        util.ThreadPool = _thread_pool
+        util.is_module_patched = lambda name: True
+        try:
+            pool = HashPool(size=2)
+            # concurrent first hashes share a single pool
+            results = []
+            workers = [threading.Thread(
+                           target=lambda: results.append(pool._get_pool()))
+                       for i in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            util.ThreadPool, util.is_module_patched = old
+        self.assertEquals(created, [2])
+        self.assertEquals(len(set(map(id, results))), 1)
+
     def test_validate_password(self):
         one = ssha('one')
         two = ssha256('two')
         self.assertTrue(validate_password('one', one))
         self.assertTrue(validate_password('two', two))
 
+    def test_credential_cache(self):
+        from services import util
+        calls = []
+        old_ssha = util.ssha
+
+        def _ssha(password, salt=None):
+            calls.append(password)
+            return old_ssha(password, salt)
+
+        util.ssha = _ssha
+        try:
+            one = old_ssha('one')
+            self.assertTrue(validate_password('one', one))
+            self.assertTrue(validate_password('one', one))
+            self.assertEqual(len(calls), 1)
+
+            # failures are never cached
+            self.assertFalse(validate_password('two', one))
+            self.assertFalse(validate_password('two', one))
+            self.assertEqual(len(calls), 3)
+
+            # a new hash for the same password is checked again
+            self.assertTrue(validate_password('one', old_ssha('one')))
+            self.assertEqual(len(calls), 4)
+
+            configure_credential_cache(size=0)
+            self.assertTrue(validate_password('one', one))
+            self.assertEqual(len(calls), 5)
+        finally:
+            util.ssha = old_ssha
+            configure_credential_cache(size=1000)
+
+    def test_hash_schemes(self):
+        hashed = sscrypt2(u'one', N=1024, r=4, p=2)
+        self.assertTrue(hashed.startswith('{SSCRYPT2}1024$4$2$'))
+        self.assertTrue(len(hashed) <= 128)
+        self.assertTrue(validate_password(u'one', hashed))
+        self.assertFalse(validate_password(u'two', hashed))
+        self.assertFalse(validate_password(u'one', '{SSCRYPT2}1024$4$xx'))
+
+        # the stored key length is used, whatever the current one is
+        longer = sscrypt2(u'one', N=1024, r=4, p=2, length=64)
+        self.assertTrue(validate_password(u'one', longer))
+        self.assertFalse(validate_password(u'two', longer))
+        self.assertFalse(validate_password(u'one', '{UNKNOWN}xx'))
+
+        self.assertTrue(password_needs_rehash(ssha256(u'one')))
+        self.assertTrue(password_needs_rehash(hashed))
+        self.assertFalse(password_needs_rehash(sscrypt2(u'one')))
+        self.assertRaises(ValueError, configure_scrypt, N=1000)
+
+        register_hash_scheme('{PLAIN}', lambda clear, hash: clear == hash[7:])
+        self.assertTrue(validate_password(u'one', '{PLAIN}one'))
+        self.assertFalse(validate_password(u'two', '{PLAIN}one'))
+        from services import util
+        del util._HASH_SCHEMES['{PLAIN}']
+
+    def test_randchars(self):
+        from services import util
+        from services.resetcodes import ResetCode
+        calls = []
+        old_urandom = util.os.urandom
+
+        def _urandom(size):
+            calls.append(size)
+            return old_urandom(size)
+
+        util.os.urandom = _urandom
+        util.RANDOM_POOL._pid = None
+        try:
+            # 100 salts and 20 reset codes used to take 1120 system calls
+            for i in range(100):
+                self.assertEqual(len(util._gensalt()), 8)
+            codes = [ResetCode()._generate_reset_code() for i in range(20)]
+            self.assertTrue(len(calls) <= 10, len(calls))
+            for code in codes:
+                self.assertTrue(ResetCode()._check_reset_code(code))
+
+            # a forked process gets new bytes
+            util.RANDOM_POOL._pid = -1
+            del calls[:]
+            randchars(1)
+            self.assertEqual(calls, [256])
+        finally:
+            util.os.urandom = old_urandom
+
+        self.assertEqual(set(randchars(1000, 'ab')), set('ab'))
+        self.assertEqual(len(randchars(1000)), 1000)
+
     def test_valid_password(self):
         self.assertFalse(valid_password(u'tarek', u'xx'))
         self.assertFalse(valid_password(u't' * 8, u't' * 8))
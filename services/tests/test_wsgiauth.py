@@ -37,11 +37,15 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import base64
+import time
+import simplejson as json
 
 from webob import Response
 from webob.exc import HTTPUnauthorized, HTTPException
 
 from services.config import Config
+from services.authcache import AuthCache
+from services.events import notify, USER_CHANGED
 from services.wsgiauth import Authentication
 from services.auth.dummy import DummyAuth
 from services.user.memory import MemoryUser
@@ -243,6 +247,50 @@ class AuthAPITestCases(object):
         self.set_credentials(req, "user", "goodpwd")
         self.assertRaises(HTTPException, auth.check, req, {"auth": "True"})
 
+    def test_auth_cache(self):
+        config = self.make_config({"auth_cache.size": 10,
+                                   "auth.check_node": True})
+        auth = self.auth_class(config)
+        calls = []
+        authenticate_user = auth.backend.authenticate_user
+
+        def _authenticate_user(*args):
+            calls.append(args)
+            return authenticate_user(*args)
+
+        auth.backend.authenticate_user = _authenticate_user
+
+        # successful credentials only hit the backend once
+        for i in range(3):
+            req = make_request("/1.0/user/info/collections", host="localhost")
+            self.set_credentials(req, "user", "goodpwd")
+            auth.check(req, {"auth": "True"})
+            self.assertEquals(req.user["username"], "user")
+            self.assertEquals(req.user["userid"], 1)
+        self.assertEquals(len(calls), 1)
+
+        # failures are never cached
+        for i in range(2):
+            req = make_request("/1.0/user/info/collections", host="localhost")
+            self.set_credentials(req, "user", "badpwd")
+            self.assertRaises(HTTPException, auth.check, req,
+                              {"auth": "True"})
+        self.assertEquals(len(calls), 3)
+
+        # and the cached node is checked
+        req = make_request("/1.0/user/info/collections", host="badnode")
+        self.set_credentials(req, "user", "goodpwd")
+        self.assertRaises(HTTPException, auth.check, req, {"auth": "True"})
+        self.assertEquals(len(calls), 4)
+
+        # the entries of a changed user are dropped
+        notify(USER_CHANGED, 1)
+        for i in range(2):
+            req = make_request("/1.0/user/info/collections", host="localhost")
+            self.set_credentials(req, "user", "goodpwd")
+            auth.check(req, {"auth": "True"})
+        self.assertEquals(len(calls), 5)
+
 
 class HTTPBasicAuthAPITestCases(AuthAPITestCases):
     """TestCases for the public Authentication API using HTTP-Basic-Auth.
@@ -341,10 +389,104 @@ class TestAuthentication_NewStyleAuth(TestAuthentication):
                         'services.tests.test_wsgiauth.BadPasswordUserTool'
 
 
+class _Memcache(dict):
+    """Enough of memcache.Client for AuthCache, shared by the caches."""
+    def set(self, key, value, time=0):
+        self[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        if key in self:
+            return False
+        self[key] = value
+        return True
+
+
+class TestAuthCache(unittest.TestCase):
+
+    def _caches(self, **kw):
+        memcached = _Memcache()
+        caches = []
+        for i in range(2):
+            cache = AuthCache(size=10, secret_key='x' * 32, **kw)
+            cache._memcache = memcached
+            caches.append(cache)
+        return memcached, caches
+
+    def test_memcached_entries(self):
+        data = {'username': 'user', 'userid': 1, 'syncNode': None}
+        memcached, (one, two) = self._caches()
+        one.set('user', 'password', data)
+        self.assertEquals(two.get('user', 'password'), data)
+
+        # forgotten by another process, once the window is over
+        one.forget(1)
+        self.assertEquals(two.get('user', 'password'), data)
+        two._generations.clear()
+        self.assertEquals(two.get('user', 'password'), None)
+
+        # a lost generation invalidates the entries made with it
+        one.set('user', 'password', data)
+        self.assertEquals(two.get('user', 'password'), data)
+        memcached.pop(one._generation_key(1))
+        one._generations.clear()
+        two._generations.clear()
+        self.assertEquals(two.get('user', 'password'), None)
+        self.assertEquals(one.get('user', 'password'), None)
+
+        # the entries of memcached are not kept longer in the process
+        one.set('user', 'password', data)
+        key = one._key('user', 'password')
+        entry = json.loads(memcached[one.cache_prefix + key])
+        entry[1] = time.time() - 1
+        memcached[one.cache_prefix + key] = json.dumps(entry)
+        two._cache.clear()
+        self.assertEquals(two.get('user', 'password'), None)
+        entry[1] = time.time() + 1
+        memcached[one.cache_prefix + key] = json.dumps(entry)
+        self.assertEquals(two.get('user', 'password'), data)
+        self.assertTrue(two._cache._items[key][0] < entry[1] + 1)
+
+    def test_generation_window(self):
+        data = {'username': 'user', 'userid': 1, 'syncNode': None}
+        memcached, (one, two) = self._caches()
+        one.set('user', 'password', data)
+        self.assertEquals(two.get('user', 'password'), data)
+
+        # local hits don't go to memcached until the window is over
+        calls = []
+        get = memcached.get
+        memcached.get = lambda key: calls.append(key) or get(key)
+        self.assertEquals(two.get('user', 'password'), data)
+        self.assertEquals(calls, [])
+
+    def test_auth_cache_invalidation(self):
+        # the memcached entries would be usable by everyone
+        self.assertRaises(ValueError, AuthCache,
+                          cache_servers='127.0.0.1:11211')
+
+        cache = AuthCache(size=10)
+        backend = MemoryUser()
+        user = backend.create_user(u'user', u'password', u'u@example.com')
+        data = {'username': 'user', 'userid': user['userid'],
+                'syncNode': None}
+
+        cache.set('user', 'password', data)
+        self.assertEquals(cache.get('user', 'password'), data)
+        backend.admin_update_password(user, u'newpassword')
+        self.assertEquals(cache.get('user', 'password'), None)
+
+        cache.set('user', 'newpassword', data)
+        self.assertEquals(cache.get('user', 'newpassword'), data)
+        backend.delete_user(user)
+        self.assertEquals(cache.get('user', 'newpassword'), None)
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestAuthentication))
     suite.addTest(unittest.makeSuite(TestAuthentication_NewStyleAuth))
+    suite.addTest(unittest.makeSuite(TestAuthCache))
     return suite
 
 
@@ -230,3 +230,23 @@ def _password_to_credentials(func):
             credentials = {"username": username, "password": credentials}
         return func(self, user, credentials, *args, **kwds)
     return wrapped_method
+
+
+def _lookup_key(key, value):
+    """Returns the value of a user name or id, normalized so that the
+    values given by the callers and the ones read from the backends
+    compare equal: ids as ints, names as unicode. None if it's invalid.
+    """
+    if key == 'userid':
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if isinstance(value, str):
+        try:
+            return value.decode('utf8')
+        except UnicodeDecodeError:
+            return None
+    if isinstance(value, unicode):
+        return value
+    return None
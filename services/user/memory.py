@@ -39,6 +39,7 @@
 import random
 from services.user import User, _password_to_credentials
 from services.exceptions import BackendError
+from services.events import notify, USER_CHANGED
 
 
 class MemoryUser(object):
@@ -138,6 +139,8 @@ class MemoryUser(object):
 
         self._users[user_name][key] = value
         user[key] = value
+        if key == 'password':
+            notify(USER_CHANGED, self._users[user_name]['userid'])
 
         return True
 
@@ -150,6 +153,8 @@ class MemoryUser(object):
 
         self._users[user_name][key] = value
         user[key] = value
+        if key == 'password':
+            notify(USER_CHANGED, self._users[user_name]['userid'])
 
         return True
 
@@ -174,6 +179,6 @@ class MemoryUser(object):
 
         user_name = user.get("username")
         if user_name in self._users:
-            del self._users[user_name]
+            notify(USER_CHANGED, self._users.pop(user_name)['userid'])
             return True
         return False
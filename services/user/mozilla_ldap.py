@@ -38,13 +38,17 @@
 """
 from hashlib import sha1
 import random
+from threading import Lock
 
 import ldap
+from ldap.filter import escape_filter_chars
 
 from metlog.holder import CLIENT_HOLDER
-from services.user import User, _password_to_credentials
-from services.util import BackendError, ssha
-from services.ldappool import ConnectionManager
+from services.user import User, _password_to_credentials, _lookup_key
+from services.util import BackendError, ssha, batch
+from services.ldappool import ConnectionManager, AUTH_MODES, backend_error
+from services.cache import LRUCache, MISSING
+from services.events import notify, USER_CHANGED
 
 
 class LDAPUser(object):
@@ -52,22 +56,69 @@ class LDAPUser(object):
 
     def __init__(self, ldapuri, allow_new_users=True,
                  users_root='ou=users,dc=mozilla', check_account_state=True,
-                 ldap_timeout=10, search_root='dc=mozilla', **kw):
+                 ldap_timeout=10, search_root='dc=mozilla', auth_mode='pool',
+                 bind_check_size=5, dn_cache_size=0, dn_cache_ttl=300,
+                 dn_cache_negative_ttl=10, id_block_size=1, **kw):
         self.allow_new_users = allow_new_users
         self.check_account_state = check_account_state
         self.users_root = users_root
         self.search_root = search_root
         self.ldap_timeout = ldap_timeout
         self.logger = CLIENT_HOLDER.default_client
+        # user name -> (dn, user id) lookups, unknown users included
+        self._dn_cache = LRUCache(dn_cache_size, dn_cache_ttl)
+        self.dn_cache_negative_ttl = float(dn_cache_negative_ttl)
+        # user ids reserved by this process, and not handed out yet
+        self.id_block_size = int(id_block_size)
+        self._next_id = self._last_id = 0
+        self._id_lock = Lock()
 
         kw.pop("check_node", None)
         self.conn = ConnectionManager(ldapuri, **kw)
 
-    def _conn(self, bind=None, passwd=None):
-        return self.conn.connection(bind, passwd)
+        # user binds can be kept away from the admin/search pool
+        if auth_mode not in AUTH_MODES:
+            raise ValueError('Unknown LDAP auth mode %r' % auth_mode)
+        self.auth_mode = auth_mode
+        if auth_mode == 'pool':
+            self.bind_check = self.conn
+        else:
+            for option in ('bind', 'passwd', 'size', 'use_pool', 'min_idle',
+                           'maintenance_interval', 'use_async'):
+                kw.pop(option, None)
+            self.bind_check = ConnectionManager(ldapuri, size=bind_check_size,
+                                                use_pool=True, **kw)
+
+    def _conn(self, bind=None, passwd=None, write=False):
+        return self.conn.connection(bind, passwd, write=write)
+
+    def _user_conn(self, bind, passwd, write=False):
+        """Returns a connector bound as a user.
+
+        Unless the auth mode is "pool", these come from the dedicated
+        bind-check connectors instead of the admin/search pool.
+        """
+        if self.bind_check is self.conn or passwd is None:
+            return self._conn(bind, passwd, write=write)
+        return self.bind_check.connection(bind, passwd, write=write)
 
     def _purge_conn(self, bind, passwd=None):
         self.conn.purge(bind, passwd=None)
+        if self.bind_check is not self.conn:
+            self.bind_check.purge(bind, passwd=None)
+
+    def _compare_password(self, dn, password):
+        """Checks a user password with an LDAP compare on the admin pool."""
+        if isinstance(password, unicode):
+            password = password.encode('utf8')
+        with self._conn() as conn:
+            try:
+                return bool(conn.compare_s(dn, 'userPassword', password))
+            except ldap.NO_SUCH_OBJECT:
+                return False
+            except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
+                self.logger.debug('Could not compare the user password.')
+                raise backend_error(e)
 
     def get_user_id(self, user):
         """Returns the id for a user name"""
@@ -125,12 +176,15 @@ class LDAPUser(object):
         #need to turn the user hash into tuples
         user = user.items()
 
-        with self._conn() as conn:
+        with self._conn(write=True) as conn:
             try:
                 res, __ = conn.add_s(dn, user)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not create the user.')
-                raise BackendError(str(e))
+                raise backend_error(e)
+
+        # the name was cached as unknown by the check above
+        self._dn_cache.delete(user_name)
 
         if res == ldap.RES_ADD:
             return userobj
@@ -166,8 +220,16 @@ class LDAPUser(object):
         if self.check_account_state and 'account-enabled' not in attrs:
             attrs.append('account-enabled')
 
+        if self.auth_mode == 'compare':
+            if not self._compare_password(dn, password):
+                return None
+            # the password is good, let's read the entry as admin
+            user_conn = self._conn()
+        else:
+            user_conn = self._user_conn(dn, password)
+
         try:
-            with self._conn(dn, password) as conn:
+            with user_conn as conn:
                 result = conn.search_st(dn, ldap.SCOPE_BASE,
                                       attrlist=attrs,
                                       timeout=self.ldap_timeout)
@@ -175,7 +237,7 @@ class LDAPUser(object):
             return None
         except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
             self.logger.debug('Could not authenticate the user.')
-            raise BackendError(str(e))
+            raise backend_error(e)
 
         if result is None:
             return None
@@ -214,7 +276,7 @@ class LDAPUser(object):
                                      timeout=self.ldap_timeout)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not get the user info in ldap.')
-                raise BackendError(str(e))
+                raise backend_error(e)
             except ldap.NO_SUCH_OBJECT:
                 return user
 
@@ -226,6 +288,65 @@ class LDAPUser(object):
             user[attr] = res.get(attr, [None])[0]
         return user
 
+    def resolve_users(self, values, attrs=None, key='username',
+                      batch_size=100):
+        """Returns the users matching many user names, or user ids.
+
+        Runs one search per batch of batch_size values, with an OR filter.
+
+        Args:
+            values: the user names, or user ids, to look up
+            attrs: the pieces of data requested
+            key: 'username' or 'userid', depending on what values are
+
+        Returns:
+            a mapping of the values found, as given, to their user object
+        """
+        if key == 'username':
+            ldap_key = 'uid'
+        elif key == 'userid':
+            ldap_key = 'uidNumber'
+        else:
+            raise ValueError('Unknown key %r' % key)
+        if attrs is None:
+            attrs = []
+
+        # the values as the caller gave them, by normalized value, since
+        # the entries come back as utf8 strings
+        wanted = {}
+        for value in values:
+            normalized = _lookup_key(key, value)
+            if normalized is not None:
+                wanted.setdefault(normalized, []).append(value)
+        attrlist = ['uid', 'uidNumber'] + [attr for attr in attrs
+                                          if attr not in ('uid', 'uidNumber')]
+        found = {}
+        for chunk in batch(wanted, batch_size):
+            terms = [u'(%s=%s)' % (ldap_key, escape_filter_chars(unicode(v)))
+                     for v in chunk]
+            filter = (u'(|%s)' % u''.join(terms)).encode('utf8')
+            with self._conn() as conn:
+                try:
+                    res = conn.search_st(self.search_root, ldap.SCOPE_SUBTREE,
+                                         filterstr=filter, attrlist=attrlist,
+                                         timeout=self.ldap_timeout)
+                except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
+                    self.logger.debug('Could not get the users from ldap')
+                    raise backend_error(e)
+                except ldap.NO_SUCH_OBJECT:
+                    continue
+
+            for dn, entry in res or ():
+                user = User(entry['uid'][0], entry['uidNumber'][0])
+                user['dn'] = dn
+                for attr in attrs:
+                    user[attr] = entry.get(attr, [None])[0]
+                self._dn_cache.set(user['username'], (dn, user['userid']))
+
+                for value in wanted.get(_lookup_key(key, user[key]), ()):
+                    found[value] = user
+        return found
+
     @_password_to_credentials
     def update_field(self, user, credentials, key, value):
         """Change the value of a user's field
@@ -311,18 +432,21 @@ class LDAPUser(object):
             return True
 
         try:
-            with self._conn() as conn:
+            with self._conn(write=True) as conn:
                 try:
                     res, __ = conn.delete_s(dn)
                 except ldap.NO_SUCH_OBJECT:
                     return False
                 except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                     self.logger.debug('Could not delete the user in ldap')
-                    raise BackendError(str(e))
+                    raise backend_error(e)
         except ldap.INVALID_CREDENTIALS:
             return False
 
+        if user.get('username'):
+            self._dn_cache.delete(user['username'])
         self._purge_conn(dn)
+        notify(USER_CHANGED, user.get('userid'))
         return res == ldap.RES_DELETE
 
     def _modify_record(self, user, key, value, ldap_user=None, ldap_pass=None):
@@ -348,13 +472,18 @@ class LDAPUser(object):
 
         action = [(ldap.MOD_REPLACE, key, value)]
 
+        if ldap_user is None:
+            modify_conn = self._conn(write=True)
+        else:
+            modify_conn = self._user_conn(ldap_user, ldap_pass, write=True)
+
         try:
-            with self._conn(ldap_user, ldap_pass) as conn:
+            with modify_conn as conn:
                 try:
                     res, __ = conn.modify_s(dn, action)
                 except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                     self.logger.debug('Could not update the password in ldap.')
-                    raise BackendError(str(e))
+                    raise backend_error(e)
         except ldap.INVALID_CREDENTIALS:
             return False
 
@@ -362,6 +491,8 @@ class LDAPUser(object):
             return False
 
         user[key] = value
+        if key == 'userPassword':
+            notify(USER_CHANGED, user.get('userid'))
         return True
 
     def _get_dn(self, user):
@@ -387,6 +518,13 @@ class LDAPUser(object):
             #we have nothing to do a search on
             return None
 
+        cached = self._dn_cache.get(user_name, MISSING)
+        if cached is None:
+            return None
+        elif cached is not MISSING:
+            user['dn'], user['userid'] = cached
+            return user['dn']
+
         dn = self.search_root
         scope = ldap.SCOPE_SUBTREE
         filter = '(uid=%s)' % user_name
@@ -398,28 +536,50 @@ class LDAPUser(object):
                                      attrlist=attrs, timeout=self.ldap_timeout)
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
                 self.logger.debug('Could not get the user info from ldap')
-                raise BackendError(str(e))
+                raise backend_error(e)
             except ldap.NO_SUCH_OBJECT:
-                return None
+                res = None
 
         if res is None or len(res) == 0:
+            self._dn_cache.set(user_name, None, self.dn_cache_negative_ttl)
             return None
 
         #dn is actually the first element that comes back. Don't need attr
         user['dn'] = res[0][0]
         user['userid'] = res[0][1]['uidNumber'][0]
+        self._dn_cache.set(user_name, (user['dn'], user['userid']))
         return user['dn']
 
     def _get_next_user_id(self):
+        """
+        Hands out the next user id from the block reserved by this process,
+        and reserves a new block of id_block_size ids when it's exhausted.
+
+        Ids left in a block when the process stops are never used.
+
+        Args:
+            none
+        Returns:
+            the next user id
+        """
+        with self._id_lock:
+            if self._next_id >= self._last_id:
+                self._next_id = self._reserve_user_ids(self.id_block_size)
+                self._last_id = self._next_id + self.id_block_size
+            user_id = self._next_id
+            self._next_id += 1
+            return user_id
+
+    def _reserve_user_ids(self, count):
         """
         Does a ldap delete, atomically followed by an ldap add. This is so the
         delete will fail if you have a race condition and someone else
         incremented between the read and write.
 
         Args:
-            none
+            count: how many ids to reserve
         Returns:
-            the next user id
+            the first reserved id
         """
         dn = 'cn=maxuid,ou=users,dc=mozilla'
 
@@ -431,16 +591,17 @@ class LDAPUser(object):
         previous_loop_value = None
 
         while flag < 10:
-            # get the value
+            # get the value - from the master, since replicas may lag
             try:
-                with self._conn() as conn:
+                with self._conn(write=True) as conn:
                     record = conn.search_st(dn, ldap.SCOPE_BASE,
                                           attrlist=['uidNumber'],
                                           timeout=self.ldap_timeout)
             except (ldap.NO_SUCH_OBJECT, ldap.INVALID_CREDENTIALS):
                 raise BackendError("No record found to get next id")
             except (ldap.TIMEOUT, ldap.SERVER_DOWN, ldap.OTHER), e:
-                raise BackendError("LDAP problem getting next id: %s" % str(e))
+                raise backend_error(e, "LDAP problem getting next id: %s" %
+                                    str(e))
 
             if record is None:
                 raise BackendError("No record found to get next id")
@@ -454,14 +615,14 @@ class LDAPUser(object):
                 raise BackendError('unable to generate new account')
             previous_loop_value = value
 
-            new_value = int(value) + 1
+            new_value = int(value) + count
 
             #remove the old value (which will fail if it isn't there) and
             #atomically add the new one
             old = (ldap.MOD_DELETE, 'uidNumber', value)
             new = (ldap.MOD_ADD, 'uidNumber', str(new_value))
 
-            with self._conn() as conn:
+            with self._conn(write=True) as conn:
                 try:
                     conn.modify_s(dn, [old, new])
                     #if we don't bomb out here, we have a valid id
@@ -472,5 +633,5 @@ class LDAPUser(object):
                     flag = flag + 1
                     continue
                 except ldap.LDAPError, e:
-                    raise BackendError(str(e))
+                    raise backend_error(e)
         raise BackendError("Unable to get new id after 10 tries")
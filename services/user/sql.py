@@ -39,20 +39,36 @@
 Users are stored with digest password (scrypt)
 """
 
+import threading
 import urlparse
+import Queue
+import simplejson as json
 
 from sqlalchemy import Integer, String
 from sqlalchemy.interfaces import PoolListener
 from sqlalchemy.ext.declarative import declarative_base, Column
-from sqlalchemy.sql import bindparam, select, insert, update, delete
+from sqlalchemy.sql import (bindparam, select, insert, update, delete,
+                            and_)
 from sqlalchemy.sql import text as sqltext
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, DBAPIError
 from sqlalchemy.pool import NullPool
 
-from services.util import (validate_password, sscrypt,
-                           safe_execute, create_engine)
-from services.user import User, _password_to_credentials
+from metlog.holder import CLIENT_HOLDER
+
+from services.util import (validate_password, sscrypt2,
+                           safe_execute, create_engine, batch,
+                           parse_weighted_uris, ReadRouter,
+                           password_needs_rehash,
+                           _is_operational_db_error)
+from services.user import User, _password_to_credentials, _lookup_key
 from services.exceptions import BackendError
+from services.cache import LRUCache
+from services.events import notify, USER_CHANGED
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
 
 _Base = declarative_base()
 tables = []
@@ -79,6 +95,56 @@ _USER_ID = select([users.c.userid], users.c.username == bindparam('username'))
 
 _USER_NAME = select([users.c.username], users.c.userid == bindparam('userid'))
 
+# columns of the bulk import and export records
+_BULK_FIELDS = {'userid': None, 'username': None, 'password': None,
+                'accountStatus': 1, 'mail': None, 'mailVerified': 0,
+                'syncNode': None}
+
+
+def _user_auth(attrs):
+    fields = [users.c.userid, users.c.password, users.c.accountStatus]
+    fields.extend(getattr(users.c, attr) for attr in sorted(attrs))
+    return select(fields, users.c.username == bindparam('username'))
+
+
+def _user_info(attrs):
+    fields = [getattr(users.c, attr) for attr in sorted(attrs)]
+    return select(fields, users.c.userid == bindparam('user_id'))
+
+
+# columns kept in the user info cache
+_CACHED_FIELDS = ('username', 'accountStatus', 'mail', 'mailVerified',
+                  'syncNode')
+
+
+def _cache_row(row):
+    """Returns a user info row with the types it has once read back from
+    memcached, whatever the driver returned: utf8 strings and ints."""
+    normalized = {}
+    for attr, value in row.items():
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        elif isinstance(value, (int, long)):
+            value = int(value)
+        normalized[str(attr)] = value
+    return normalized
+
+
+# statements built from the requested attributes, compiled once per
+# database driver and shared by all the SQLUser instances
+_COMPILED = {}
+
+
+def _compiled(engine, build, attrs):
+    """Returns the statement built for attrs, compiled for the engine."""
+    attrs = frozenset(attrs)
+    key = engine.dialect.name, engine.dialect.driver, build, attrs
+    statement = _COMPILED.get(key)
+    if statement is None:
+        statement = build(attrs).compile(dialect=engine.dialect)
+        _COMPILED[key] = statement
+    return statement
+
 
 class SetTextFactory(PoolListener):
     """This ensures strings are not converted to unicode on queries
@@ -93,8 +159,13 @@ class SQLUser(object):
 
     def __init__(self, sqluri=_SQLURI, pool_size=20, pool_recycle=60,
                  check_account_state=True, create_tables=True, no_pool=False,
-                 allow_new_users=True, **kw):
-        sqlkw = {'logging_name': 'weaveserver'}
+                 allow_new_users=True, read_sqluris=None,
+                 replica_retry_after=30, read_write_window=5,
+                 slow_query_threshold=None, cache_size=0, cache_ttl=60,
+                 cache_servers=None, cache_prefix='SQLUser/',
+                 rehash_passwords=True, rehash_max_queue=100, **kw):
+        sqlkw = {'logging_name': 'weaveserver',
+                 'slow_query_threshold': slow_query_threshold}
         if sqluri.startswith('sqlite'):
             sqlkw['listeners'] = [SetTextFactory()]
         else:
@@ -107,6 +178,12 @@ class SQLUser(object):
         if no_pool or sqluri.startswith('sqlite'):
             sqlkw['poolclass'] = NullPool
 
+        # outdated hashes are upgraded in the background at login
+        self.rehash_passwords = rehash_passwords
+        self._rehash_queue = Queue.Queue(int(rehash_max_queue))
+        self._rehash_lock = threading.Lock()
+        self._rehashing = set()
+        self._rehash_worker = None
         self.check_account_state = check_account_state
         self.allow_new_users = allow_new_users
         self._engine = create_engine(sqluri, **sqlkw)
@@ -115,6 +192,65 @@ class SQLUser(object):
             users.create(checkfirst=True)
         self.sqluri = sqluri
 
+        # read-only lookups can go to replicas
+        read_engines = []
+        if read_sqluris is not None:
+            for uri, weight in parse_weighted_uris(read_sqluris):
+                read_engines.append((create_engine(uri, **sqlkw), weight))
+        self._reads = ReadRouter(self._engine, read_engines,
+                                 retry_after=replica_retry_after,
+                                 write_window=read_write_window)
+
+        # user info rows, per user id, optionally shared through memcached
+        self._cache = LRUCache(cache_size, cache_ttl)
+        self.cache_ttl = int(cache_ttl)
+        self.cache_prefix = cache_prefix
+        if isinstance(cache_servers, str):
+            cache_servers = cache_servers.split()
+        if cache_servers and self._cache.size > 0:
+            if memcache is None:
+                raise ValueError('cache_servers needs python-memcached')
+            self._memcache = memcache.Client(cache_servers)
+        else:
+            self._memcache = None
+
+    # the cached rows are keyed by int(user_id), since the ids come as
+    # strings or longs too
+
+    def _get_cached_row(self, user_id):
+        user_id = int(user_id)
+        row = self._cache.get(user_id)
+        if row is None and self._memcache is not None:
+            data = self._memcache.get(self.cache_prefix + str(user_id))
+            if data is not None:
+                row = _cache_row(json.loads(data))
+                self._cache.set(user_id, row)
+        return row
+
+    def _set_cached_row(self, user_id, row):
+        """Caches a user info row, and returns it as cached."""
+        user_id = int(user_id)
+        row = _cache_row(row)
+        self._cache.set(user_id, row)
+        if self._memcache is not None:
+            self._memcache.set(self.cache_prefix + str(user_id),
+                               json.dumps(row), self.cache_ttl)
+        return row
+
+    def _forget_user(self, user_id):
+        """Drops a user from the user info cache."""
+        if self._cache.size == 0:
+            return
+        user_id = int(user_id)
+        self._cache.delete(user_id)
+        if self._memcache is not None:
+            self._memcache.delete(self.cache_prefix + str(user_id))
+
+    def _written(self, user):
+        """Sends the next reads about this user to the primary."""
+        self._reads.written(('userid', user.get('userid')),
+                            ('username', user.get('username')))
+
     def get_user_id(self, user):
         """Returns the id for a user name"""
         user_id = user.get('userid')
@@ -125,8 +261,8 @@ class SQLUser(object):
         if username is None:
             return None
 
-        res = safe_execute(self._engine, _USER_ID,
-                           username=username).fetchone()
+        res = self._reads.execute(_USER_ID, ('username', username),
+                                  username=username).fetchone()
         if res is None:
             return None
         user['userid'] = res.userid
@@ -137,7 +273,7 @@ class SQLUser(object):
         if not self.allow_new_users:
             raise BackendError("Creation of new users is disabled")
 
-        password_hash = sscrypt(password)
+        password_hash = sscrypt2(password)
         values = {
             'username': username,
             'password': password_hash,
@@ -153,6 +289,7 @@ class SQLUser(object):
             #Name already exists
             return False
 
+        self._reads.written(('username', username))
         if res.rowcount != 1:
             return False
 
@@ -181,16 +318,12 @@ class SQLUser(object):
         if password is None:
             return None
 
-        fields = [users.c.userid, users.c.password, users.c.accountStatus]
-        if attrs is not None:
-            for attr in attrs:
-                fields.append(getattr(users.c, attr))
-        else:
+        if attrs is None:
             attrs = []
 
-        _USER_AUTH = select(fields, users.c.username == bindparam('username'))
-        res = safe_execute(self._engine, _USER_AUTH,
-                           username=username).fetchone()
+        _USER_AUTH = _compiled(self._engine, _user_auth, attrs)
+        res = self._reads.execute(_USER_AUTH, ('username', username),
+                                  username=username).fetchone()
         if res is None:
             return None
 
@@ -200,12 +333,59 @@ class SQLUser(object):
         if not validate_password(password, res.password):
             return None
 
+        if self.rehash_passwords and password_needs_rehash(res.password):
+            self._rehash_password(res.userid, username, password,
+                                  res.password)
+
         user['username'] = username
         user['userid'] = res.userid
         for attr in attrs:
             user[attr] = getattr(res, attr)
         return res.userid
 
+    def _rehash_password(self, user_id, username, password, old_hash):
+        """Queues the replacement of an outdated password hash.
+
+        The hashes are replaced one at a time by a background worker. When
+        rehash_max_queue of them are pending, the rehash is dropped, and
+        will happen at a later login."""
+        job = user_id, username, password, old_hash
+        with self._rehash_lock:
+            if user_id in self._rehashing:
+                return
+            try:
+                self._rehash_queue.put_nowait(job)
+            except Queue.Full:
+                return
+            self._rehashing.add(user_id)
+            # started lazily, and again in a forked process
+            if (self._rehash_worker is None or
+                not self._rehash_worker.is_alive()):
+                self._rehash_worker = threading.Thread(target=self._rehash)
+                self._rehash_worker.daemon = True
+                self._rehash_worker.start()
+
+    def _rehash(self):
+        while True:
+            user_id, username, password, old_hash = self._rehash_queue.get()
+            try:
+                # only applies if the hash didn't change meanwhile
+                query = update(users, and_(users.c.userid == user_id,
+                                           users.c.password == old_hash),
+                               {'password': sscrypt2(password)})
+                safe_execute(self._engine, query)
+                self._written({'userid': user_id, 'username': username})
+                self._forget_user(user_id)
+            except Exception:
+                logger = CLIENT_HOLDER.default_client
+                if logger is not None:
+                    logger.exception('Could not rehash the password of %s'
+                                     % user_id)
+            finally:
+                with self._rehash_lock:
+                    self._rehashing.discard(user_id)
+                self._rehash_queue.task_done()
+
     def get_user_info(self, user, attrs):
         """Returns user info
 
@@ -224,15 +404,28 @@ class SQLUser(object):
         if attrs == []:
             return user
 
-        fields = []
-        for attr in attrs:
-            fields.append(getattr(users.c, attr))
-
-        _USER_INFO = select(fields, users.c.userid == bindparam('user_id'))
-        res = safe_execute(self._engine, _USER_INFO,
-                           user_id=user_id).fetchone()
+        # the whole row gets cached, so that it serves any of its columns
+        cached = self._cache.size > 0 and set(attrs) <= set(_CACHED_FIELDS)
+        if cached:
+            row = self._get_cached_row(user_id)
+            if row is not None:
+                for attr in attrs:
+                    user[attr] = row[attr]
+                return user
+            attrs, wanted = _CACHED_FIELDS, attrs
+
+        _USER_INFO = _compiled(self._engine, _user_info, attrs)
+        res = self._reads.execute(_USER_INFO, ('userid', user_id),
+                                  user_id=user_id).fetchone()
         if res is None:
             return user
+        if cached:
+            row = dict((attr, getattr(res, attr)) for attr in attrs)
+            # answered as if it was a cache hit
+            row = self._set_cached_row(user_id, row)
+            for attr in wanted:
+                user[attr] = row[attr]
+            return user
         for attr in attrs:
             try:
                 user[attr] = getattr(res, attr)
@@ -241,6 +434,126 @@ class SQLUser(object):
 
         return user
 
+    def resolve_users(self, values, attrs=None, key='username',
+                      batch_size=100):
+        """Returns the users matching many user names, or user ids.
+
+        Runs one query per batch of batch_size values.
+
+        Args:
+            values: the user names, or user ids, to look up
+            attrs: the pieces of data requested
+            key: 'username' or 'userid', depending on what values are
+
+        Returns:
+            a mapping of the values found, as given, to their user object
+        """
+        if key not in ('username', 'userid'):
+            raise ValueError('Unknown key %r' % key)
+        if attrs is None:
+            attrs = []
+
+        fields = [users.c.userid, users.c.username]
+        for attr in attrs:
+            if attr not in ('userid', 'username'):
+                fields.append(getattr(users.c, attr))
+        column = getattr(users.c, key)
+
+        # the values as the caller gave them, by normalized value
+        wanted = {}
+        for value in values:
+            normalized = _lookup_key(key, value)
+            if normalized is not None:
+                wanted.setdefault(normalized, []).append(value)
+
+        found = {}
+        for chunk in batch(wanted, batch_size):
+            query = select(fields, column.in_(list(chunk)))
+            for res in self._reads.execute(query).fetchall():
+                user = User(res.username, res.userid)
+                for attr in attrs:
+                    user[attr] = getattr(res, attr)
+                for value in wanted.get(_lookup_key(key, user[key]), ()):
+                    found[value] = user
+        return found
+
+    def import_users(self, records, batch_size=1000):
+        """Creates users in bulk.
+
+        Each batch of batch_size users is inserted with a single
+        executemany, in its own transaction. If a batch fails, it is rolled
+        back and the error is raised - the previous batches are kept.
+
+        Args:
+            records: an iterable of dicts, with a username and any of the
+                     userid, mail, accountStatus, mailVerified and syncNode
+                     fields. The password is given either in clear with
+                     "password", or already hashed with "password_hash".
+
+        Returns:
+            the number of users created
+        """
+        if not self.allow_new_users:
+            raise BackendError("Creation of new users is disabled")
+
+        count = 0
+        for chunk in batch(records, batch_size):
+            rows = []
+            for record in chunk:
+                row = dict(_BULK_FIELDS)
+                for field in row:
+                    if field != 'password' and field in record:
+                        row[field] = record[field]
+                if record.get('password_hash') is not None:
+                    row['password'] = record['password_hash']
+                elif record.get('password') is not None:
+                    row['password'] = sscrypt2(record['password'])
+                rows.append(row)
+
+            conn = self._engine.connect()
+            try:
+                trans = conn.begin()
+                try:
+                    conn.execute(insert(users), rows)
+                    trans.commit()
+                except Exception:
+                    trans.rollback()
+                    raise
+            except DBAPIError, exc:
+                if not _is_operational_db_error(self._engine, exc):
+                    raise
+                raise BackendError(str(exc))
+            finally:
+                conn.close()
+
+            for row in rows:
+                self._reads.written(('username', row['username']))
+            count += len(rows)
+        return count
+
+    def export_users(self, batch_size=1000):
+        """Yields every user, ordered by user id.
+
+        The rows are read batch_size at a time, with a server-side cursor
+        when the driver supports it. Each user is a dict that can be given
+        back to import_users, with the hashed password in "password_hash".
+        """
+        fields = [getattr(users.c, field) for field in _BULK_FIELDS]
+        query = select(fields).order_by(users.c.userid)
+        conn = self._engine.connect().execution_options(stream_results=True)
+        try:
+            res = conn.execute(query)
+            while True:
+                rows = res.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    record = dict(row.items())
+                    record['password_hash'] = record.pop('password')
+                    yield record
+        finally:
+            conn.close()
+
     @_password_to_credentials
     def update_field(self, user, credentials, key, value):
         """Change the value of a user's field
@@ -264,6 +577,10 @@ class SQLUser(object):
 
         query = update(users, users.c.userid == user_id, {key: value})
         res = safe_execute(self._engine, query)
+        self._written(user)
+        self._forget_user(user_id)
+        if key == 'password':
+            notify(USER_CHANGED, user_id)
         user[key] = value
         return res.rowcount == 1
 
@@ -296,7 +613,7 @@ class SQLUser(object):
         Returns:
             True if the change was successful, False otherwise
         """
-        password_hash = sscrypt(new_password.encode('utf8'))
+        password_hash = sscrypt2(new_password.encode('utf8'))
         return self.admin_update_field(user, 'password', password_hash)
 
     @_password_to_credentials
@@ -322,4 +639,7 @@ class SQLUser(object):
 
         query = delete(users).where(users.c.userid == user_id)
         res = safe_execute(self._engine, query)
+        self._written(user)
+        self._forget_user(user_id)
+        notify(USER_CHANGED, user_id)
         return res.rowcount == 1
@@ -42,6 +42,7 @@ import traceback
 import random
 import string
 from hashlib import sha256, sha1, md5
+import hmac
 import base64
 import simplejson as json
 import itertools
@@ -51,6 +52,9 @@ import os
 import urllib2
 from decimal import Decimal, InvalidOperation
 import time
+import math
+import thread
+import threading
 import warnings
 
 from webob.exc import HTTPBadRequest, HTTPServiceUnavailable
@@ -58,11 +62,20 @@ from webob import Response
 
 import scrypt
 
+try:
+    from gevent.monkey import is_module_patched
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    is_module_patched = ThreadPool = None
+
 import sqlalchemy
 from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
+from sqlalchemy.sql.expression import _TextClause, Select
 
 from metlog.holder import CLIENT_HOLDER
 from services.exceptions import BackendError, BackendTimeoutError  # NOQA
+from services.cache import LRUCache
+from services.retry import RetryPolicy
 
 random.seed()
 _RE_CODE = re.compile('[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}')
@@ -91,19 +104,61 @@ def function_moved(moved_to, follow_redirect=True):
     return arg_wrapper
 
 
-def randchar(chars=string.digits + string.letters):
-    """Generates a random char using urandom.
+class RandomPool(object):
+    """Serves random bytes out of os.urandom blocks, so that small reads
+    don't cost a system call each.
+
+    The bytes left are dropped after a fork, so that two processes never
+    get the same ones.
+    """
+    def __init__(self, block_size=256):
+        self.block_size = block_size
+        self._bytes = ''
+        self._pid = None
+        self._lock = thread.allocate_lock()
+
+    def read(self, size):
+        """Returns size random bytes."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._bytes = ''
+                self._pid = os.getpid()
+            if len(self._bytes) < size:
+                self._bytes += os.urandom(max(self.block_size, size))
+            data, self._bytes = self._bytes[:size], self._bytes[size:]
+        return data
+
+
+RANDOM_POOL = RandomPool()
+
+
+def randchars(count, chars=string.digits + string.letters):
+    """Generates count random chars using urandom.
 
     If the system does not support it, the function fallbacks on random.choice
 
-    See Haypo's explanation on the used formula to pick a char:
-    http://bitbucket.org/haypo/hasard/src/tip/doc/common_errors.rst
+    The bytes over the last multiple of len(chars) are skipped, so that
+    every char has the same odds.
     """
+    limit = 256 - 256 % len(chars)
+    result = []
     try:
-        pos = int(float(ord(os.urandom(1))) * 256. / 255.)
-        return chars[pos % len(chars)]
+        while len(result) < count:
+            for byte in RANDOM_POOL.read(count - len(result)):
+                byte = ord(byte)
+                if byte < limit:
+                    result.append(chars[byte % len(chars)])
     except NotImplementedError:
-        return random.choice(chars)
+        return ''.join([random.choice(chars) for i in range(count)])
+    return ''.join(result)
+
+
+def randchar(chars=string.digits + string.letters):
+    """Generates a random char using urandom.
+
+    If the system does not support it, the function fallbacks on random.choice
+    """
+    return randchars(1, chars)
 
 
 def time2bigint(value):
@@ -148,10 +203,94 @@ def round_time(value=None, precision=2):
 
 _SALT_LEN = 8
 
+_HASH_METLOG_PREFIX = 'services.util.hash_pool.'
+
+
+class HashPool(object):
+    """Runs the password hashes out of the gevent loop.
+
+    When gevent patched the threading module, the hashes run in a pool of
+    `size` native threads - scrypt releases the GIL - and the calling
+    greenlet waits for them cooperatively. Otherwise, they just run in the
+    calling thread.
+
+    At most `max_queue` hashes can be queued or running: past that, a
+    BackendError is raised rather than letting the logins pile up.
+    """
+    def __init__(self, size=4, max_queue=64):
+        self.size = int(size)
+        self.max_queue = int(max_queue)
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def resize(self, size):
+        """Changes the number of threads. The threads of the previous pool
+        exit once the hashes it was given are done."""
+        with self._lock:
+            self.size = int(size)
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pid == os.getpid():
+            pool.kill()
+
+    def _get_pool(self):
+        """Returns the thread pool, or None when hashing inline."""
+        if ThreadPool is None or not is_module_patched('threading'):
+            return None
+        pool = self._pool
+        # the pool has to be created in the process using it
+        if pool is None or self._pid != os.getpid():
+            with self._lock:
+                # another caller may have created it meanwhile
+                pool = self._pool
+                if pool is None or self._pid != os.getpid():
+                    pool = self._pool = ThreadPool(self.size)
+                    self._pid = os.getpid()
+        return pool
+
+    def run(self, func, *args):
+        """Calls func(*args) in the pool, and returns its result."""
+        logger = CLIENT_HOLDER.default_client
+        with self._lock:
+            if self.pending >= self.max_queue:
+                if logger is not None:
+                    logger.incr(_HASH_METLOG_PREFIX + 'rejected')
+                raise BackendError('Too many password hashes pending')
+            self.pending += 1
+            pending = self.pending
+        if logger is not None:
+            logger.metlog('gauge', payload=str(pending),
+                          fields={'name': _HASH_METLOG_PREFIX + 'queue'})
+        start = time.time()
+        try:
+            pool = self._get_pool()
+            if pool is None:
+                return func(*args)
+            return pool.apply(func, args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+            if logger is not None:
+                logger.timer_send(_HASH_METLOG_PREFIX + 'latency',
+                                  (time.time() - start) * 1000)
+
+
+# shared by every scrypt hash of the process
+HASH_POOL = HashPool()
+
+
+def configure_hash_pool(size=None, max_queue=None):
+    """Changes the size and the queue of the password hashing pool."""
+    if size is not None and int(size) != HASH_POOL.size:
+        HASH_POOL.resize(size)
+    if max_queue is not None:
+        HASH_POOL.max_queue = int(max_queue)
+
 
 def _gensalt():
     """Generates a salt"""
-    return ''.join([randchar() for i in range(_SALT_LEN)])
+    return randchars(_SALT_LEN)
 
 
 def ssha(password, salt=None):
@@ -196,32 +335,172 @@ def sscrypt(password, salt=None):
     password = password.encode('utf8')
     if salt is None:
         salt = _gensalt()
-    sscrypt = base64.b64encode(scrypt.hash(password, salt) + salt).strip()
+    hashed = HASH_POOL.run(scrypt.hash, password, salt)
+    sscrypt = base64.b64encode(hashed + salt).strip()
     return "{SSCRYPT}%s" % sscrypt
 
 
+# cost parameters of the new scrypt hashes, see configure_scrypt
+SCRYPT_PARAMS = {'N': 16384, 'r': 8, 'p': 1}
+_SCRYPT_SALT_LEN = 16
+_SCRYPT_HASH_LEN = 32
+
+
+def configure_scrypt(N=None, r=None, p=None):
+    """Changes the cost parameters used by sscrypt2.
+
+    Existing hashes keep working, as they carry their own parameters."""
+    params = dict(SCRYPT_PARAMS)
+    for name, value in (('N', N), ('r', r), ('p', p)):
+        if value is not None:
+            params[name] = int(value)
+    if params['N'] < 2 or params['N'] & (params['N'] - 1):
+        raise ValueError('N must be a power of 2 (got %d)' % params['N'])
+    if params['r'] < 1 or params['p'] < 1:
+        raise ValueError('r and p must be positive')
+    SCRYPT_PARAMS.update(params)
+
+
+def sscrypt2(password, salt=None, N=None, r=None, p=None,
+             length=_SCRYPT_HASH_LEN):
+    """Returns a Salted-Scrypt password hash that embeds its cost
+    parameters, as {SSCRYPT2}N$r$p$salt$hash
+
+    Args:
+        password: password
+        salt: salt to use. If none, one is generated
+        N, r, p: scrypt parameters. If none, SCRYPT_PARAMS are used
+        length: length of the derived key, in bytes
+    """
+    password = password.encode('utf8')
+    if salt is None:
+        salt = RANDOM_POOL.read(_SCRYPT_SALT_LEN)
+    N = SCRYPT_PARAMS['N'] if N is None else N
+    r = SCRYPT_PARAMS['r'] if r is None else r
+    p = SCRYPT_PARAMS['p'] if p is None else p
+    hashed = HASH_POOL.run(scrypt.hash, password, salt, N, r, p, length)
+    return "{SSCRYPT2}%d$%d$%d$%s$%s" % (N, r, p, base64.b64encode(salt),
+                                         base64.b64encode(hashed))
+
+
+def _parse_sscrypt2(hash):
+    """Returns the N, r, p, salt and hash of a {SSCRYPT2} hash"""
+    N, r, p, salt, hashed = hash[len('{SSCRYPT2}'):].split('$')
+    return (int(N), int(r), int(p), base64.b64decode(salt),
+            base64.b64decode(hashed))
+
+
+def _check_salted(hash_meth, prefix, clear, hash):
+    salt = base64.decodestring(hash[len(prefix):])[-_SALT_LEN:]
+    # all hash_meth take a unicode value for clear
+    return hash_meth(clear, salt) == hash
+
+
+def _equals(one, two):
+    """Compares two strings in a constant time"""
+    if len(one) != len(two):
+        return False
+    result = 0
+    for char1, char2 in zip(one, two):
+        result |= ord(char1) ^ ord(char2)
+    return result == 0
+
+
+def _check_sscrypt2(clear, hash):
+    try:
+        N, r, p, salt, hashed = _parse_sscrypt2(hash)
+    except (ValueError, TypeError):
+        return False
+    if not hashed:
+        return False
+    # the key length is the stored one, not the current default
+    password = sscrypt2(clear, salt, N, r, p, length=len(hashed))
+    return _equals(password, hash)
+
+
+# the verification function of each hash scheme, by prefix.
+_HASH_SCHEMES = {
+    '{SSHA}': lambda clear, hash: _check_salted(ssha, '{SSHA}', clear, hash),
+    '{SSHA-256}': lambda clear, hash: _check_salted(ssha256, '{SSHA-256}',
+                                                    clear, hash),
+    '{SSCRYPT}': lambda clear, hash: _check_salted(sscrypt, '{SSCRYPT}',
+                                                   clear, hash),
+    '{SSCRYPT2}': _check_sscrypt2,
+}
+
+
+def register_hash_scheme(prefix, check):
+    """Registers the check(clear, hash) function of a hash scheme.
+
+    The hashes of the scheme are the ones starting with prefix."""
+    _HASH_SCHEMES[prefix] = check
+
+
+def _hash_scheme(hash):
+    if not hash.startswith('{'):
+        return None
+    return hash[:hash.find('}') + 1]
+
+
+def password_needs_rehash(hash):
+    """Returns True if a hash wasn't made by sscrypt2 with the current
+    SCRYPT_PARAMS, and should be upgraded at the next login."""
+    if _hash_scheme(hash) != '{SSCRYPT2}':
+        return True
+    try:
+        N, r, p = _parse_sscrypt2(hash)[:3]
+    except (ValueError, TypeError):
+        return True
+    return {'N': N, 'r': r, 'p': p} != SCRYPT_PARAMS
+
+
+# Credentials that recently matched their stored hash, as an HMAC of the
+# password and of the hash, keyed with a secret of the process. The salt
+# makes every hash unique, and a new hash gives new keys, so a password
+# change takes effect right away.
+_VERIFIED = LRUCache(size=1000, ttl=60)
+_VERIFIED_SECRET = os.urandom(32)
+
+
+def configure_credential_cache(size=None, ttl=None):
+    """Changes the size and the ttl of the verified credentials cache.
+    A size of 0 disables it."""
+    if size is not None:
+        _VERIFIED.size = int(size)
+        _VERIFIED.clear()
+    if ttl is not None:
+        _VERIFIED.ttl = float(ttl)
+
+
+def _credential_key(clear, hash):
+    if isinstance(clear, unicode):
+        clear = clear.encode('utf8')
+    data = '%d:%s%s' % (len(clear), clear, hash)
+    return hmac.new(_VERIFIED_SECRET, data, sha256).digest()
+
+
 def validate_password(clear, hash):
-    """Validates a Salted-SHA(256) password
+    """Validates a password against a hash of one of the registered schemes
+
+    Successful checks are cached for a while, so that the clients sending
+    their credentials on every request don't pay for a hash each time.
 
     Args:
         clear: password in clear text
         hash: hash of the password
     """
-    if hash.startswith('{SSCRYPT}'):
-        real_hash = hash.split('{SSCRYPT}')[-1]
-        hash_meth = sscrypt
-    elif hash.startswith('{SSHA-256}'):
-        real_hash = hash.split('{SSHA-256}')[-1]
-        hash_meth = ssha256
-    else:
-        real_hash = hash.split('{SSHA}')[-1]
-        hash_meth = ssha
-
-    salt = base64.decodestring(real_hash)[-_SALT_LEN:]
+    key = None
+    if _VERIFIED.size > 0:
+        key = _credential_key(clear, hash)
+        if _VERIFIED.get(key) is not None:
+            return True
 
-    # both hash_meth take a unicode value for clear
-    password = hash_meth(clear, salt)
-    return password == hash
+    check = _HASH_SCHEMES.get(_hash_scheme(hash))
+    if check is None or not check(clear, hash):
+        return False
+    if key is not None:
+        _VERIFIED.set(key, True)
+    return True
 
 
 def valid_password(user_name, password):
@@ -362,18 +641,136 @@ class CatchErrorMiddleware(object):
             return [response]
 
 
+# queries running for longer than this, in seconds, get logged
+SLOW_QUERY_THRESHOLD = 1.
+
+# how safe_execute retries the queries, unless the engine has its own
+SQL_RETRY_POLICY = RetryPolicy(max_attempts=2, base_delay=.05, name='sql')
+
+# MySQL error code for queries cancelled on a max_execution_time
+_MYSQL_QUERY_TIMEOUT = 3024
+
+# Request deadlines, keyed by thread.get_ident() looked up at call time so
+# that they follow gevent's monkey-patching, and are kept per greenlet.
+_DEADLINES = {}
+
+_SQL_METLOG_PREFIX = 'services.util.sql.'
+
+
 def create_engine(*args, **kwds):
     """Wrapper for sqlalchemy.create_engine with some extra security measures.
 
     This function wraps a call to sqlalchemy.create_engine with logic to
     restrict the process umask.  This ensures that sqlite database files are
     created with secure permissions by default.
+
+    The extra `slow_query_threshold` option overrides SLOW_QUERY_THRESHOLD
+    for the queries run through safe_execute on this engine, the extra
+    `statement_timeout` option caps the time they may run, in seconds, and
+    the extra `retry_policy` one overrides SQL_RETRY_POLICY.
     """
+    slow_query_threshold = kwds.pop('slow_query_threshold', None)
+    statement_timeout = kwds.pop('statement_timeout', None)
+    retry_policy = kwds.pop('retry_policy', None)
     old_umask = os.umask(0077)
     try:
-        return sqlalchemy.create_engine(*args, **kwds)
+        engine = sqlalchemy.create_engine(*args, **kwds)
     finally:
         os.umask(old_umask)
+    if slow_query_threshold is not None:
+        engine.slow_query_threshold = float(slow_query_threshold)
+    if statement_timeout is not None:
+        engine.statement_timeout = float(statement_timeout)
+    if retry_policy is not None:
+        engine.retry_policy = retry_policy
+    return engine
+
+
+def set_deadline(timeout):
+    """Sets the time left to the current request, in seconds.
+
+    Queries run through safe_execute past this deadline are not started,
+    and the MySQL ones get cancelled server-side when it expires.
+    None removes the deadline.
+    """
+    ident = thread.get_ident()
+    if timeout is None:
+        _DEADLINES.pop(ident, None)
+    else:
+        _DEADLINES[ident] = time.time() + float(timeout)
+
+
+def get_time_left():
+    """Returns the seconds left to the current request, or None."""
+    deadline = _DEADLINES.get(thread.get_ident())
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def _statement_timeout(engine):
+    """Returns how long a statement may run on this engine, or None."""
+    timeout = getattr(engine, 'statement_timeout', None)
+    left = get_time_left()
+    if left is not None and (timeout is None or left < timeout):
+        timeout = left
+    return timeout
+
+
+def _mysql_timeout_hint(query, timeout):
+    """Returns the SELECT query with a MAX_EXECUTION_TIME optimizer hint.
+
+    The hint applies to this statement only, so no extra round-trip is
+    needed to set the session value. Servers before 5.7.8 take it for a
+    comment, and other statements, which MySQL doesn't time out, are
+    returned unchanged.
+    """
+    if timeout is None:
+        return query
+    hint = '/*+ MAX_EXECUTION_TIME(%d) */' % int(math.ceil(timeout * 1000))
+    if isinstance(query, Select):
+        return query.prefix_with(hint)
+    if isinstance(query, basestring):
+        words = query.lstrip().split(None, 1)
+        if len(words) == 2 and words[0].upper() == 'SELECT':
+            return '%s %s %s' % (words[0], hint, words[1])
+    return query
+
+
+def _sql_incr(name):
+    logger = CLIENT_HOLDER.default_client
+    if logger is not None:
+        logger.incr(_SQL_METLOG_PREFIX + name)
+
+
+def _statement_label(query):
+    """Returns a short label naming a statement, for the metrics.
+
+    An explicit label can be given with query.execution_options(label=...).
+    Otherwise it's built from the kind of statement and the tables it uses,
+    e.g. "select.users" or "update.reset_codes".
+    """
+    statement = getattr(query, 'statement', None)
+    if statement is not None:
+        # compiled statement
+        query = statement
+    options = getattr(query, '_execution_options', None) or {}
+    if 'label' in options:
+        return options['label']
+
+    if isinstance(query, basestring) or isinstance(query, _TextClause):
+        words = str(query).split(None, 1)
+        return words and words[0].lower() or 'unknown'
+
+    kind = query.__class__.__name__.lower()
+    table = getattr(query, 'table', None)
+    if table is not None:
+        tables = [table]
+    else:
+        tables = getattr(query, 'froms', ())
+    names = sorted(set(getattr(table, 'name', None) or 'anon'
+                       for table in tables))
+    return '.'.join([kind] + names)
 
 
 def execute_with_cleanup(engine, query, *args, **kwargs):
@@ -385,10 +782,38 @@ def execute_with_cleanup(engine, query, *args, **kwargs):
 
     The cleanup currently works only for the PyMySQL driver.  Other drivers
     will still work, they just won't get the cleanup.
+
+    Queries are not started once the request deadline (see set_deadline)
+    is over, and on MySQL the time left is passed as a MAX_EXECUTION_TIME
+    hint so that the server cancels the slow SELECTs.
     """
-    conn = engine.contextual_connect(close_with_result=True)
+    timeout = _statement_timeout(engine)
+    if timeout is not None and timeout <= 0:
+        _sql_incr('deadline_exceeded')
+        raise BackendTimeoutError('Deadline exceeded before the query')
+
+    logger = CLIENT_HOLDER.default_client
+    start = time.time()
     try:
-        return conn.execute(query, *args, **kwargs)
+        conn = engine.contextual_connect(close_with_result=True)
+    except TimeoutError:
+        _sql_incr('checkout_timeout')
+        raise
+    if logger is not None:
+        logger.timer_send(_SQL_METLOG_PREFIX + 'checkout_wait',
+                          (time.time() - start) * 1000)
+        # QueuePool going over its size is a sign of saturation
+        overflow = getattr(engine.pool, 'overflow', None)
+        if overflow is not None and overflow() > 0:
+            logger.incr(_SQL_METLOG_PREFIX + 'overflow')
+    if engine.dialect.name == 'mysql':
+        query = _mysql_timeout_hint(query, _statement_timeout(engine))
+    try:
+        start = time.time()
+        try:
+            return conn.execute(query, *args, **kwargs)
+        finally:
+            _record_query(engine, query, time.time() - start)
     except Exception:
         # Normal exceptions are passed straight through.
         raise
@@ -435,11 +860,27 @@ def execute_with_cleanup(engine, query, *args, **kwargs):
             try:
                 # Don't return this connection to the pool.
                 conn.invalidate()
+                _sql_incr('invalidated')
             finally:
                 # Always re-raise the original error.
                 raise exc, val, tb
 
 
+def _record_query(engine, query, duration):
+    """Sends the query latency to metlog, and logs it if it's slow."""
+    logger = CLIENT_HOLDER.default_client
+    if logger is None:
+        return
+    label = _statement_label(query)
+    logger.timer_send(_SQL_METLOG_PREFIX + 'query.' + label, duration * 1000)
+    threshold = getattr(engine, 'slow_query_threshold',
+                        SLOW_QUERY_THRESHOLD)
+    if duration > threshold:
+        logger.incr(_SQL_METLOG_PREFIX + 'slow_query.' + label)
+        logger.warn('slow query (%.3fs) %s: %s', duration, label,
+                    str(query)[:200])
+
+
 def safe_execute(engine, *args, **kwargs):
     """Execution wrapper that will raise a HTTPServiceUnavailableError
     on any OperationalError errors and log it.
@@ -448,16 +889,23 @@ def safe_execute(engine, *args, **kwargs):
         # It's possible for the backend to raise a "connection invalided" error
         # if e.g. the server timed out the connection.  SQLAlchemy purges the
         # the whole connection pool if this happens, so one retry is enough.
-        try:
-            return execute_with_cleanup(engine, *args, **kwargs)
-        except DBAPIError, exc:
-            if _is_retryable_db_error(engine, exc):
+        # The retries follow the engine's retry policy, see services.retry.
+        policy = getattr(engine, 'retry_policy', SQL_RETRY_POLICY)
+        for attempt in policy.attempts(engine):
+            if attempt > 0:
                 logger = CLIENT_HOLDER.default_client
                 logger.incr('services.util.safe_execute.retry')
-                logger.debug('retrying due to db error %r', exc)
+                logger.debug('retrying due to db error %r', exc_info[1])
+            try:
                 return execute_with_cleanup(engine, *args, **kwargs)
-            else:
-                raise
+            except DBAPIError, exc:
+                if not _is_retryable_db_error(engine, exc):
+                    raise
+                if exc.connection_invalidated:
+                    _sql_incr('invalidated')
+                exc_info = sys.exc_info()
+        # out of retries
+        raise exc_info[0], exc_info[1], exc_info[2]
     except Exception, exc:
         if not _is_operational_db_error(engine, exc):
             raise
@@ -468,9 +916,14 @@ def safe_execute(engine, *args, **kwargs):
         # of connection failure to leave zombies checked out of the pool.
         # Ref:  http://www.sqlalchemy.org/trac/ticket/2695
         # We employ a rather brutal workaround: re-create the entire pool.
-        if _get_mysql_error_code(engine, exc) in (2006, 2013, 2014):
+        mysql_error_code = _get_mysql_error_code(engine, exc)
+        if mysql_error_code in (2006, 2013, 2014):
             if not exc.connection_invalidated:
                 engine.dispose()
+                _sql_incr('dispose')
+        elif mysql_error_code == _MYSQL_QUERY_TIMEOUT:
+            _sql_incr('statement_timeout')
+            raise BackendTimeoutError(str(exc))
         raise BackendError(str(exc))
 
 
@@ -518,13 +971,101 @@ def _is_operational_db_error(engine, exc):
         if _is_retryable_db_error(engine, exc):
             return True
         # MySQL "Query execution was interrupted" errors are operational.
-        # They're produced by ops killing long-running queries.
-        if mysql_error_code == 1317:
+        # They're produced by ops killing long-running queries, or by
+        # max_execution_time.
+        if mysql_error_code in (1317, _MYSQL_QUERY_TIMEOUT):
             return True
     # Everything else counts as a programming error.
     return False
 
 
+def parse_weighted_uris(uris):
+    """Returns a list of (uri, weight) from a list, or a space separated
+    string, of URIs. A weight can be appended to an URI as "#weight"."""
+    if isinstance(uris, basestring):
+        uris = uris.split()
+    res = []
+    for uri in uris:
+        uri, __, weight = uri.strip().partition('#')
+        if uri:
+            res.append((uri, int(weight or 1)))
+    return res
+
+
+class _Replica(object):
+    def __init__(self, engine, weight=1):
+        self.engine = engine
+        self.weight = weight
+        self.current = 0
+        self.down_until = 0
+
+
+class ReadRouter(object):
+    """Sends read-only queries to replica engines, and the rest to the
+    primary one.
+
+    Replicas are picked by smooth weighted round-robin. A replica failing
+    with an operational error is skipped for `retry_after` seconds, and the
+    query is run on the primary instead. Timeouts are raised as they are.
+
+    For `write_window` seconds after written() is called for a key, the
+    reads for that key go to the primary, so that a user sees its own
+    changes in spite of the replication lag. This only covers the writes
+    done by the current process.
+    """
+    def __init__(self, engine, read_engines=(), retry_after=30,
+                 write_window=5, max_writes=10000):
+        self.engine = engine
+        self.replicas = [_Replica(read_engine, weight)
+                         for read_engine, weight in read_engines]
+        self.retry_after = float(retry_after)
+        self._writes = LRUCache(max_writes, write_window)
+        self._lock = threading.Lock()
+
+    def _pick(self):
+        """Returns the next healthy replica, or None."""
+        now = time.time()
+        with self._lock:
+            healthy = [replica for replica in self.replicas
+                       if replica.down_until <= now]
+            if not healthy:
+                return None
+            total = 0
+            for replica in healthy:
+                replica.current += replica.weight
+                total += replica.weight
+            best = max(healthy, key=lambda replica: replica.current)
+            best.current -= total
+            return best
+
+    def written(self, *keys):
+        """Marks keys as modified - their reads go to the primary."""
+        for key in keys:
+            if key is not None:
+                self._writes.set(key, True)
+
+    def execute(self, query, key=None, **params):
+        """Runs a read-only query, on a replica if possible."""
+        replica = None
+        if self.replicas and (key is None or self._writes.get(key) is None):
+            replica = self._pick()
+
+        if replica is not None:
+            try:
+                return safe_execute(replica.engine, query, **params)
+            except BackendTimeoutError:
+                # the request ran out of time, the replica is not to blame
+                raise
+            except BackendError:
+                # safe_execute only raises it on operational errors
+                replica.down_until = time.time() + self.retry_after
+                logger = CLIENT_HOLDER.default_client
+                if logger is not None:
+                    logger.incr('services.util.read_router.replica_down')
+
+        return safe_execute(self.engine, query, **params)
+
+
 def get_source_ip(environ):
     """Extracts the source IP from the environ."""
     if 'HTTP_X_FORWARDED_FOR' in environ:
@@ -538,7 +1079,7 @@ def create_hash(data):
     """Creates a unique hash using the data provided
     and a bit of randomness
     """
-    rand = ''.join([randchar() for x in range(10)])
+    rand = randchars(10)
     data += rand
     return md5(data + rand).hexdigest()
 
@@ -53,6 +53,7 @@ from metlog_cef import AUTH_FAILURE
 
 from services.pluginreg import load_and_configure
 from services.user import User
+from services.authcache import get_auth_cache
 
 from services.whoauth.backendauth import BackendAuthPlugin
 
@@ -96,6 +97,7 @@ class WhoAuthentication(object):
             self.backend = load_and_configure(self.config, 'auth')
         except KeyError:
             self.backend = None
+        self.cache = get_auth_cache(self.config)
         self.logger = CLIENT_HOLDER.default_client
         # Extract who-related settings from the config or from our defaults.
         # the configured authentication backend.
@@ -274,6 +276,8 @@ class WhoAuthentication(object):
                 plugin.config = self.config
             if plugin.backend is None:
                 plugin.backend = self.backend
+            if plugin.cache is None:
+                plugin.cache = self.cache
 
     def _find_backend_plugins(self, api_factory):
         """Return set of BackendAuthPlugin objects used by the api factory."""
@@ -50,6 +50,7 @@ from metlog.holder import CLIENT_HOLDER
 from metlog_cef import AUTH_FAILURE
 
 from services.user import User, extract_username
+from services.authcache import checks_node
 
 
 class BackendAuthPlugin(object):
@@ -62,9 +63,10 @@ class BackendAuthPlugin(object):
 
     implements(IAuthenticator)
 
-    def __init__(self, config=None, backend=None):
+    def __init__(self, config=None, backend=None, cache=None):
         self.config = config
         self.backend = backend
+        self.cache = cache
         self.logger = CLIENT_HOLDER.default_client
 
     def authenticate(self, environ, identity):
@@ -76,11 +78,25 @@ class BackendAuthPlugin(object):
             if username is None:
                 return None
         orig_username = username
+        orig_password = password = identity.get("password")
+
+        # Credentials that passed recently skip the backend.
+        if self.cache is not None and password is not None:
+            cached = self.cache.get(username, password)
+            if (cached is not None
+                and checks_node(self.backend, self.config)
+                and cached["syncNode"] != environ.get("HTTP_HOST")):
+                cached = None
+            if cached is not None:
+                if not isinstance(password, unicode):
+                    identity["password"] = password.decode("utf8")
+                identity.update(cached)
+                return cached["username"]
+
         identity["username"] = username = extract_username(username)
 
         # Normalize the password, if any, to be unicode.
         # It it's not valid utf8 then authentication fails.
-        password = identity.get("password")
         if password is not None and not isinstance(password, unicode):
             try:
                 identity["password"] = password.decode("utf8")
@@ -104,6 +120,14 @@ class BackendAuthPlugin(object):
 
         # Success!  Store any loaded attributes into the identity dict.
         identity.update(user)
+        if self.cache is not None and orig_password is not None:
+            sync_node = user.get("syncNode")
+            if sync_node is None and checks_node(self.backend, self.config):
+                # the old-style backends checked the node against the host
+                sync_node = environ.get("HTTP_HOST")
+            data = {"username": user["username"], "userid": user["userid"],
+                    "syncNode": sync_node}
+            self.cache.set(orig_username, orig_password, data)
         return user["username"]
 
     def _authenticate_oldstyle(self, environ, username, identity):
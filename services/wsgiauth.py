@@ -46,6 +46,7 @@ from metlog_cef import AUTH_FAILURE
 
 from services.pluginreg import load_and_configure
 from services.user import User, extract_username
+from services.authcache import get_auth_cache, checks_node
 
 
 class Authentication(object):
@@ -69,6 +70,7 @@ class Authentication(object):
     def __init__(self, config):
         self.config = config
         self.backend = load_and_configure(self.config, 'auth')
+        self.cache = get_auth_cache(self.config)
         self.logger = CLIENT_HOLDER.default_client
 
     def _log_cef(self, name, severity, environ, config=None,
@@ -151,68 +153,29 @@ class Authentication(object):
                               7, environ, config, user_name, AUTH_FAILURE)
                 raise HTTPUnauthorized()
 
-            # if this is an email, hash it. Save the original for logging and
-            #  debugging.
-            remote_user_original = user_name
-            try:
-                user_name = extract_username(user_name)
-            except UnicodeError:
-                self._log_cef('Username contains invalid characters',
-                              7, environ)
-                raise HTTPBadRequest('Invalid characters specified in ' +
-                                     'username', {}, 'Username must be BIDI ' +
-                                     'compliant UTF-8')
-
-            # let's try an authentication
-            # the authenticate_user API takes a unicode UTF-8 for the password
-            try:
+            # credentials that passed recently skip the backend
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.get(user_name, password)
+                if (cached is not None
+                    and checks_node(self.backend, self.config)
+                    and cached['syncNode'] != environ.get('HTTP_HOST')):
+                    cached = None
+
+            if cached is not None:
+                # cached credentials were decoded fine the first time
                 password = password.decode('utf8')
-            except UnicodeDecodeError:
-                self._log_cef('Password is not utf-8 encoded', 7, environ)
-                raise HTTPUnauthorized()
-
-            #first we need to figure out if this is old-style or new-style auth
-            if hasattr(self.backend, 'generate_reset_code'):
-
-            # XXX to be removed once we get the proper fix see bug #662859
-                if (hasattr(self.backend, 'check_node')
-                    and self.backend.check_node):
-                    user_id = self.backend.authenticate_user(user_name,
-                                            password, environ.get('HTTP_HOST'))
-                else:
-                    user_id = self.backend.authenticate_user(user_name,
-                                                             password)
+                user_name = cached['username']
+                user_id = cached['userid']
                 request.user = User(user_name, user_id)
+                request.user['syncNode'] = cached['syncNode']
             else:
-                user = User(user_name)
-                credentials = {"username": user_name, "password": password}
-                attrs = []
-                check_node = self.config.get('auth.check_node')
-                if check_node:
-                    attrs.append('syncNode')
-                user_id = self.backend.authenticate_user(user, credentials,
-                                                         attrs)
-                if not user_id:
-                    user_id = None
-                    user = None
-                else:
-                    if (check_node
-                        and user.get('syncNode') != environ.get('HTTP_HOST')):
-                        self._log_cef('User authenticated to wrong node',
-                                      7, environ)
-                        user_id = None
-                        user = None
-
-                request.user = user
-
-            if user_id is None:
-                err_user = user_name
-                if remote_user_original is not None and \
-                    user_name != remote_user_original:
-                        err_user += ' (%s)' % (remote_user_original)
-                self._log_cef('User Authentication Failed', 5,
-                              environ, config, err_user, AUTH_FAILURE)
-                raise HTTPUnauthorized()
+                raw_credentials = user_name, password
+                user_name, password, user_id = self._authenticate_backend(
+                                     request, config, user_name, password)
+                if self.cache is not None:
+                    self._cache_user(environ, raw_credentials,
+                                     request.user)
 
             # we're all clear ! setting up REMOTE_USER
             request.remote_user = environ['REMOTE_USER'] = user_name
@@ -224,3 +187,85 @@ class Authentication(object):
 
             del environ['HTTP_AUTHORIZATION']
             return user_id
+
+    def _cache_user(self, environ, raw_credentials, user):
+        """Caches the successful authentication of a user."""
+        sync_node = user.get('syncNode')
+        if sync_node is None and checks_node(self.backend, self.config):
+            # the old-style backends checked the node against the host
+            sync_node = environ.get('HTTP_HOST')
+        data = {'username': user['username'], 'userid': user['userid'],
+                'syncNode': sync_node}
+        self.cache.set(raw_credentials[0], raw_credentials[1], data)
+
+    def _authenticate_backend(self, request, config, user_name, password):
+        """Authenticates the credentials of a request against the backend.
+
+        Returns the normalized user name, the decoded password and the
+        user id, or raises an HTTP error.
+        """
+        environ = request.environ
+        # if this is an email, hash it. Save the original for logging and
+        #  debugging.
+        remote_user_original = user_name
+        try:
+            user_name = extract_username(user_name)
+        except UnicodeError:
+            self._log_cef('Username contains invalid characters',
+                          7, environ)
+            raise HTTPBadRequest('Invalid characters specified in ' +
+                                 'username', {}, 'Username must be BIDI ' +
+                                 'compliant UTF-8')
+
+        # let's try an authentication
+        # the authenticate_user API takes a unicode UTF-8 for the password
+        try:
+            password = password.decode('utf8')
+        except UnicodeDecodeError:
+            self._log_cef('Password is not utf-8 encoded', 7, environ)
+            raise HTTPUnauthorized()
+
+        #first we need to figure out if this is old-style or new-style auth
+        if hasattr(self.backend, 'generate_reset_code'):
+
+        # XXX to be removed once we get the proper fix see bug #662859
+            if (hasattr(self.backend, 'check_node')
+                and self.backend.check_node):
+                user_id = self.backend.authenticate_user(user_name,
+                                        password, environ.get('HTTP_HOST'))
+            else:
+                user_id = self.backend.authenticate_user(user_name,
+                                                         password)
+            request.user = User(user_name, user_id)
+        else:
+            user = User(user_name)
+            credentials = {"username": user_name, "password": password}
+            attrs = []
+            check_node = self.config.get('auth.check_node')
+            if check_node:
+                attrs.append('syncNode')
+            user_id = self.backend.authenticate_user(user, credentials,
+                                                     attrs)
+            if not user_id:
+                user_id = None
+                user = None
+            else:
+                if (check_node
+                    and user.get('syncNode') != environ.get('HTTP_HOST')):
+                    self._log_cef('User authenticated to wrong node',
+                                  7, environ)
+                    user_id = None
+                    user = None
+
+            request.user = user
+
+        if user_id is None:
+            err_user = user_name
+            if remote_user_original is not None and \
+                user_name != remote_user_original:
+                    err_user += ' (%s)' % (remote_user_original)
+            self._log_cef('User Authentication Failed', 5,
+                          environ, config, err_user, AUTH_FAILURE)
+            raise HTTPUnauthorized()
+
+        return user_name, password, user_id